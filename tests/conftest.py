@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+from PIL import Image, ImageDraw
+
+# 测试直接导入仓库根目录下的模块
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def sample_image(mode='RGB', size=(301, 203)):
+    """有细节、每个通道都不相同的测试图片"""
+    base = Image.effect_mandelbrot(size, (-2, -1.2, 1, 1.2), 60).convert('L')
+    noise = Image.effect_noise(size, 40)
+    rgb = Image.merge('RGB', (base, noise, base.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    ImageDraw.Draw(rgb).text((10, 10), "test", fill=(255, 0, 0))
+    if mode == 'RGBA':
+        return Image.merge('RGBA', (*rgb.split(), noise))
+    if mode == 'LA':
+        return Image.merge('LA', (base, noise))
+    if mode == 'P':
+        return rgb.quantize(200)
+    return rgb.convert(mode)
+
+
+def watermark_image(size=(40, 24)):
+    """半透明的测试水印"""
+    image = Image.new('RGBA', size, (255, 0, 0, 128))
+    ImageDraw.Draw(image).rectangle((5, 5, size[0] - 6, size[1] - 6), fill=(0, 0, 255, 200))
+    return image
+
+
+@pytest.fixture
+def sample():
+    return sample_image
+
+
+@pytest.fixture
+def watermark():
+    return watermark_image()
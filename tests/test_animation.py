@@ -0,0 +1,88 @@
+import io
+
+import pytest
+from PIL import Image
+
+import watermark_animation as wa
+from watermark_core import WatermarkRenderer, WatermarkSettings
+from watermark_encoders import get_profile
+
+DURATIONS = [100, 200, 300, 150, 50]
+LOOP = 3
+
+
+def animation(image_format, size=(120, 80)):
+    frames = [Image.new('RGB', size, (i * 40, 50, 100)) for i in range(len(DURATIONS))]
+    buffer = io.BytesIO()
+    frames[0].save(buffer, image_format, save_all=True, append_images=frames[1:],
+                   duration=DURATIONS, loop=LOOP)
+    buffer.seek(0)
+    return Image.open(buffer)
+
+
+def frame_info(data):
+    """每帧的时长和循环次数"""
+    with Image.open(io.BytesIO(data)) as image:
+        durations = []
+        for i in range(image.n_frames):
+            image.seek(i)
+            # WebP 的帧时长在 load 之后才更新
+            image.load()
+            durations.append(image.info['duration'])
+        return image.format, durations, image.info.get('loop')
+
+
+def encode(source, profile, watermark, size=None):
+    renderer = WatermarkRenderer(WatermarkSettings(watermark_type='custom', position='居中'), watermark)
+    encoded, = wa.encode_animation(source, [(renderer, get_profile(profile), size)])
+    if isinstance(encoded, Exception):
+        raise encoded
+    return encoded
+
+
+@pytest.fixture(params=['stream', 'save'])
+def webp_writer(request, monkeypatch):
+    """分别测试逐帧编码器和 Image.save 的后备方式"""
+    if request.param == 'stream':
+        if wa.webp_anim_encoder() is None:
+            pytest.skip("当前 Pillow 不能逐帧编码 WebP")
+    else:
+        monkeypatch.setattr(wa, '_webp_encoder', False)
+    return request.param
+
+
+@pytest.mark.parametrize('source_format', ['GIF', 'WEBP'])
+def test_gif_keeps_durations_and_loop(source_format, watermark):
+    encoded = encode(animation(source_format), 'gif', watermark)
+    assert frame_info(encoded.data) == ('GIF', DURATIONS, LOOP)
+
+
+@pytest.mark.parametrize('source_format', ['GIF', 'WEBP'])
+def test_webp_keeps_durations_and_loop(source_format, watermark, webp_writer):
+    encoded = encode(animation(source_format), 'webp', watermark)
+    assert frame_info(encoded.data) == ('WEBP', DURATIONS, LOOP)
+
+
+def test_every_frame_is_watermarked(watermark):
+    source = animation('GIF')
+    encoded = encode(source, 'gif', watermark)
+    with Image.open(io.BytesIO(encoded.data)) as image:
+        for i in range(image.n_frames):
+            image.seek(i)
+            source.seek(i)
+            center = (image.width // 2, image.height // 2)
+            assert image.convert('RGB').getpixel(center) != source.convert('RGB').getpixel(center)
+
+
+def test_resized_output_keeps_timing(watermark, webp_writer):
+    encoded = encode(animation('GIF'), 'webp', watermark, size=(60, 40))
+    with Image.open(io.BytesIO(encoded.data)) as image:
+        assert image.size == (60, 40)
+    assert frame_info(encoded.data)[1:] == (DURATIONS, LOOP)
+
+
+def test_save_fallback_limit(watermark, monkeypatch):
+    monkeypatch.setattr(wa, '_webp_encoder', False)
+    monkeypatch.setattr(wa, 'WEBP_FALLBACK_MB', 0.01)
+    with pytest.raises(OSError):
+        encode(animation('GIF'), 'webp', watermark)
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+from PIL import Image
+
+from watermark_batch import iter_batch
+from watermark_core import WatermarkSettings
+from watermark_manifest import Manifest
+
+
+@pytest.fixture
+def photos(tmp_path, sample):
+    folder = tmp_path / 'in'
+    folder.mkdir()
+    paths = []
+    for i in range(3):
+        path = str(folder / f'photo{i}.jpg')
+        sample('RGB', (120 + i, 90)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def run(paths, out, manifest_path, settings=None, watermark=None, force=False, profile=None):
+    """处理一次，返回 {文件名: 是否跳过}"""
+    settings = settings or WatermarkSettings(watermark_type='custom')
+    with Manifest(manifest_path, force=force) as manifest:
+        results = list(iter_batch(paths, out, settings, watermark, workers=1,
+                                  manifest=manifest, profile=profile))
+    assert all(result.ok for result in results), [result.error for result in results]
+    return {os.path.basename(result.image_path): result.skipped for result in results}
+
+
+def test_manifest_skips_unchanged(tmp_path, photos, watermark):
+    out, manifest_path = str(tmp_path / 'out'), str(tmp_path / 'manifest.sqlite')
+    assert run(photos, out, manifest_path, watermark=watermark) == {
+        'photo0.jpg': False, 'photo1.jpg': False, 'photo2.jpg': False}
+    written = {name: os.stat(os.path.join(out, name)).st_mtime_ns for name in os.listdir(out)}
+    assert sorted(written) == ['photo0_watermarked.jpg', 'photo1_watermarked.jpg', 'photo2_watermarked.jpg']
+
+    # 记录重新打开后仍然有效，跳过的文件不会重写
+    assert set(run(photos, out, manifest_path, watermark=watermark).values()) == {True}
+    assert {name: os.stat(os.path.join(out, name)).st_mtime_ns for name in os.listdir(out)} == written
+
+
+def test_manifest_reprocesses_changes(tmp_path, photos, watermark, sample):
+    out, manifest_path = str(tmp_path / 'out'), str(tmp_path / 'manifest.sqlite')
+    run(photos, out, manifest_path, watermark=watermark)
+
+    # 原图修改
+    sample('RGB', (200, 150)).save(photos[0], quality=80)
+    # 输出被删除
+    os.remove(os.path.join(out, 'photo1_watermarked.jpg'))
+    assert run(photos, out, manifest_path, watermark=watermark) == {
+        'photo0.jpg': False, 'photo1.jpg': False, 'photo2.jpg': True}
+    with Image.open(os.path.join(out, 'photo0_watermarked.jpg')) as image:
+        assert image.size == (200, 150)
+
+    # 设置、输出格式变化时全部重新处理
+    changed = WatermarkSettings(watermark_type='custom', opacity=0.8)
+    assert set(run(photos, out, manifest_path, changed, watermark).values()) == {False}
+    assert set(run(photos, out, manifest_path, changed, watermark).values()) == {True}
+    assert set(run(photos, out, manifest_path, changed, watermark, profile='jpeg-web').values()) == {False}
+
+
+def test_manifest_force(tmp_path, photos, watermark):
+    out, manifest_path = str(tmp_path / 'out'), str(tmp_path / 'manifest.sqlite')
+    run(photos, out, manifest_path, watermark=watermark)
+    assert set(run(photos, out, manifest_path, watermark=watermark, force=True).values()) == {False}
+    # force 仍然更新记录
+    assert set(run(photos, out, manifest_path, watermark=watermark).values()) == {True}
@@ -0,0 +1,101 @@
+import pytest
+
+from watermark_core import MAX_TILE_SPACING, TILED, WatermarkRenderer, WatermarkSettings, tile_layout
+
+
+def placements(image_size, cell_size, spacing, stagger):
+    """tile_layout 展开后每个水印的左上角"""
+    rows, period = tile_layout(image_size, cell_size, spacing, stagger)
+    cells = []
+    for left, top in rows:
+        x = left
+        while x < image_size[0]:
+            cells.append((x, top))
+            x += period
+    return rows, period, cells
+
+
+def visible(cell, cell_size, image_size):
+    x, y = cell
+    return x + cell_size[0] > 0 and y + cell_size[1] > 0 and x < image_size[0] and y < image_size[1]
+
+
+@pytest.mark.parametrize('image_size, cell_size', [
+    ((100, 80), (10, 7)),
+    ((101, 79), (33, 20)),
+    ((7, 5), (3, 2)),
+    ((1, 1), (1, 1)),
+])
+@pytest.mark.parametrize('stagger', [False, True])
+def test_zero_spacing_covers_image(image_size, cell_size, stagger):
+    _, period, cells = placements(image_size, cell_size, 0.0, stagger)
+    assert period == cell_size[0]
+    covered = set()
+    for x, y in cells:
+        for px in range(max(x, 0), min(x + cell_size[0], image_size[0])):
+            for py in range(max(y, 0), min(y + cell_size[1], image_size[1])):
+                covered.add((px, py))
+    assert len(covered) == image_size[0] * image_size[1]
+
+
+@pytest.mark.parametrize('spacing', [0.0, 0.5, 3.0, MAX_TILE_SPACING, 1000.0])
+@pytest.mark.parametrize('stagger', [False, True])
+def test_rows_start_at_first_visible_cell(spacing, stagger):
+    image_size, cell_size = (200, 150), (30, 12)
+    rows, period, cells = placements(image_size, cell_size, spacing, stagger)
+    assert rows
+    for left, top in rows:
+        # 每行第一个水印的右边缘在图片内，它左边的一个已经完全在图片之外
+        assert -cell_size[0] < left < image_size[0]
+        assert left - period + cell_size[0] <= 0
+        assert -cell_size[1] < top < image_size[1]
+    assert all(visible(cell, cell_size, image_size) for cell in cells)
+
+
+@pytest.mark.parametrize('image_size, cell_size', [
+    ((200, 150), (30, 12)),
+    ((50, 40), (80, 60)),
+    ((10, 300), (7, 9)),
+])
+@pytest.mark.parametrize('spacing', [0.0, 0.5, 1000.0])
+@pytest.mark.parametrize('stagger', [False, True])
+def test_center_cell_present(image_size, cell_size, spacing, stagger):
+    _, _, cells = placements(image_size, cell_size, spacing, stagger)
+    center = ((image_size[0] - cell_size[0]) // 2, (image_size[1] - cell_size[1]) // 2)
+    assert center in cells
+
+
+def test_cell_larger_than_image_is_single_centered_cell():
+    _, _, cells = placements((50, 40), (80, 60), 1000.0, True)
+    assert cells == [(-15, -10)]
+
+
+def test_spacing_is_clamped():
+    assert tile_layout((200, 150), (30, 12), -5.0, False) == tile_layout((200, 150), (30, 12), 0.0, False)
+    assert tile_layout((200, 150), (30, 12), 1e9, True) == tile_layout((200, 150), (30, 12), MAX_TILE_SPACING, True)
+    _, period = tile_layout((200, 150), (30, 12), 1e9, True)
+    assert period == round(30 * (1 + MAX_TILE_SPACING))
+
+
+def test_stagger_shifts_odd_rows_by_half_period():
+    plain, period = tile_layout((400, 300), (20, 10), 1.0, False)
+    staggered, _ = tile_layout((400, 300), (20, 10), 1.0, True)
+    assert [top for _, top in plain] == [top for _, top in staggered]
+    shifts = {(b[0] - a[0]) % period for a, b in zip(plain, staggered)}
+    assert shifts == {0, period // 2}
+
+
+def test_huge_spacing_skips_rows_outside_image():
+    rows, period = tile_layout((100, 1000), (20, 10), MAX_TILE_SPACING, True)
+    # 间距很大、错开时奇数行可能整行都在图片之外
+    assert all(left < 100 for left, _ in rows)
+    assert len(rows) < 1000 // round(10 * (1 + MAX_TILE_SPACING)) + 2
+
+
+def test_tiled_render_is_deterministic(sample, watermark):
+    settings = WatermarkSettings(watermark_type='custom', position=TILED, tile_spacing=0.3, tile_angle=15.0)
+    image = sample('RGB')
+    first = WatermarkRenderer(settings, watermark).render(image)
+    second = WatermarkRenderer(settings, watermark).render(image)
+    assert first.tobytes() == second.tobytes()
+    assert first.tobytes() != image.tobytes()
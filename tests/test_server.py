@@ -0,0 +1,179 @@
+import io
+import json
+import socket
+import threading
+import http.client
+
+import pytest
+from PIL import Image
+
+from watermark_core import WatermarkSettings, create_fallback_watermark
+from watermark_server import WatermarkHTTPServer, WatermarkService
+
+MAX_BODY = 1024 * 1024
+QUERY = '/watermark?watermark_type=text&text=test&profile=jpeg'
+
+
+@pytest.fixture(scope='module')
+def service():
+    service = WatermarkService(WatermarkSettings(), {'default': create_fallback_watermark()}, 1, MAX_BODY)
+    yield service
+    service.close()
+
+
+def start(service, max_connections=64):
+    server = WatermarkHTTPServer(('127.0.0.1', 0), service, quiet=True, max_connections=max_connections)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def stop(server):
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope='module')
+def server(service):
+    server = start(service)
+    yield server
+    stop(server)
+
+
+def connect(server):
+    return http.client.HTTPConnection(*server.server_address[:2], timeout=30)
+
+
+def raw_request(server, request):
+    """发送原始请求，返回状态码和完整响应（服务器关闭连接为止）"""
+    with socket.create_connection(server.server_address[:2], timeout=30) as sock:
+        sock.sendall(request)
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    response = b''.join(chunks)
+    return int(response.split(b' ', 2)[1]), response
+
+
+def jpeg_bytes(sample):
+    buffer = io.BytesIO()
+    sample('RGB').save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def test_watermark_and_keep_alive(server, sample):
+    conn = connect(server)
+    body = jpeg_bytes(sample)
+    for _ in range(2):
+        conn.request('POST', QUERY, body, {'Content-Type': 'image/jpeg'})
+        response = conn.getresponse()
+        data = response.read()
+        assert response.status == 200
+        assert response.getheader('Content-Type') == 'image/jpeg'
+        assert 'Server-Timing' in response.headers
+        with Image.open(io.BytesIO(data)) as image:
+            assert image.size == (301, 203)
+    conn.close()
+
+
+def test_missing_content_length_is_411(server):
+    status, response = raw_request(server, b'POST ' + QUERY.encode() + b' HTTP/1.1\r\nHost: x\r\n\r\n')
+    assert status == 411
+    assert b'Connection: close' in response
+
+
+def test_chunked_is_411(server):
+    status, _ = raw_request(server, b'POST ' + QUERY.encode() + b' HTTP/1.1\r\nHost: x\r\n'
+                                    b'Transfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n0\r\n\r\n')
+    assert status == 411
+
+
+def test_too_large_is_413_without_body(server):
+    # 只发送请求头，服务器不等待请求体就返回 413 并关闭连接
+    status, response = raw_request(server, b'POST ' + QUERY.encode() + b' HTTP/1.1\r\nHost: x\r\n'
+                                           b'Content-Length: %d\r\n\r\n' % (MAX_BODY + 1))
+    assert status == 413
+    assert b'Connection: close' in response
+
+
+def test_expect_continue_too_large_is_413(server):
+    status, _ = raw_request(server, b'POST ' + QUERY.encode() + b' HTTP/1.1\r\nHost: x\r\n'
+                                    b'Expect: 100-continue\r\nContent-Length: %d\r\n\r\n' % (MAX_BODY + 1))
+    assert status == 413
+
+
+def test_unknown_image_is_415(server):
+    conn = connect(server)
+    conn.request('POST', QUERY, b'not an image', {'Content-Type': 'application/octet-stream'})
+    response = conn.getresponse()
+    assert response.status == 415
+    assert 'error' in json.loads(response.read())
+    conn.close()
+
+
+def test_bad_settings_is_400(server, sample):
+    conn = connect(server)
+    conn.request('POST', '/watermark?opacity=2', jpeg_bytes(sample))
+    response = conn.getresponse()
+    response.read()
+    assert response.status == 400
+    conn.close()
+
+
+def test_queue_full_is_503_before_body(server, service):
+    # 占满所有排队位置
+    for _ in range(service.queue_limit):
+        assert service._slots.acquire(blocking=False)
+    try:
+        status, response = raw_request(server, b'POST ' + QUERY.encode() + b' HTTP/1.1\r\nHost: x\r\n'
+                                               b'Content-Length: 1000\r\n\r\n')
+        assert status == 503
+        assert b'Retry-After: 1' in response
+        assert b'Connection: close' in response
+    finally:
+        for _ in range(service.queue_limit):
+            service._slots.release()
+
+
+def test_connection_limit_is_503(service):
+    server = start(service, max_connections=1)
+    try:
+        # 第一个连接保持着（keep-alive），占用唯一的连接名额
+        conn = connect(server)
+        conn.request('GET', '/health')
+        response = conn.getresponse()
+        assert response.read() == b'ok'
+        status, response = raw_request(server, b'GET /health HTTP/1.1\r\nHost: x\r\n\r\n')
+        assert status == 503
+        assert b'Retry-After: 1' in response
+        conn.close()
+    finally:
+        stop(server)
+
+
+def metrics(server):
+    conn = connect(server)
+    conn.request('GET', '/metrics')
+    response = conn.getresponse()
+    data = json.loads(response.read())
+    conn.close()
+    assert response.status == 200
+    return data
+
+
+def test_metrics_counts_statuses(server, sample):
+    before = metrics(server)
+    raw_request(server, b'POST ' + QUERY.encode() + b' HTTP/1.1\r\nHost: x\r\n\r\n')
+    conn = connect(server)
+    conn.request('POST', QUERY, jpeg_bytes(sample))
+    conn.getresponse().read()
+    conn.close()
+    after = metrics(server)
+    assert after['workers'] == 1
+    assert after['requests'] == before['requests'] + 2
+    for status in ('200', '411'):
+        assert after['status'].get(status, 0) == before['status'].get(status, 0) + 1
+    assert after['latency_ms']
@@ -0,0 +1,132 @@
+import zlib
+import struct
+
+import pytest
+from PIL import Image
+
+import watermark_tiles as wt
+from watermark_core import TILED, WatermarkRenderer, WatermarkSettings
+
+
+def save_png(image, path, **options):
+    image.save(path, **options)
+
+
+def save_tiled_tiff(image, path, tile_size=(64, 32)):
+    """按图块存储、Deflate 压缩的 TIFF（Pillow 只能写条带）"""
+    width, height = image.size
+    tile_width, tile_length = tile_size
+    pieces = []
+    for y in range(0, height, tile_length):
+        for x in range(0, width, tile_width):
+            tile = Image.new('RGB', tile_size)
+            tile.paste(image.crop((x, y, min(x + tile_width, width), min(y + tile_length, height))))
+            pieces.append(zlib.compress(tile.tobytes()))
+    entries = {
+        256: (width, 4), 257: (height, 4), 258: ((8, 8, 8), 3), 259: (8, 3), 262: (2, 3), 277: (3, 3),
+        284: (1, 3), 322: (tile_width, 4), 323: (tile_length, 4), 325: (tuple(len(p) for p in pieces), 4),
+    }
+    with open(path, 'wb') as f:
+        f.write(wt.tiff_file(entries, wt.TIFF_TILE_OFFSETS, pieces))
+
+
+# (文件名, 预期的 stream_kind, 生成函数)
+SOURCES = [
+    ('rgb.png', 'png', lambda s, p: save_png(s('RGB'), p)),
+    ('rgba.png', 'png', lambda s, p: save_png(s('RGBA'), p)),
+    ('l.png', 'png', lambda s, p: save_png(s('L'), p)),
+    ('la.png', 'png', lambda s, p: save_png(s('LA'), p)),
+    ('1.png', 'png', lambda s, p: save_png(s('1'), p)),
+    ('p.png', 'png', lambda s, p: save_png(s('P'), p, transparency=bytes([0, 128] + [255] * 10))),
+    ('p4.png', 'png', lambda s, p: save_png(s('RGB').quantize(16), p, bits=4)),
+    ('raw.tif', 'raw', lambda s, p: s('RGB').save(p)),
+    ('raw.bmp', 'raw', lambda s, p: s('RGB').save(p)),
+    ('raw.ppm', 'raw', lambda s, p: s('RGB').save(p)),
+    ('lzw.tif', 'tiff', lambda s, p: s('RGB').save(p, compression='tiff_lzw')),
+    ('deflate.tif', 'tiff', lambda s, p: s('RGB').save(p, compression='tiff_adobe_deflate', tiffinfo={317: 2})),
+    ('jpeg.tif', 'tiff', lambda s, p: s('RGB').save(p, compression='jpeg')),
+    ('packbits.tif', 'tiff', lambda s, p: s('RGB').save(p, compression='packbits')),
+    ('rgba_lzw.tif', 'tiff', lambda s, p: s('RGBA').save(p, compression='tiff_lzw')),
+    ('tiled.tif', 'tiff', lambda s, p: save_tiled_tiff(s('RGB'), p)),
+]
+
+
+def assemble(path, band_height):
+    """把 iter_bands 产出的条带拼回整张图片"""
+    with Image.open(path) as image:
+        kind = wt.stream_kind(image)
+        unit = wt.band_unit(image, kind)
+        out = Image.new('RGBA', image.size)
+    band_height = max(unit, band_height // unit * unit)
+    next_top = 0
+    for top, band in wt.iter_bands(path, band_height):
+        assert top == next_top
+        assert band.height <= band_height
+        out.paste(band.convert('RGBA'), (0, top))
+        next_top = top + band.height
+    assert next_top == out.height
+    return out
+
+
+@pytest.mark.parametrize('name, kind, make', SOURCES, ids=[s[0] for s in SOURCES])
+@pytest.mark.parametrize('band_height', [1, 7, 100, 5000])
+def test_bands_match_full_decode(tmp_path, sample, name, kind, make, band_height):
+    path = str(tmp_path / name)
+    make(sample, path)
+    with Image.open(path) as image:
+        assert wt.stream_kind(image) == kind
+        expected = image.convert('RGBA').tobytes()
+    assert assemble(path, band_height).tobytes() == expected
+
+
+def png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+def test_interlaced_png_is_not_streamed(tmp_path):
+    # Pillow 不能写入隔行扫描的 PNG，手工拼一张 1x1 的
+    path = str(tmp_path / 'interlaced.png')
+    with open(path, 'wb') as f:
+        f.write(wt.PNG_SIGNATURE + png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 2, 0, 0, 1))
+                + png_chunk(b'IDAT', zlib.compress(b'\x00\x01\x02\x03')) + png_chunk(b'IEND', b''))
+    with Image.open(path) as image:
+        assert image.getpixel((0, 0)) == (1, 2, 3)
+        assert wt.stream_kind(image) is None
+        with pytest.raises(wt.MemoryLimitError):
+            wt.check_memory(image, 1, 'PNG')
+
+
+def test_check_memory(tmp_path, sample):
+    path = str(tmp_path / 'lzw.tif')
+    sample('RGB').save(path, compression='tiff_lzw', tiffinfo={wt.TIFF_ROWS_PER_STRIP: 16})
+    with Image.open(path) as image:
+        assert wt.band_unit(image, 'tiff') == 16
+        strip = wt.band_bytes_per_row(image) * 16
+        assert not wt.check_memory(image, wt.decoded_size(image), 'PNG')
+        assert wt.check_memory(image, strip, 'PNG')
+        # 只有输出 PNG 时才能分块
+        with pytest.raises(wt.MemoryLimitError):
+            wt.check_memory(image, strip, 'JPEG')
+        # 一个条带都放不下
+        with pytest.raises(wt.MemoryLimitError):
+            wt.check_memory(image, strip - 1, 'PNG')
+
+
+RENDER_SOURCES = [s for s in SOURCES if s[0] in ('rgb.png', 'rgba.png', 'raw.tif', 'lzw.tif', 'tiled.tif')]
+
+
+@pytest.mark.parametrize('name, kind, make', RENDER_SOURCES, ids=[s[0] for s in RENDER_SOURCES])
+@pytest.mark.parametrize('position', ['右下', TILED])
+def test_process_tiled_matches_full_render(tmp_path, sample, watermark, name, kind, make, position):
+    path = str(tmp_path / name)
+    make(sample, path)
+    renderer = WatermarkRenderer(WatermarkSettings(watermark_type='custom', position=position), watermark)
+    save_path = str(tmp_path / 'out.png')
+    with Image.open(path) as image:
+        row_bytes = wt.band_bytes_per_row(image)
+        expected = renderer.render(image.convert(wt.output_mode(image.mode)))
+    # 上限只够放几十行，整张图片要分成多个条带
+    wt.process_tiled(renderer, path, save_path, row_bytes * 40)
+    with Image.open(save_path) as result:
+        assert result.mode == expected.mode
+        assert result.tobytes() == expected.tobytes()
@@ -0,0 +1,391 @@
+"""动图（GIF、WebP）逐帧加水印
+
+逐帧解码、加水印、编码，同时只保留解码器当前的一帧和正在处理的一帧，
+很长的动图内存占用也和帧数无关。每帧的时长、循环次数和 GIF 的帧处置
+方式（disposal）保持不变；所有帧尺寸相同，水印图块只在第一帧生成一次，
+之后从 OverlayCache 取用。输出 GIF 时和 Pillow 一样，不透明的帧只写出与
+上一帧不同的区域。
+
+Pillow 保存动图时会先把所有帧放进列表，GIF 还会逐帧重新量化，所以这里
+自己逐帧写出：GIF 使用 Pillow 的 getheader/getdata，WebP 使用 libwebp 的
+动图编码器（Pillow 的内部接口 _webp.WebPAnimEncoder，只在测试过的 Pillow
+版本上、并且试编码一帧成功后才使用，否则收集帧后交给 Image.save，帧占用的
+内存超过 WEBP_FALLBACK_MB 时报错）。输出 GIF 时不逐帧重新量化：原帧用到的颜色不超过 255 种时（GIF
+原图总是如此），这一帧的局部调色板由原帧的颜色加上水印区域的颜色组成，
+没有被水印改变的像素颜色完全不变，只有加了水印的像素按调色板查找最接近的
+颜色；颜色更多的帧按全局调色板查找（原图为 GIF 时沿用它的调色板，其他原图
+用第一帧加水印后的颜色生成）。
+
+输出 JPEG、PNG 时只能保留第一帧。
+"""
+import io
+import time
+
+from PIL import GifImagePlugin, Image, ImageChops
+from PIL import __version__ as PILLOW_VERSION
+
+from watermark_core import downscale, has_transparency
+from watermark_encoders import EncodeResult
+from watermark_metrics import StageTimer
+
+
+# 可以保存动画的输出格式
+ANIMATED_FORMATS = ('GIF', 'WEBP')
+# GIF 只有全透明和不透明，透明度低于一半的像素写成透明
+TRANSPARENT_ALPHA = [255] * 128 + [0] * 128
+# 加水印前后有差别的像素
+CHANGED = [0] + [255] * 255
+# 整个画布重绘的帧之间清除为背景（透明），非 GIF 原图使用
+DISPOSE_TO_BACKGROUND = 2
+# 下一帧只写出变化的区域时，这一帧留在画布上
+LEAVE_IN_PLACE = 1
+# 逐帧编码 WebP 使用的 _webp.WebPAnimEncoder 在这个范围的 Pillow 版本中测试过
+#（[最低, 最高)，Pillow 11 起帧以 Image.getim() 传入）
+WEBP_ENCODER_PILLOW = ((11, 0), (13, 0))
+# 不能逐帧编码 WebP 时，交给 Image.save 的帧最多占用的内存（MB）
+WEBP_FALLBACK_MB = 256
+
+
+def is_animated(image):
+    """图片是否有多帧"""
+    return getattr(image, 'is_animated', False)
+
+
+def iter_frames(image, timer=None):
+    """从第一帧开始逐帧解码，产出 (帧, 时长毫秒, disposal)
+
+    帧是解码器内部的图片，下一帧在它的基础上解码，使用前要先转换出一份。
+    GIF 以外的原图 disposal 为 None。
+    """
+    timer = timer or StageTimer()
+    index = 0
+    while True:
+        with timer.stage('decode'):
+            try:
+                image.seek(index)
+            except EOFError:
+                return
+            image.load()
+        yield image, image.info.get('duration', 0), getattr(image, 'disposal_method', None)
+        index += 1
+
+
+def palette_image(colors):
+    """用来按颜色查找序号的 P 模式图片，colors 为 [r, g, b, ...]"""
+    image = Image.new('P', (1, 1))
+    image.putpalette(colors)
+    return image
+
+
+def local_indexed(frame, original):
+    """原帧不超过 255 种颜色时，返回使用局部调色板的 P 模式帧，否则返回 None
+
+    frame 和 original 为 RGB 图片。颜色种数不超过调色板大小时 quantize 是精确的，
+    所以先按原帧生成序号，调色板剩下的位置放水印区域的颜色，再只把被水印
+    改变的像素换成其中最接近的颜色。
+    """
+    if original.getcolors(255) is None:
+        return None
+    indexed = original.quantize(255, dither=Image.Dither.NONE)
+    changed = ImageChops.difference(frame, original)
+    box = changed.getbbox()
+    if box is None:
+        return indexed
+    colors = indexed.getpalette()
+    region = frame.crop(box)
+    spare = 255 - len(colors) // 3
+    if spare:
+        colors += region.quantize(spare, dither=Image.Dither.NONE).getpalette()
+        indexed.putpalette(colors)
+    red, green, blue = changed.crop(box).split()
+    mask = ImageChops.lighter(ImageChops.lighter(red, green), blue).point(CHANGED)
+    indexed.paste(region.quantize(palette=palette_image(colors), dither=Image.Dither.NONE), box, mask)
+    return indexed
+
+
+def source_palette(image):
+    """GIF 原图（第一帧）的调色板颜色，去掉透明色；其他原图返回 None"""
+    if image.format != 'GIF' or image.mode != 'P':
+        return None
+    colors = image.getpalette()
+    transparency = image.info.get('transparency')
+    if isinstance(transparency, int) and transparency * 3 < len(colors):
+        del colors[transparency * 3:transparency * 3 + 3]
+    return colors
+
+
+class GIFStreamWriter:
+    """逐帧写入 GIF
+
+    palette 为全局调色板的颜色（[r, g, b, ...]），为空时用第一帧的颜色生成；
+    调色板不满 256 色时多留一个透明色。
+    """
+
+    def __init__(self, f, size, loop=None, palette=None):
+        self.f = f
+        self.size = size
+        self.loop = loop
+        self.palette = palette
+        self.transparency = None
+        self._lookup = None
+        # 还没有写出的上一帧 (P 模式帧, 位置, 参数)，等下一帧确定它的处置方式
+        self._pending = None
+        # 上一帧不透明时为它加水印后的图片，用来找出变化的区域
+        self._previous = None
+
+    def _start(self, frame):
+        if self.palette is None:
+            self.palette = frame.convert('RGB').quantize(255).getpalette()
+        colors = self.palette[:768]
+        self._lookup = palette_image(colors)
+        if len(colors) < 768:
+            self.transparency = len(colors) // 3
+            colors = colors + [0, 0, 0]
+        header_image = Image.new('P', self.size)
+        header_image.putpalette(colors)
+        # 帧带有时长等扩展，总是写成 GIF89a
+        header_image.info['version'] = b'89a'
+        info = {} if self.loop is None else {'loop': self.loop}
+        header, _ = GifImagePlugin.getheader(header_image, None, info)
+        self.f.write(b''.join(header))
+
+    def add(self, frame, duration=0, disposal=None, original=None):
+        """写入一帧（RGB 或 RGBA，尺寸与画布相同）
+
+        original 为加水印前的同一帧，颜色不多时用来生成局部调色板（local_indexed）。
+        不透明的帧与上一帧相同时只延长上一帧的时长，不同时只写出变化的区域。
+        """
+        if self._lookup is None:
+            self._start(frame)
+        params = {'duration': duration,
+                  'disposal': DISPOSE_TO_BACKGROUND if disposal is None else disposal}
+        offset = (0, 0)
+        if frame.mode == 'RGB' and self._previous is not None:
+            box = ImageChops.difference(frame, self._previous).getbbox()
+            if box is None:
+                self._pending[2]['duration'] += duration
+                return
+            self._pending[2]['disposal'] = LEAVE_IN_PLACE
+            self._previous = frame
+            offset = box[:2]
+            frame = frame.crop(box)
+            if original is not None:
+                original = original.crop(box)
+        else:
+            self._previous = frame if frame.mode == 'RGB' else None
+        rgb = frame.convert('RGB') if frame.mode == 'RGBA' else frame
+        indexed = None
+        if original is not None:
+            indexed = local_indexed(rgb, original.convert('RGB') if original.mode == 'RGBA' else original)
+        if indexed is None:
+            indexed = rgb.quantize(palette=self._lookup, dither=Image.Dither.NONE)
+            transparency = self.transparency
+        else:
+            # 局部调色板同样多留一个透明色
+            colors = indexed.getpalette()
+            transparency = len(colors) // 3
+            indexed.putpalette(colors + [0, 0, 0])
+            params['include_color_table'] = True
+        if frame.mode == 'RGBA' and transparency is not None:
+            indexed.paste(transparency, mask=frame.getchannel('A').point(TRANSPARENT_ALPHA))
+            params['transparency'] = transparency
+        self._flush()
+        self._pending = (indexed, offset, params)
+
+    def _flush(self):
+        if self._pending is not None:
+            indexed, offset, params = self._pending
+            self.f.write(b''.join(GifImagePlugin.getdata(indexed, offset, **params)))
+            self._pending = None
+
+    def close(self):
+        self._flush()
+        self.f.write(b';')
+
+
+def _pillow_version():
+    """Pillow 的 (主版本, 次版本)，无法解析时返回 None"""
+    try:
+        return tuple(int(part) for part in PILLOW_VERSION.split('.')[:2])
+    except ValueError:
+        return None
+
+
+def _probe_webp_encoder():
+    """用 1x1 的两帧试编码，接口和预期相同时返回 WebPAnimEncoder，否则返回 None"""
+    version = _pillow_version()
+    low, high = WEBP_ENCODER_PILLOW
+    if version is None or not low <= version < high:
+        return None
+    try:
+        from PIL import _webp
+        encoder = _webp.WebPAnimEncoder((1, 1), 0, 0, False, 3, 5, False, False)
+        encoder.add(Image.new('RGBA', (1, 1)).getim(), 0, False, 80, 100, 0)
+        encoder.add(None, 10, False, 80, 100, 0)
+        if not encoder.assemble('', '', ''):
+            return None
+        return _webp.WebPAnimEncoder
+    except (ImportError, AttributeError, TypeError, ValueError, OSError):
+        return None
+
+
+_webp_encoder = None
+
+
+def webp_anim_encoder():
+    """可以逐帧使用的 WebPAnimEncoder（第一次调用时检查），不能使用时返回 None"""
+    global _webp_encoder
+    if _webp_encoder is None:
+        _webp_encoder = _probe_webp_encoder() or False
+    return _webp_encoder or None
+
+
+class WebPStreamWriter:
+    """逐帧交给 libwebp 的动图编码器，编码器只保留压缩后的数据
+
+    encoder 为 webp_anim_encoder() 返回的编码器类。
+    """
+
+    def __init__(self, f, size, loop=None, options=None, encoder=None):
+        encoder = encoder or webp_anim_encoder()
+        if encoder is None:
+            raise OSError(f"Pillow {PILLOW_VERSION} 不支持逐帧编码 WebP 动图")
+        options = dict(options or {})
+        self.f = f
+        self.lossless = bool(options.get('lossless', False))
+        self.quality = options.get('quality', 80)
+        self.method = options.get('method', 0)
+        self.timestamp = 0
+        # 关键帧间隔与 Pillow 的默认值相同
+        kmin, kmax = (9, 17) if self.lossless else (3, 5)
+        # GIF 没有循环扩展时只播放一次；WebP 的 0 表示无限循环
+        self._encoder = encoder(size, 0, 1 if loop is None else loop, False, kmin, kmax, False, False)
+
+    def add(self, frame, duration=0, disposal=None, original=None):
+        """写入一帧（RGB 或 RGBA），WebP 的帧处置方式由编码器决定"""
+        self._encoder.add(frame.getim(), round(self.timestamp), self.lossless, self.quality, 100,
+                          self.method)
+        self.timestamp += duration
+
+    def close(self):
+        self._encoder.add(None, round(self.timestamp), self.lossless, self.quality, 100, 0)
+        data = self._encoder.assemble('', '', '')
+        if data is None:
+            raise OSError("WebP 动图编码失败")
+        self.f.write(data)
+
+
+class WebPSaveWriter:
+    """不能逐帧编码时的 WebP 写入器：收集帧，结束时用 Image.save(save_all=True) 编码
+
+    所有帧都留在内存中，合计超过 limit（字节，默认 WEBP_FALLBACK_MB）时抛出
+    OSError，不会耗尽内存。
+    """
+
+    def __init__(self, f, size, loop=None, options=None, limit=None):
+        self.f = f
+        self.options = dict(options or {})
+        self.loop = 1 if loop is None else loop
+        self.limit = WEBP_FALLBACK_MB * 1024 * 1024 if limit is None else limit
+        self.frames = []
+        self.durations = []
+        self.nbytes = 0
+
+    def add(self, frame, duration=0, disposal=None, original=None):
+        self.nbytes += frame.width * frame.height * len(frame.getbands())
+        if self.nbytes > self.limit:
+            low, high = WEBP_ENCODER_PILLOW
+            raise OSError(f"Pillow {PILLOW_VERSION} 不能逐帧编码 WebP 动图，动图超过 {self.limit // 1024 // 1024} MB "
+                          f"无法编码；请使用 Pillow {low[0]}.{low[1]} 到 {high[0]}.{high[1]} 之前的版本")
+        self.frames.append(frame)
+        self.durations.append(duration)
+
+    def close(self):
+        first, rest = self.frames[0], self.frames[1:]
+        first.save(self.f, 'WEBP', save_all=True, append_images=rest, duration=self.durations,
+                   loop=self.loop, lossless=bool(self.options.get('lossless', False)),
+                   quality=self.options.get('quality', 80), method=self.options.get('method', 0))
+        self.frames = []
+
+
+def open_writer(f, profile, size, loop, palette):
+    """按编码方案创建逐帧写入器"""
+    if profile.format == 'GIF':
+        return GIFStreamWriter(f, size, loop, palette)
+    if profile.format == 'WEBP':
+        encoder = webp_anim_encoder()
+        if encoder is None:
+            return WebPSaveWriter(f, size, loop, profile.options)
+        return WebPStreamWriter(f, size, loop, profile.options, encoder)
+    raise ValueError(f"{profile.format} 不能保存动图")
+
+
+def encode_animated_file(path, renderer, profile):
+    """path 为动图且 profile（已经 resolve）能保存动画时逐帧处理，返回 EncodeResult，否则返回 None"""
+    with Image.open(path) as image:
+        if not is_animated(image) or profile.format not in ANIMATED_FORMATS:
+            return None
+        encoded, = encode_animation(image, [(renderer, profile, None)])
+    if isinstance(encoded, Exception):
+        raise encoded
+    return encoded
+
+
+def encode_animation(image, outputs, timers=None):
+    """逐帧解码一次，按 outputs 中每个 (渲染器, 编码方案, 输出尺寸) 加水印并编码
+
+    编码方案为已经 resolve 过的 GIF 或 WebP 方案，输出尺寸为空时保持原图尺寸，
+    水印按原图尺寸等比缩放后放置。timers 与 outputs 一一对应，解码耗时记在
+    第一个上。返回与 outputs 对应的列表，每项为 EncodeResult，出错的输出为
+    异常对象，不影响其他输出。
+    """
+    timers = timers or [StageTimer() for _ in outputs]
+    full_size = image.size
+    loop = image.info.get('loop')
+    palette = source_palette(image)
+    buffers = [io.BytesIO() for _ in outputs]
+    writers = [None] * len(outputs)
+    encode_times = [0.0] * len(outputs)
+    errors = [None] * len(outputs)
+
+    for frame, duration, disposal in iter_frames(image, timers[0]):
+        active = [i for i in range(len(outputs)) if errors[i] is None]
+        if not active:
+            break
+        with timers[0].stage('convert'):
+            converted = frame.convert('RGBA' if has_transparency(frame) else 'RGB')
+        for n, i in enumerate(active):
+            renderer, profile, size = outputs[i]
+            timer = timers[i]
+            try:
+                original = converted
+                if size and tuple(size) != full_size:
+                    with timer.stage('resize'):
+                        original = downscale(converted, size)
+                # GIF 要用加水印前的帧生成调色板，合成到副本上；其他格式的最后一个
+                # 输出直接在转换出的帧上合成
+                copy = profile.format == 'GIF' or (original is converted and n < len(active) - 1)
+                current = renderer.render(original, reference_size=full_size, timer=timer, copy=copy)
+                start = time.perf_counter()
+                if writers[i] is None:
+                    writers[i] = open_writer(buffers[i], profile, current.size, loop, palette)
+                writers[i].add(current, duration, disposal, original)
+                encode_times[i] += time.perf_counter() - start
+            except Exception as e:
+                errors[i] = e
+        converted = original = current = None
+
+    results = []
+    for i, (_, profile, _) in enumerate(outputs):
+        if errors[i] is None:
+            try:
+                start = time.perf_counter()
+                writers[i].close()
+                encode_times[i] += time.perf_counter() - start
+            except Exception as e:
+                errors[i] = e
+        if errors[i] is not None:
+            results.append(errors[i])
+        else:
+            results.append(EncodeResult(buffers[i].getvalue(), profile.format, encode_times[i]))
+    return results
@@ -0,0 +1,658 @@
+"""批量处理引擎
+
+把图片分发到进程池中并行处理。水印设置和水印图片在每个工作进程
+启动时只传递一次，之后每个任务只传文件路径和预读的原图。
+
+读取、计算、写入按流水线进行（见 watermark_pipeline）：主进程的读取线程
+提前读入原图，工作进程解码、加水印、编码，写入线程把结果保存到磁盘。
+输出先写临时文件再改名，中途终止不会留下不完整的图片。
+
+传入多个 Preset（每个客户各自的水印、位置、透明度和输出格式）时，每张原图
+只读取、解码一次，再分别渲染、编码成各个方案的输出。方案可以限制长边尺寸
+（Derivative），同一张原图的多个尺寸从大到小逐级缩小，每个尺寸使用按这个尺寸
+缓存的水印图块，而不是把加好水印的大图缩小。
+
+动图（GIF、WebP）输出为 GIF、WebP 时逐帧加水印、编码（见 watermark_animation），
+输出为其他格式时只保留第一帧并给出提示。
+"""
+import io
+import os
+import queue
+import signal
+import traceback
+import threading
+import multiprocessing
+from dataclasses import dataclass, field, replace
+
+from PIL import Image
+
+from watermark_core import WatermarkRenderer, WatermarkSettings, convert_for_render, downscale
+from watermark_manifest import settings_hash
+from watermark_encoders import encode_image, get_profile
+from watermark_tiles import MemoryLimitError, check_memory, decoded_size, process_tiled, unlimited_pixels
+from watermark_animation import ANIMATED_FORMATS, encode_animation, is_animated
+from watermark_metrics import MemoryPeak, StageTimer
+from watermark_pipeline import (
+    READ_AHEAD_MB, RESULT_POLL_INTERVAL, AsyncWriter, ByteBudget, iter_prefetched, read_task, write_result,
+)
+
+
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff')
+# 单进程处理时读取线程最多提前准备的任务数
+PREFETCH_TASKS = 4
+
+
+@dataclass(frozen=True)
+class Preset:
+    """一次解码输出多份时的一个方案
+
+    watermark 为默认/自定义水印图片（文字水印为 None），profile 为空时使用
+    整批的编码方案；max_size 为输出的长边像素，为空时保持原图尺寸。
+    """
+    name: str
+    settings: WatermarkSettings
+    watermark: object = None
+    profile: object = None
+    max_size: int = None
+
+
+@dataclass(frozen=True)
+class Derivative:
+    """同一方案的一个输出尺寸，max_size 为长边像素（为空时为原图尺寸），profile 为这个尺寸的编码方案"""
+    max_size: int = None
+    profile: object = None
+
+    @property
+    def label(self):
+        return str(self.max_size) if self.max_size else 'full'
+
+
+def with_derivatives(presets, derivatives):
+    """把每个方案按每个尺寸展开，名称为 方案名称@尺寸（方案名称为空时只有尺寸）
+
+    尺寸没有指定编码方案时沿用方案自己的。
+    """
+    return [replace(preset, name=f"{preset.name}@{derivative.label}" if preset.name else derivative.label,
+                    max_size=derivative.max_size, profile=derivative.profile or preset.profile)
+            for preset in presets for derivative in derivatives]
+
+
+def derivative_size(image_size, max_size=None):
+    """长边不超过 max_size 的输出尺寸，保持比例，不放大"""
+    width, height = image_size
+    if not max_size or max(width, height) <= max_size:
+        return (width, height)
+    scale = max_size / max(width, height)
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+
+@dataclass
+class FileResult:
+    """单个文件的处理结果"""
+    image_path: str
+    output_path: str = None
+    error: str = None
+    # 处理记录显示没有变化而跳过
+    skipped: bool = False
+    # 编码耗时（秒）和写入的字节数
+    encode_time: float = 0.0
+    bytes_written: int = 0
+    # 异常的类型名称
+    error_type: str = None
+    # 原图的字节数和尺寸
+    bytes_read: int = 0
+    width: int = 0
+    height: int = 0
+    # 各阶段耗时（秒），见 watermark_metrics.STAGES
+    timings: dict = field(default_factory=dict)
+    # 处理期间进程内存峰值比开始时多出的字节数，只在 Linux 上、要求测量时统计
+    peak_memory: int = None
+    # 处理完成时进程的内存峰值（VmHWM，字节），只在 Linux 上统计
+    process_peak_memory: int = None
+    # 处理期间水印图块缓存（OverlayCache）的命中、未命中次数，一起处理的
+    # 一组图片或多个方案只记在第一个结果上
+    overlay_hits: int = 0
+    overlay_misses: int = 0
+    # 输出多个方案时，这个结果所属的方案名称
+    preset: str = None
+    # 还没有保存的编码结果（write=False 时），保存后清空
+    encoded: object = field(default=None, repr=False)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def default_workers():
+    """默认进程数：CPU核心数"""
+    return os.cpu_count() or 1
+
+
+def default_chunksize(total_files, workers):
+    """每个进程一次领取的文件数，文件多时减少进程间通信"""
+    return max(1, min(16, total_files // (workers * 4)))
+
+
+def output_path_for(image_path, output_dir, profile=None):
+    """生成输出文件路径，扩展名由编码方案决定"""
+    name, _ = os.path.splitext(os.path.basename(image_path))
+    suffix = get_profile(profile).extension_for(image_path)
+    return os.path.join(output_dir, f"{name}_watermarked{suffix}")
+
+
+def open_task_image(task, unlimited=False):
+    """打开任务的原图（优先使用预读的字节），返回 (图片, 原图字节数)"""
+    if task.data is not None:
+        fp, size = io.BytesIO(task.data), len(task.data)
+    else:
+        fp, size = task.image_path, os.path.getsize(task.image_path)
+    if unlimited:
+        with unlimited_pixels():
+            return Image.open(fp), size
+    return Image.open(fp), size
+
+
+def process_file(renderer, task, profile=None, memory_limit=None, write=True, measure_memory=False):
+    """处理一个 BatchTask，异常不会抛出而是记录在结果里
+
+    memory_limit（字节）不为空时，解码后超过上限的图片改为分块处理，
+    无法分块的图片记为失败，不会占用超过上限的内存。
+    write 为 False 时只编码，编码结果放在 FileResult.encoded 中，由
+    watermark_pipeline.write_result 保存；分块处理的图片总是直接写入。
+    进程的内存峰值记录在 FileResult.process_peak_memory 中；measure_memory 为
+    True 时还测量这张图片多用的内存，记录在 FileResult.peak_memory 中（较慢）。
+    """
+    before = cache_counts([renderer])
+    with MemoryPeak(measure_memory) as memory:
+        result = render_file(renderer, task, profile, memory_limit, write)
+    result.peak_memory = memory.peak
+    result.process_peak_memory = memory.high
+    record_cache_counts([result], [renderer], before)
+    return result
+
+
+def cache_counts(renderers):
+    """渲染器使用的图块缓存的 (命中次数, 未命中次数)，同一个缓存只算一次"""
+    hits = misses = 0
+    for cache in {id(renderer.cache): renderer.cache for renderer in renderers}.values():
+        stats = cache.stats()
+        hits += stats['hits']
+        misses += stats['misses']
+    return hits, misses
+
+
+def record_cache_counts(results, renderers, before):
+    """把从 before（cache_counts 的结果）开始的命中、未命中次数记在第一个结果上"""
+    if results:
+        hits, misses = cache_counts(renderers)
+        results[0].overlay_hits = hits - before[0]
+        results[0].overlay_misses = misses - before[1]
+
+
+def render_file(renderer, task, profile=None, memory_limit=None, write=True):
+    """process_file 的实际处理过程
+
+    解码后的图片直接在原处合成，整个过程只保留一份完整的像素缓冲。
+    """
+    image_path, save_path = task.image_path, task.save_path
+    timer = StageTimer()
+    timer.add('read', task.read_time)
+    source = {}
+    try:
+        with timer.stage('decode'):
+            image, source['bytes_read'] = open_task_image(task, unlimited=bool(memory_limit))
+        source['width'], source['height'] = image.size
+        resolved = get_profile(profile).resolve(image_path)
+        if memory_limit:
+            if check_memory(image, memory_limit, resolved.format):
+                image.close()
+                os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+                level = resolved.options.get('compress_level')
+                written, encode_time = process_tiled(renderer, image_path, save_path, memory_limit, level,
+                                                     timer)
+                return FileResult(image_path, save_path, encode_time=encode_time, bytes_written=written,
+                                  timings=timer.timings, **source)
+        if is_animated(image):
+            if resolved.format in ANIMATED_FORMATS:
+                return render_animation(renderer, image, task, resolved, timer, write, **source)
+            warn_first_frame(image_path, resolved.format)
+        with timer.stage('decode'):
+            image.load()
+        with timer.stage('convert'):
+            image = convert_for_render(image, resolved.format)
+        image = renderer.render(image, timer=timer, copy=False)
+        return save_result(image, image_path, save_path, profile, timer, write, **source)
+    except Exception as e:
+        return failed_result(image_path, e, timer, **source)
+
+
+def failed_result(image_path, error, timer=None, **source):
+    """输出错误信息，返回失败的 FileResult"""
+    print(f"处理图片失败 {image_path}: {str(error)}")
+    traceback.print_exc()
+    return FileResult(image_path, error=str(error), error_type=type(error).__name__,
+                      timings=timer.timings if timer else {}, **source)
+
+
+def save_result(result, image_path, save_path, profile=None, timer=None, write=True, **source):
+    """编码加好水印的图片，write 为 True 时立即保存
+
+    source 为原图的 bytes_read/width/height，原样记录在 FileResult 中。
+    """
+    encoded = encode_image(result, profile, image_path)
+    return save_encoded(encoded, image_path, save_path, timer, write, **source)
+
+
+def save_encoded(encoded, image_path, save_path, timer=None, write=True, **source):
+    """记录编码好的 EncodeResult，write 为 True 时立即保存"""
+    timer = timer or StageTimer()
+    timer.add('encode', encoded.encode_time)
+    file_result = FileResult(image_path, save_path, encode_time=encoded.encode_time,
+                             timings=timer.timings, encoded=encoded, **source)
+    if write:
+        write_result(file_result)
+    return file_result
+
+
+def render_animation(renderer, image, task, resolved, timer, write=True, **source):
+    """逐帧给动图加水印并编码成 resolved 的格式（GIF 或 WebP），出错时抛出异常"""
+    encoded, = encode_animation(image, [(renderer, resolved, None)], [timer])
+    if isinstance(encoded, Exception):
+        raise encoded
+    return save_encoded(encoded, task.image_path, task.save_path, timer, write, **source)
+
+
+def warn_first_frame(image_path, image_format):
+    """动图输出为不能保存动画的格式时提示只保留第一帧"""
+    print(f"{image_path} 是动图，输出 {image_format} 只保留第一帧（输出 GIF、WebP 或保持原图格式可以保留动画）")
+
+
+def build_variants(presets, profile=None):
+    """每个方案的 (名称, 渲染器, 编码方案, 长边上限)，供 process_variants 使用"""
+    variants = []
+    for preset in presets:
+        renderer = WatermarkRenderer(preset.settings, preset.watermark)
+        variants.append((preset.name, renderer.warm_up(), get_profile(preset.profile or profile),
+                         preset.max_size))
+    return variants
+
+
+def process_variants(variants, task, memory_limit=None, write=True, measure_memory=False):
+    """原图只解码一次，按 task.variants 分别输出各个方案，返回 FileResult 列表
+
+    除最后一个方案外都在副本上合成，解码的图片之外同时最多再占用一份像素缓冲。
+    限制了尺寸的方案按尺寸从大到小处理：每一级从上一级未加水印的图片缩小，
+    先缩小出下一级再在这一级上原地合成，水印按原图尺寸等比缩放后放置。
+    只输出缩小的尺寸时，JPEG 直接以接近最大输出尺寸的 1/2、1/4、1/8 解码。
+    结果按处理顺序排列，读取、解码的耗时和原图字节数只记在第一个结果上；
+    内存峰值为处理整个文件期间的峰值，每个结果都记录；measure_memory 同 process_file。
+    """
+    renderers = [variant[1] for variant in variants]
+    before = cache_counts(renderers)
+    with MemoryPeak(measure_memory) as memory:
+        results = render_variants(variants, task, memory_limit, write)
+    for result in results:
+        result.peak_memory = memory.peak
+        result.process_peak_memory = memory.high
+    record_cache_counts(results, renderers, before)
+    return results
+
+
+def render_variants(variants, task, memory_limit=None, write=True):
+    """process_variants 的实际处理过程"""
+    image_path = task.image_path
+    timer = StageTimer()
+    timer.add('read', task.read_time)
+    source = {}
+    try:
+        with timer.stage('decode'):
+            image, source['bytes_read'] = open_task_image(task, unlimited=bool(memory_limit))
+        full_size = image.size
+        source['width'], source['height'] = full_size
+        # 按输出尺寸从大到小处理，尺寸相同时保持原来的顺序
+        targets = [derivative_size(full_size, variants[index][3]) for index, _ in task.variants]
+        order = sorted(range(len(targets)), key=lambda i: targets[i], reverse=True)
+        largest = targets[order[0]]
+        if largest != full_size:
+            with timer.stage('decode'):
+                image.draft(image.mode, largest)
+        if memory_limit and decoded_size(image) > memory_limit:
+            # 整张图片放不进内存，每个方案分别按条带读取
+            image.close()
+            return [tiled_variant(variants[task.variants[i][0]], task, task.variants[i][1], memory_limit,
+                                  timer if position == 0 else None, **variant_source(source, position))
+                    for position, i in enumerate(order)]
+        results = []
+        if is_animated(image):
+            # 能保存动画的方案一起逐帧处理，其他方案只输出第一帧
+            animated = [i for i in order
+                        if variants[task.variants[i][0]][2].resolve(image_path).format in ANIMATED_FORMATS]
+            if animated:
+                results = animated_variants(variants, task, image, animated, targets, timer, write, **source)
+                order = [i for i in order if i not in animated]
+                if not order:
+                    return results
+                image.seek(0)
+                timer = StageTimer()
+            warn_first_frame(image_path, variants[task.variants[order[0]][0]][2].resolve(image_path).format)
+        with timer.stage('decode'):
+            image.load()
+        if any(targets[i] != full_size for i in order):
+            # P、I;16 等模式缩小前先转换，CMYK 留到确定输出格式时再处理
+            with timer.stage('convert'):
+                image = convert_for_render(image)
+    except Exception as e:
+        failed = failed_result(image_path, e, timer, **source)
+        return [replace(failed, preset=variants[index][0], output_path=None,
+                        timings=failed.timings if i == 0 else {}, **variant_source(source, i))
+                for i, (index, _) in enumerate(task.variants)]
+
+    timers = [timer if i == order[0] else StageTimer() for i in range(len(targets))]
+    # 当前尺寸还没有加水印的图片
+    level, image = image, None
+    # 动图的结果已经在前面，原图字节数只记在第一个结果上
+    first = len(results)
+    for position, i in enumerate(order):
+        index, save_path = task.variants[i]
+        name, renderer, profile, _ = variants[index]
+        timer = timers[i]
+        following = order[position + 1] if position + 1 < len(order) else None
+        converted = rendered = smaller = None
+        try:
+            if level.size != targets[i]:
+                with timer.stage('resize'):
+                    level = downscale(level, targets[i])
+            if following is not None and targets[following] != targets[i]:
+                # 先缩小出下一级，这一级就可以直接在原处合成
+                with timers[following].stage('resize'):
+                    smaller = downscale(level, targets[following])
+            with timer.stage('convert'):
+                converted = convert_for_render(level, profile.resolve(image_path).format)
+            # 同一尺寸的最后一个方案直接在原处合成；转换过模式的已经是新图片，也不用复制
+            copy = converted is level and following is not None and smaller is None
+            rendered = renderer.render(converted, reference_size=full_size, timer=timer, copy=copy)
+            result = save_result(rendered, image_path, save_path, profile, timer, write,
+                                 **variant_source(source, first + position))
+        except Exception as e:
+            result = failed_result(image_path, e, timer, **variant_source(source, first + position))
+        if smaller is not None:
+            level = smaller
+        # 下一个方案复制之前先释放这一份
+        converted = rendered = smaller = None
+        result.preset = name
+        results.append(result)
+    return results
+
+
+def animated_variants(variants, task, image, indices, targets, timer, write=True, **source):
+    """动图只逐帧解码一次，输出 indices 中的各个方案（都是 GIF 或 WebP），返回 FileResult 列表"""
+    timers = [timer if n == 0 else StageTimer() for n in range(len(indices))]
+    outputs = []
+    for i in indices:
+        _, renderer, profile, _ = variants[task.variants[i][0]]
+        outputs.append((renderer, profile.resolve(task.image_path), targets[i]))
+    results = []
+    for n, (i, encoded) in enumerate(zip(indices, encode_animation(image, outputs, timers))):
+        index, save_path = task.variants[i]
+        try:
+            if isinstance(encoded, Exception):
+                raise encoded
+            result = save_encoded(encoded, task.image_path, save_path, timers[n], write,
+                                  **variant_source(source, n))
+        except Exception as e:
+            result = failed_result(task.image_path, e, timers[n], **variant_source(source, n))
+        result.preset = variants[index][0]
+        results.append(result)
+    return results
+
+
+def variant_source(source, i):
+    """第 i 个方案结果中的原图信息：原图只读取一次，字节数记在第一个方案上"""
+    return dict(source, bytes_read=source.get('bytes_read', 0) if i == 0 else 0)
+
+
+def tiled_variant(variant, task, save_path, memory_limit, timer=None, **source):
+    """分块处理一个方案的输出，分块处理不能缩小尺寸"""
+    name, renderer, profile, max_size = variant
+    timer = timer or StageTimer()
+    try:
+        if max_size:
+            raise MemoryLimitError("图片超过内存上限，分块处理时不能输出缩小的尺寸")
+        resolved = profile.resolve(task.image_path)
+        image, _ = open_task_image(task, unlimited=True)
+        with image:
+            # 不能分块时抛出 MemoryLimitError
+            check_memory(image, memory_limit, resolved.format)
+        os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
+        written, encode_time = process_tiled(renderer, task.image_path, save_path, memory_limit,
+                                             resolved.options.get('compress_level'), timer)
+        return FileResult(task.image_path, save_path, encode_time=encode_time, bytes_written=written,
+                          timings=timer.timings, preset=name, **source)
+    except Exception as e:
+        return replace(failed_result(task.image_path, e, timer, **source), preset=name)
+
+
+# 工作进程内的渲染器、编码方案和内存上限，由 _init_worker 创建
+_worker_renderer = None
+_worker_profile = None
+_worker_memory_limit = None
+_worker_measure_memory = False
+# 输出多个方案时每个方案的 (名称, 渲染器, 编码方案)
+_worker_variants = None
+
+
+def _init_worker(settings, watermark, profile, memory_limit=None, presets=None, measure_memory=False):
+    global _worker_renderer, _worker_profile, _worker_memory_limit, _worker_variants
+    global _worker_measure_memory
+    # Ctrl+C 由主进程处理，工作进程不能在任务中途退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if presets:
+        _worker_variants = build_variants(presets, profile)
+    else:
+        _worker_renderer = WatermarkRenderer(settings, watermark)
+        _worker_renderer.warm_up()
+    _worker_profile = profile
+    _worker_memory_limit = memory_limit
+    _worker_measure_memory = measure_memory
+
+
+def process_task(renderer, variants, task, profile=None, memory_limit=None, write=True,
+                 measure_memory=False):
+    """处理一个任务，返回 FileResult 列表：有 variants 时每个方案一个结果"""
+    if variants:
+        return process_variants(variants, task, memory_limit, write, measure_memory)
+    return [process_file(renderer, task, profile, memory_limit, write, measure_memory)]
+
+
+def _process_in_worker(chunk):
+    """处理一批任务，返回 (结果列表, 任务数, 预读的字节数)，编码好的数据交给主进程写入"""
+    results = []
+    for task in chunk:
+        results.extend(process_task(_worker_renderer, _worker_variants, task, _worker_profile,
+                                    _worker_memory_limit, write=False,
+                                    measure_memory=_worker_measure_memory))
+    return results, len(chunk), sum(task.prefetched_size for task in chunk)
+
+
+def group_tasks(tasks, size):
+    """把任务按 size 个一组打包"""
+    group = []
+    for task in tasks:
+        group.append(task)
+        if len(group) >= size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def iter_batch(image_paths, output_dir, settings, watermark=None, workers=None, chunksize=None,
+               output_path=None, manifest=None, profile=None, memory_limit_mb=None, presets=None,
+               measure_memory=False):
+    """批量处理图片，每处理完一个文件产出一个 FileResult（顺序不保证）
+
+    image_paths 可以是生成器，会边读取边处理，同时最多只有有限个文件在排队。
+    output_path(image_path) 用来自定义输出路径，不传时保存到 output_dir。
+    profile 为编码方案名称或 EncoderProfile，默认 JPEG 质量95。
+    传入 manifest（watermark_manifest.Manifest）时跳过原图和设置都没有变化的文件。
+    memory_limit_mb 为每个进程处理单张图片的内存上限，超过的图片分块处理。
+    measure_memory 为 True 时测量每张图片的内存峰值（FileResult.peak_memory），
+    每张图片都要整理一次堆，吞吐会下降，只在需要统计时使用。
+    image_paths 是持续产出文件的生成器（监视文件夹）时，应该传 chunksize=1，
+    每个文件到达后立即处理。
+    workers 为 1 时在当前进程中处理；提前关闭生成器会终止进程池。
+    产出的结果都已经写入磁盘，读取线程预读的原图最多占用 READ_AHEAD_MB。
+
+    presets 为 Preset 列表时忽略 settings 和 watermark：每张原图只解码一次，
+    输出每个方案，每个方案各产出一个 FileResult（FileResult.preset 为方案名称）。
+    这时 output_path 以 (image_path, 方案名称) 调用，默认保存到 output_dir
+    下以方案名称命名的子文件夹；处理记录按原图和方案分别记录。
+    Preset.max_size 限制输出尺寸，with_derivatives 把方案展开成多个尺寸，
+    同一张原图的所有尺寸也只解码一次。
+    """
+    profile = get_profile(profile)
+    memory_limit = int(memory_limit_mb * 1024 * 1024) if memory_limit_mb else None
+    if presets:
+        presets = list(presets)
+        names = [preset.name for preset in presets]
+        if len(set(names)) != len(names):
+            raise ValueError("方案名称不能重复")
+    if output_path is None:
+        if presets:
+            def output_path(image_path, name):
+                preset_profile = get_profile(presets[names.index(name)].profile or profile)
+                return output_path_for(image_path, os.path.join(output_dir, name), preset_profile)
+        else:
+            def output_path(image_path):
+                return output_path_for(image_path, output_dir, profile)
+
+    # 处理记录中的设置哈希，按方案名称（没有方案时为 None）
+    digests = {}
+    if manifest is not None:
+        for preset in presets or [Preset(None, settings, watermark, profile)]:
+            preset_profile = get_profile(preset.profile or profile)
+            digests[preset.name] = settings_hash(
+                preset.settings, preset.watermark,
+                profile=(preset_profile.name, preset_profile.format, preset_profile.options))
+
+    # 跳过的文件在读取线程中产生，由这里转交给调用方
+    skipped = queue.SimpleQueue()
+    budget = ByteBudget(READ_AHEAD_MB * 1024 * 1024)
+
+    def plan():
+        """预读需要处理的文件，产出 BatchTask"""
+        for image_path in image_paths:
+            if presets:
+                # 只输出有变化的方案
+                variants = []
+                for index, preset in enumerate(presets):
+                    save_path = output_path(image_path, preset.name)
+                    if manifest is not None and not manifest.needs_processing(
+                            image_path, digests[preset.name], save_path, preset.name):
+                        skipped.put(FileResult(image_path, save_path, skipped=True, preset=preset.name))
+                        continue
+                    variants.append((index, save_path))
+                if variants:
+                    yield read_task(image_path, variants[0][1], budget, memory_limit, tuple(variants))
+                continue
+            save_path = output_path(image_path)
+            if manifest is not None and not manifest.needs_processing(image_path, digests[None], save_path):
+                skipped.put(FileResult(image_path, save_path, skipped=True))
+                continue
+            # 需要分块处理的大文件由工作进程按条带读取，不预读
+            yield read_task(image_path, save_path, budget, memory_limit)
+
+    def record(result):
+        # 写入完成时立即更新处理记录，调用方中途停止也不会丢失
+        if manifest is not None:
+            manifest.record(result, digests[result.preset])
+
+    writer = AsyncWriter(on_done=record)
+
+    def completed():
+        """取出已经跳过或写入完成的结果"""
+        while True:
+            try:
+                yield skipped.get_nowait()
+            except queue.Empty:
+                break
+        yield from writer.completed()
+
+    workers = workers or default_workers()
+    if hasattr(image_paths, '__len__'):
+        workers = min(workers, len(image_paths)) or 1
+    if workers == 1:
+        renderer = variants = None
+        if presets:
+            variants = build_variants(presets, profile)
+        else:
+            renderer = WatermarkRenderer(settings, watermark)
+            renderer.warm_up()
+        # 读取线程提前准备后面的文件，这里只负责计算
+        tasks = iter_prefetched(plan(), PREFETCH_TASKS, idle_timeout=RESULT_POLL_INTERVAL)
+        try:
+            for task in tasks:
+                if task is None:
+                    # 暂时没有新文件，先交出已经写好的结果
+                    yield from completed()
+                    continue
+                results = process_task(renderer, variants, task, profile, memory_limit, write=False,
+                                       measure_memory=measure_memory)
+                budget.release(task.prefetched_size)
+                for result in results:
+                    writer.submit(result)
+                yield from completed()
+            writer.close()
+            yield from completed()
+        finally:
+            budget.close()
+            tasks.close()
+            writer.close()
+        return
+
+    if chunksize is None:
+        total = len(image_paths) if hasattr(image_paths, '__len__') else workers * 16
+        chunksize = default_chunksize(total, workers)
+
+    # 限制排队中的任务数量，文件列表很长时不会一次性全部读入
+    max_pending = workers * chunksize * 4
+    pending = threading.Semaphore(max_pending)
+    stopped = False
+
+    def tasks():
+        # 由进程池的任务线程迭代，预读和计算同时进行
+        for task in plan():
+            pending.acquire()
+            if stopped:
+                return
+            yield task
+
+    # 使用 spawn，避免在带有GUI线程的进程里 fork
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=_init_worker,
+                      initargs=(settings, watermark, profile, memory_limit, presets, measure_memory)) as pool:
+        try:
+            # 自己按 chunksize 打包：进程池打包时返回的迭代器不支持等待超时
+            batches = pool.imap_unordered(_process_in_worker, group_tasks(tasks(), chunksize))
+            while True:
+                try:
+                    results, task_count, prefetched = batches.next(RESULT_POLL_INTERVAL)
+                except multiprocessing.TimeoutError:
+                    # 暂时没有新结果，先交出已经写好的结果
+                    yield from completed()
+                    continue
+                except StopIteration:
+                    break
+                pending.release(task_count)
+                budget.release(prefetched)
+                for result in results:
+                    writer.submit(result)
+                yield from completed()
+            writer.close()
+            yield from completed()
+        finally:
+            # 唤醒可能在等待的任务线程，让它退出
+            stopped = True
+            pending.release(max_pending)
+            budget.close()
+            writer.close()
@@ -0,0 +1,487 @@
+"""水印渲染和批量处理的性能测试
+
+生成固定内容的测试图片（多种尺寸、模式、格式），分别测试四条路径：
+    preview  预览：按预览尺寸解码 + 渲染 + 转成显示用的 RGB
+             （对应 open_image / update_watermark / update_preview，不含 Tk 显示）
+    save     保存：完整解码 + 渲染 + 编码 + 写入（对应 save_image）
+    batch    批量：iter_batch 多进程处理一组图片（对应 process_all_images）
+    startup  冷启动：新的 Python 进程从启动到得到第一张预览、批量处理完第一个
+             文件的时间（只使用第一组图片）
+每种路径分别使用文字、默认、自定义水印。每个测试在单独的进程中运行，
+峰值内存互不影响。结果以 JSON 输出，可以保存为基准并与之比较：
+
+    python watermark_bench.py --quick -o result.json
+    python watermark_bench.py --save-baseline bench_baseline.json
+    python watermark_bench.py --baseline bench_baseline.json
+
+与基准相比吞吐下降或内存增加超过容差时退出码为 1。
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import subprocess
+import platform
+import tempfile
+import multiprocessing
+
+import PIL
+from PIL import Image
+
+from watermark_core import (
+    WatermarkSettings, WatermarkRenderer,
+    create_fallback_watermark, load_default_watermark, load_preview_image, load_source_image,
+)
+from watermark_batch import default_workers, iter_batch
+from watermark_encoders import DEFAULT_PROFILE, PROFILES, encode_image, get_profile, write_encoded
+from watermark_metrics import percentile
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+PATHS = ('preview', 'save', 'batch', 'startup')
+WATERMARKS = ('text', 'default', 'custom')
+DEFAULT_SIZES = (2, 12, 24)
+QUICK_SIZES = (1,)
+# 各尺寸都测试的图片；其他模式和格式只在最小的尺寸上测试
+MAIN_VARIANT = ('RGB', 'JPEG')
+EXTRA_VARIANTS = (('RGBA', 'PNG'), ('L', 'PNG'), ('P', 'PNG'), ('RGB', 'WEBP'), ('RGBA', 'WEBP'))
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+PERCENTILES = (50, 90, 99)
+# 默认容差：吞吐下降 15%、峰值内存增加 25% 算作退步
+THROUGHPUT_TOLERANCE = 0.15
+MEMORY_TOLERANCE = 0.25
+# 冷启动测试在新的解释器中运行的脚本，输出各时间点（time.time()）的 JSON。
+# 预览和界面启动时一样导入 watermark_gui（没有 tkinter 时跳过），批量只导入批量处理的模块
+STARTUP_SCRIPT = """
+import sys, json, time
+started = time.time()
+run, settings, watermark_path, image_paths, output_dir, profile, workers = sys.argv[1:]
+image_paths = json.loads(image_paths)
+if run == 'preview':
+    try:
+        import watermark_gui
+    except ImportError:
+        pass
+import watermark_core as core
+if run == 'batch':
+    from watermark_batch import iter_batch
+imported = time.time()
+settings = core.WatermarkSettings(**json.loads(settings))
+if watermark_path == 'default':
+    watermark = core.load_default_watermark() or core.create_fallback_watermark()
+else:
+    watermark = core.load_watermark_image(watermark_path) if watermark_path else None
+if run == 'preview':
+    preview, full_size = core.load_preview_image(image_paths[0])
+    result = core.WatermarkRenderer(settings, watermark).render(preview, reference_size=full_size)
+    result.convert('RGB').tobytes()
+    first = time.time()
+else:
+    results = iter_batch(image_paths, output_dir, settings, watermark, int(workers), profile=profile)
+    if not next(results).ok:
+        sys.exit(1)
+    first = time.time()
+    # 处理完其余文件，进程池正常退出
+    for _ in results:
+        pass
+print(json.dumps({'started': started, 'imported': imported, 'first': first}))
+"""
+
+
+def image_dimensions(megapixels):
+    """指定像素数的 3:2 图片尺寸"""
+    height = int((megapixels * 1_000_000 / 1.5) ** 0.5)
+    return int(height * 1.5), height
+
+
+def synthetic_image(size, mode):
+    """内容固定的测试图片：渐变加分形纹理，每次生成的结果都相同"""
+    width, height = size
+    texture = Image.effect_mandelbrot((width, height), (-2.2, -1.2, 1.0, 1.2), 64)
+    horizontal = Image.linear_gradient('L').rotate(90).resize(size)
+    vertical = Image.linear_gradient('L').resize(size)
+    image = Image.merge('RGB', (texture, horizontal, vertical))
+    if mode == 'RGBA':
+        image.putalpha(Image.radial_gradient('L').resize(size).point(lambda x: 255 - x // 2))
+    elif mode == 'P':
+        image = image.quantize(64)
+    elif mode != 'RGB':
+        image = image.convert(mode)
+    return image
+
+
+def synthetic_watermark():
+    """自定义水印：半透明的圆形图案"""
+    mask = Image.radial_gradient('L').resize((240, 240)).point(lambda x: 200 if x < 128 else 0)
+    watermark = Image.new('RGBA', mask.size, (30, 144, 255, 0))
+    watermark.putalpha(mask)
+    return watermark
+
+
+def image_sets(sizes):
+    """需要生成的测试图片：(名称, 像素数, 模式, 格式)"""
+    sets = [(megapixels,) + MAIN_VARIANT for megapixels in sizes]
+    sets += [(min(sizes),) + variant for variant in EXTRA_VARIANTS]
+    return [(f"{megapixels:g}MP-{mode}-{fmt.lower()}", megapixels, mode, fmt)
+            for megapixels, mode, fmt in sets]
+
+
+def generate_images(workdir, sizes, count):
+    """生成测试图片，返回 {名称: [文件路径]}；每组 count 个文件，供批量测试使用"""
+    files = {}
+    for name, megapixels, mode, fmt in image_sets(sizes):
+        image = synthetic_image(image_dimensions(megapixels), mode)
+        directory = os.path.join(workdir, name)
+        os.makedirs(directory, exist_ok=True)
+        first = os.path.join(directory, f"0{FORMAT_EXTENSIONS[fmt]}")
+        image.save(first, fmt)
+        paths = [first]
+        for i in range(1, count):
+            path = os.path.join(directory, f"{i}{FORMAT_EXTENSIONS[fmt]}")
+            shutil.copyfile(first, path)
+            paths.append(path)
+        files[name] = paths
+    return files
+
+
+def watermark_setup(kind):
+    """返回 (设置, 水印图片)"""
+    if kind == 'text':
+        return WatermarkSettings(watermark_type='text', text="Benchmark 水印"), None
+    if kind == 'custom':
+        return WatermarkSettings(watermark_type='custom'), synthetic_watermark()
+    return WatermarkSettings(), load_default_watermark() or create_fallback_watermark()
+
+
+def percentiles(values):
+    """毫秒为单位的延迟分位数"""
+    if not values:
+        return {}
+    result = {f'p{p}': round(percentile(values, p) * 1000, 3) for p in PERCENTILES}
+    result['max'] = round(max(values) * 1000, 3)
+    return result
+
+
+def own_peak_kb():
+    """当前进程自己的峰值内存（KB）
+
+    Linux 上 ru_maxrss 会继承父进程启动子进程时的值，所以优先读取 VmHWM。
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS 单位为字节，Linux 为 KB
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def peak_rss_mb():
+    """当前进程及已结束的子进程中最大的峰值内存（MB），不支持时为 None"""
+    if resource is None:
+        return None
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        children //= 1024
+    return round(max(own_peak_kb(), children) / 1024, 1)
+
+
+def bench_preview(renderer, path, repeat):
+    stages = {'decode': [], 'render': [], 'display': []}
+    for i in range(repeat + 1):
+        start = time.perf_counter()
+        preview, full_size = load_preview_image(path)
+        decoded = time.perf_counter()
+        result = renderer.render(preview, reference_size=full_size)
+        rendered = time.perf_counter()
+        if result.mode != 'RGB':
+            result = result.convert('RGB')
+        result.tobytes()
+        displayed = time.perf_counter()
+        if i:  # 第一次为预热
+            stages['decode'].append(decoded - start)
+            stages['render'].append(rendered - decoded)
+            stages['display'].append(displayed - rendered)
+    return stages, repeat
+
+
+def bench_save(renderer, path, repeat, output_dir, profile):
+    stages = {'decode': [], 'render': [], 'encode': [], 'write': []}
+    save_path = os.path.join(output_dir, 'save' + get_profile(profile).extension_for(path))
+    for i in range(repeat + 1):
+        start = time.perf_counter()
+        image = load_source_image(path, get_profile(profile).resolve(path).format)
+        decoded = time.perf_counter()
+        image = renderer.render(image, copy=False)
+        rendered = time.perf_counter()
+        encoded = encode_image(image, profile, path)
+        encoded_at = time.perf_counter()
+        write_encoded(encoded, save_path)
+        written = time.perf_counter()
+        if i:
+            stages['decode'].append(decoded - start)
+            stages['render'].append(rendered - decoded)
+            stages['encode'].append(encoded_at - rendered)
+            stages['write'].append(written - encoded_at)
+    return stages, repeat
+
+
+def bench_batch(settings, watermark, paths, output_dir, profile, workers):
+    stages = {'encode': []}
+    failed = 0
+    for result in iter_batch(paths, output_dir, settings, watermark, workers=workers, profile=profile):
+        if result.ok:
+            stages['encode'].append(result.encode_time)
+        else:
+            failed += 1
+    if failed:
+        raise RuntimeError(f"批量处理有 {failed} 个文件失败")
+    return stages, len(paths)
+
+
+def startup_marks(run, settings, watermark_arg, paths, output_dir, profile, workers):
+    """在新的解释器中运行一次 STARTUP_SCRIPT，返回各时间点相对启动的秒数"""
+    env = dict(os.environ)
+    here = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [here, env.get('PYTHONPATH')]))
+    args = [sys.executable, '-c', STARTUP_SCRIPT, run, json.dumps(settings.__dict__), watermark_arg,
+            json.dumps(paths), output_dir, profile, str(workers)]
+    launched = time.time()
+    finished = subprocess.run(args, env=env, capture_output=True, text=True)
+    if finished.returncode:
+        raise RuntimeError(f"冷启动测试失败: {finished.stderr.strip().splitlines()[-1:]}")
+    marks = json.loads(finished.stdout.strip().splitlines()[-1])
+    return {name: value - launched for name, value in marks.items()}
+
+
+def bench_startup(kind, settings, paths, output_dir, profile, workers, repeat):
+    """冷启动：每次都用新的解释器，记录完成导入和得到第一个结果的时间"""
+    if kind == 'custom':
+        watermark_arg = os.path.join(output_dir, 'watermark.png')
+        synthetic_watermark().save(watermark_arg)
+    else:
+        watermark_arg = 'default' if kind == 'default' else ''
+    stages = {'preview_import': [], 'first_preview': [], 'batch_import': [], 'first_file': []}
+    for _ in range(repeat):
+        marks = startup_marks('preview', settings, watermark_arg, paths[:1], output_dir, profile, workers)
+        stages['preview_import'].append(marks['imported'])
+        stages['first_preview'].append(marks['first'])
+        marks = startup_marks('batch', settings, watermark_arg, paths, output_dir, profile, workers)
+        stages['batch_import'].append(marks['imported'])
+        stages['first_file'].append(marks['first'])
+    return stages, repeat
+
+
+def run_case(case):
+    """在单独的进程中运行一个测试，返回结果字典"""
+    path_name, kind, set_name, paths, options = case
+    settings, watermark = watermark_setup(kind)
+    renderer = WatermarkRenderer(settings, watermark)
+    output_dir = tempfile.mkdtemp(prefix='bench_out_', dir=options['workdir'])
+    try:
+        start = time.perf_counter()
+        if path_name == 'preview':
+            stages, images = bench_preview(renderer, paths[0], options['repeat'])
+        elif path_name == 'save':
+            stages, images = bench_save(renderer, paths[0], options['repeat'], output_dir, options['profile'])
+        elif path_name == 'startup':
+            stages, images = bench_startup(kind, settings, paths, output_dir, options['profile'],
+                                           options['workers'], options['repeat'])
+        else:
+            stages, images = bench_batch(settings, watermark, paths, output_dir, options['profile'],
+                                         options['workers'])
+        wall = time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    if path_name == 'batch':
+        # 批量处理是并行的，按总耗时计算吞吐，没有单张的延迟
+        totals = []
+        throughput = images / wall
+    elif path_name == 'startup':
+        # 各阶段都是从启动开始计算的时间点，延迟为启动到第一张预览，没有吞吐
+        totals = stages['first_preview']
+        throughput = None
+    else:
+        # 按中位数延迟计算吞吐，不受偶尔的慢速迭代影响
+        totals = [sum(values) for values in zip(*stages.values())]
+        throughput = 1 / sorted(totals)[len(totals) // 2]
+    return {
+        'name': f"{path_name}/{kind}/{set_name}",
+        'path': path_name,
+        'watermark': kind,
+        'images': set_name,
+        'count': images,
+        'images_per_sec': round(throughput, 3) if throughput is not None else None,
+        'latency_ms': percentiles(totals),
+        'stages_ms': {stage: percentiles(values) for stage, values in stages.items()},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _case_process(case, conn):
+    try:
+        conn.send(run_case(case))
+    except Exception as e:
+        conn.send({'name': '/'.join(case[:3]), 'error': str(e)})
+    finally:
+        conn.close()
+
+
+def run_isolated(context, case):
+    """在新的进程中运行测试（不能用进程池：批量测试自己还要创建进程池）"""
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_case_process, args=(case, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'name': '/'.join(case[:3]), 'error': f"测试进程异常退出（{process.exitcode}）"}
+    process.join()
+    return result
+
+
+def run_benchmarks(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='watermark_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        sizes = args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+        print(f"生成测试图片: {', '.join(f'{s:g}MP' for s in sizes)}", file=sys.stderr)
+        files = generate_images(workdir, sizes, args.batch_count)
+        options = {'repeat': args.repeat, 'profile': args.profile, 'workers': args.workers,
+                   'workdir': workdir}
+        # 冷启动只使用第一组图片
+        startup_set = next(iter(files))
+        cases = [(path_name, kind, set_name, paths, options)
+                 for path_name in args.paths
+                 for kind in args.watermarks
+                 for set_name, paths in files.items()
+                 if path_name != 'startup' or set_name == startup_set]
+
+        results = []
+        # 每个测试使用新的进程，峰值内存和缓存都不受前面的测试影响
+        context = multiprocessing.get_context('spawn')
+        for case in cases:
+            result = run_isolated(context, case)
+            results.append(result)
+            if 'error' in result:
+                print(f"{result['name']:<40} 失败: {result['error']}", file=sys.stderr)
+                continue
+            latency = result['latency_ms'].get('p50')
+            latency = f"p50 {latency:>8.1f} ms" if latency is not None else " " * 15
+            if result['images_per_sec'] is None:
+                first_file = result['stages_ms']['first_file']['p50']
+                print(f"{result['name']:<40} 第一张预览 {latency}  第一个批量文件 p50 {first_file:>8.1f} ms",
+                      file=sys.stderr)
+                continue
+            print(f"{result['name']:<40} {result['images_per_sec']:>9.2f} 张/秒  {latency}  "
+                  f"峰值内存 {result['peak_rss_mb']} MB", file=sys.stderr)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'workers': args.workers,
+            'profile': args.profile,
+            'repeat': args.repeat,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+
+
+def compare(report, baseline, throughput_tolerance=THROUGHPUT_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """与基准比较，返回退步说明的列表"""
+    previous = {result['name']: result for result in baseline.get('results', [])}
+    regressions = []
+    for result in report['results']:
+        old = previous.get(result['name'])
+        if old is None or 'error' in result:
+            continue
+        if old.get('images_per_sec') and result['images_per_sec'] is not None:
+            limit = old['images_per_sec'] * (1 - throughput_tolerance)
+            if result['images_per_sec'] < limit:
+                regressions.append(f"{result['name']}: 吞吐 {result['images_per_sec']:.2f} 张/秒，"
+                                   f"基准 {old['images_per_sec']:.2f}")
+        if result['path'] == 'startup':
+            # 冷启动没有吞吐，比较各时间点的 p50
+            for stage, row in result['stages_ms'].items():
+                before = old.get('stages_ms', {}).get(stage, {}).get('p50')
+                if before and row['p50'] > before * (1 + throughput_tolerance):
+                    regressions.append(f"{result['name']}: {stage} {row['p50']:.1f} ms，基准 {before:.1f} ms")
+        if old.get('peak_rss_mb') and result['peak_rss_mb'] is not None:
+            limit = old['peak_rss_mb'] * (1 + memory_tolerance)
+            if result['peak_rss_mb'] > limit:
+                regressions.append(f"{result['name']}: 峰值内存 {result['peak_rss_mb']} MB，"
+                                   f"基准 {old['peak_rss_mb']} MB")
+    return regressions
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="水印工具性能测试")
+    parser.add_argument('--quick', action='store_true', help="只使用 1MP 的小图，快速检查")
+    parser.add_argument('--sizes', type=float, nargs='+', help="测试图片的像素数（百万像素）")
+    parser.add_argument('--paths', nargs='+', choices=PATHS, default=list(PATHS))
+    parser.add_argument('--watermarks', nargs='+', choices=WATERMARKS, default=list(WATERMARKS))
+    parser.add_argument('--repeat', type=int, default=5, help="预览和保存每组重复的次数（默认: %(default)s）")
+    parser.add_argument('--batch-count', type=int, default=16, help="批量测试每组的文件数（默认: %(default)s）")
+    parser.add_argument('-j', '--workers', type=int, default=default_workers(), help="批量测试的进程数")
+    parser.add_argument('-f', '--profile', choices=list(PROFILES), default=DEFAULT_PROFILE,
+                        help="输出格式（默认: %(default)s）")
+    parser.add_argument('--workdir', help="测试图片目录（默认使用临时目录并在结束后删除）")
+    parser.add_argument('-o', '--output', help="结果 JSON 文件（默认输出到标准输出）")
+    parser.add_argument('--baseline', help="与这个基准 JSON 比较，退步时退出码为 1")
+    parser.add_argument('--save-baseline', help="把结果保存为基准")
+    parser.add_argument('--tolerance', type=float, default=THROUGHPUT_TOLERANCE, help="吞吐下降的容差")
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE, help="峰值内存增加的容差")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    report = run_benchmarks(args)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    failed = [result['name'] for result in report['results'] if 'error' in result]
+    if failed:
+        print(f"{len(failed)} 个测试失败", file=sys.stderr)
+        return 1
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance, args.memory_tolerance)
+        for line in regressions:
+            print(f"退步 {line}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("与基准相比没有退步", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,451 @@
+"""命令行批量加水印（不需要图形界面）
+
+示例：
+    python watermark_cli.py photos/ -r --type text --text "版权所有"
+    python watermark_cli.py "shoots/**/*.jpg" --settings settings.json \\
+        --output "out/{rel}/{name}_watermarked.jpg"
+    python watermark_cli.py incoming/ -r --watch --output "published/{rel}/{name}{suffix}"
+    python watermark_cli.py shoot/ --presets clients.json --output "delivery/{preset}/{name}{suffix}"
+    python watermark_cli.py shoot/ --type text --text "版权所有" --sizes full,2048,1024:webp,400:jpeg-web \
+        --output "site/{size}/{name}{suffix}"
+
+全部成功时退出码为 0，有文件处理失败时为 1，参数错误时为 2，被中断时为 130。
+"""
+import os
+import sys
+import glob
+import json
+import signal
+import fnmatch
+import argparse
+import threading
+from dataclasses import replace
+
+from watermark_core import (
+    POSITIONS, WatermarkSettings, load_settings_file, parse_settings, validate_settings,
+    create_fallback_watermark, load_default_watermark, load_watermark_image,
+)
+from watermark_batch import (
+    SUPPORTED_EXTENSIONS, Derivative, Preset, default_workers, iter_batch, with_derivatives,
+)
+from watermark_manifest import MANIFEST_FILENAME, Manifest
+from watermark_encoders import DEFAULT_PROFILE, PROFILES, get_profile
+from watermark_metrics import BatchMetrics, JsonLinesWriter, result_record
+from watermark_watch import SETTLE_SECONDS, FolderWatcher
+
+
+DEFAULT_OUTPUT_TEMPLATE = os.path.join("{dir}", "watermark", "{name}_watermarked{suffix}")
+# 使用 --presets 时每个方案输出到自己的子文件夹
+DEFAULT_PRESET_TEMPLATE = os.path.join("{dir}", "watermark", "{preset}", "{name}_watermarked{suffix}")
+# 使用 --sizes 时每个尺寸输出到自己的子文件夹（同时使用 --presets 时在方案的子文件夹下）
+DEFAULT_SIZE_TEMPLATE = os.path.join("{dir}", "watermark", "{size}", "{name}_watermarked{suffix}")
+DEFAULT_PRESET_SIZE_TEMPLATE = os.path.join("{dir}", "watermark", "{preset}", "{size}", "{name}_watermarked{suffix}")
+# 命令行中的水印参数，使用 --presets 时不能再指定
+SETTING_ARGS = ('watermark_type', 'text', 'text_color', 'position', 'opacity', 'size_scale',
+                'tile_spacing', 'tile_angle', 'tile_stagger')
+GLOB_CHARS = ('*', '?', '[')
+
+
+def is_image_file(name, pattern=None):
+    """按扩展名（和可选的文件名模式）判断是否需要处理"""
+    if not name.lower().endswith(SUPPORTED_EXTENSIONS):
+        return False
+    return pattern is None or fnmatch.fnmatch(name, pattern)
+
+
+def scan_directory(root, recursive=False, pattern=None, skip_dir=None):
+    """用 os.scandir 逐个产出目录中的图片，不需要先列出整个目录树
+
+    skip_dir(path) 返回 True 的子目录（例如输出目录）会被跳过。
+    """
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            print(f"无法读取目录 {directory}: {str(e)}", file=sys.stderr)
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and not (skip_dir and skip_dir(entry.path)):
+                            subdirs.append(entry.path)
+                    elif entry.is_file() and is_image_file(entry.name, pattern):
+                        yield entry.path
+                except OSError:
+                    continue
+        # 按名称顺序处理子目录
+        stack.extend(sorted(subdirs, reverse=True))
+
+
+def iter_inputs(inputs, recursive=False, pattern=None, skip_dir=None):
+    """展开命令行中的输入，产出 (图片路径, 输入根目录)"""
+    for item in inputs:
+        if os.path.isdir(item):
+            for path in scan_directory(item, recursive, pattern, skip_dir):
+                yield path, item
+        elif any(c in item for c in GLOB_CHARS):
+            root = glob_root(item)
+            skipped = {}
+            for path in glob.iglob(item, recursive=True):
+                if not (os.path.isfile(path) and is_image_file(os.path.basename(path), pattern)):
+                    continue
+                directory = os.path.dirname(path)
+                if skip_dir and directory not in skipped:
+                    skipped[directory] = in_skipped_dir(directory, root, skip_dir)
+                if not skipped.get(directory):
+                    yield path, root
+        elif os.path.isfile(item):
+            yield item, os.path.dirname(item)
+        else:
+            print(f"找不到输入: {item}", file=sys.stderr)
+
+
+def in_skipped_dir(directory, root, skip_dir):
+    """directory 或它在 root 之下的某一级上级目录是否被 skip_dir 跳过
+
+    通配符（例如 **）匹配到的文件同样不处理输出目录中的图片，和扫描文件夹时一致。
+    """
+    directory, root = os.path.abspath(directory), os.path.abspath(root)
+    while directory != root and os.path.dirname(directory) != directory:
+        if not directory.startswith(os.path.join(root, '')):
+            return False
+        if skip_dir(directory):
+            return True
+        directory = os.path.dirname(directory)
+    return False
+
+
+def glob_root(pattern):
+    """通配符之前的目录部分，用于计算相对路径"""
+    parts = []
+    for part in pattern.replace('\\', '/').split('/'):
+        if any(c in part for c in GLOB_CHARS):
+            break
+        parts.append(part)
+    return '/'.join(parts) or '.'
+
+
+def format_output_path(template, image_path, root, suffix='.jpg', preset='', size=''):
+    """按模板生成输出路径
+
+    可用字段：{dir} 原图目录，{name} 不带扩展名的文件名，{ext} 扩展名，
+    {rel} 原图相对输入目录的子目录，{suffix} 输出格式的扩展名（带点），
+    {preset} 方案名称（使用 --presets 时），{size} 输出尺寸（使用 --sizes 时，如 full、1024）。
+    """
+    name, ext = os.path.splitext(os.path.basename(image_path))
+    directory = os.path.dirname(image_path)
+    rel = os.path.relpath(directory, root) if root else ''
+    if rel == os.curdir:
+        rel = ''
+    path = template.format(dir=directory or os.curdir, name=name, ext=ext.lstrip('.'), rel=rel,
+                           suffix=suffix, preset=preset, size=size)
+    return os.path.normpath(path)
+
+
+def output_dir_filter(template):
+    """返回判断子目录是否为输出目录的函数，避免递归时处理自己的输出"""
+    prefix = os.path.dirname(template.split('{')[0])
+    static_root = os.path.abspath(prefix) if prefix else None
+
+    def skip_dir(path):
+        path = os.path.abspath(path)
+        if static_root and path == static_root:
+            return True
+        # 与同级图片的输出目录相同，例如默认模板的 {dir}/watermark
+        parent = os.path.dirname(path)
+        sample = format_output_path(template, os.path.join(parent, 'x.jpg'), parent)
+        return os.path.abspath(os.path.dirname(sample)) == path
+
+    return skip_dir
+
+
+def load_presets_file(path, base_profile=None):
+    """读取方案文件，返回 Preset 列表
+
+    文件为 JSON 对象，键为方案名称，值为设置（字段同设置文件，指定了 watermark
+    而没有 watermark_type 时为自定义水印），另可用 profile 指定这个方案的输出格式。
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or not data:
+        raise ValueError("方案文件应为非空的 JSON 对象：{方案名称: 设置}")
+    presets = []
+    for name, values in data.items():
+        if not name or any(sep in name for sep in ('/', '\\')) or name in (os.curdir, os.pardir):
+            raise ValueError(f"方案名称不能为空或包含路径分隔符: {name!r}")
+        try:
+            if values.get('watermark'):
+                values = {'watermark_type': 'custom', **values}
+            settings, extra = parse_settings(values, ('watermark', 'profile'))
+            watermark = load_watermark_for(settings, extra.get('watermark'))
+            profile = get_profile(extra.get('profile') or base_profile)
+        except (AttributeError, TypeError, ValueError) as e:
+            raise ValueError(f"方案 {name}: {str(e)}")
+        presets.append(Preset(name, settings, watermark, profile))
+    return presets
+
+
+def parse_sizes(spec):
+    """解析 --sizes，返回 Derivative 列表
+
+    逗号分隔，每项为长边像素或 full（原图尺寸），可用 尺寸:格式 指定这个尺寸的输出格式。
+    """
+    derivatives = []
+    for item in spec.split(','):
+        size, _, profile = item.strip().partition(':')
+        if size == 'full':
+            max_size = None
+        elif size.isdigit() and int(size) > 0:
+            max_size = int(size)
+        else:
+            raise ValueError(f"尺寸应为正整数或 full: {item.strip()!r}")
+        derivatives.append(Derivative(max_size, get_profile(profile) if profile else None))
+    labels = [derivative.label for derivative in derivatives]
+    if len(set(labels)) != len(labels):
+        raise ValueError("输出尺寸不能重复")
+    return derivatives
+
+
+def load_watermark_for(settings, watermark_path=None):
+    """按水印类型加载水印图片（文字水印返回 None）"""
+    if settings.watermark_type == 'custom':
+        if not watermark_path:
+            raise ValueError("自定义水印需要指定水印图片（--watermark 或设置中的 watermark）")
+        return load_watermark_image(watermark_path)
+    if settings.watermark_type == 'default':
+        return load_default_watermark() or create_fallback_watermark()
+    return None
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="批量给图片添加水印")
+    parser.add_argument('inputs', nargs='+', help="图片、文件夹或通配符（支持 **）")
+    parser.add_argument('-r', '--recursive', action='store_true', help="递归处理子文件夹")
+    parser.add_argument('--pattern', help="只处理文件名匹配的图片，例如 *.jpg")
+    parser.add_argument('-o', '--output',
+                        help="输出路径模板，可用 {dir} {name} {ext} {rel} {suffix} {preset} {size}"
+                             f"（默认: {DEFAULT_OUTPUT_TEMPLATE}，使用 --presets 时为 {DEFAULT_PRESET_TEMPLATE}，"
+                             f"使用 --sizes 时为 {DEFAULT_SIZE_TEMPLATE}）")
+    parser.add_argument('-f', '--profile', choices=list(PROFILES), default=DEFAULT_PROFILE,
+                        help="输出格式：" + "；".join(f"{p.name} {p.description}" for p in PROFILES.values()))
+    parser.add_argument('--settings', help="JSON 设置文件，字段同 WatermarkSettings，另可用 watermark 指定水印图片")
+    parser.add_argument('--type', dest='watermark_type', choices=['default', 'text', 'custom'])
+    parser.add_argument('--text')
+    parser.add_argument('--color', dest='text_color', choices=['white', 'black'])
+    parser.add_argument('--position', choices=POSITIONS)
+    parser.add_argument('--opacity', type=float)
+    parser.add_argument('--scale', dest='size_scale', type=float)
+    parser.add_argument('--tile-spacing', type=float, help="平铺时水印之间的间距，相对水印大小（默认 0.5）")
+    parser.add_argument('--tile-angle', type=float, help="平铺时水印的旋转角度（默认 30 度）")
+    parser.add_argument('--no-stagger', dest='tile_stagger', action='store_false', default=None,
+                        help="平铺时各行对齐，不错开半格")
+    parser.add_argument('--watermark', help="自定义水印图片（会把类型设为 custom）")
+    parser.add_argument('--presets', metavar='FILE',
+                        help="方案文件（JSON，{方案名称: 设置}），每张图片只解码一次，分别输出每个方案；"
+                             "输出模板中用 {preset} 区分方案")
+    parser.add_argument('--sizes', metavar='SIZES',
+                        help="一次输出多个尺寸，逗号分隔的长边像素或 full（原图），可用 尺寸:格式 单独指定"
+                             "输出格式，例如 full,2048,1024:webp,400:jpeg-web；每张图片只解码一次，"
+                             "输出模板中用 {size} 区分尺寸")
+    parser.add_argument('-j', '--workers', type=int, default=default_workers(),
+                        help="并行进程数（默认: %(default)s）")
+    parser.add_argument('--chunksize', type=int, help="每个进程一次领取的文件数")
+    parser.add_argument('--max-memory', type=float, metavar='MB',
+                        help="每个进程处理单张图片的内存上限，超过的未压缩 TIFF/BMP 分块处理并输出 PNG")
+    parser.add_argument('--manifest', help=f"处理记录文件（默认在输出目录或输入目录中的 {MANIFEST_FILENAME}）")
+    parser.add_argument('--no-manifest', action='store_true', help="不使用处理记录，全部重新处理")
+    parser.add_argument('--force', action='store_true', help="忽略已有记录重新处理，并更新记录")
+    parser.add_argument('--hash', action='store_true', help="修改时间变化时再比较文件内容")
+    parser.add_argument('--watch', action='store_true',
+                        help="持续监视输入文件夹，新图片写入完成后立即处理（Ctrl+C 停止）")
+    parser.add_argument('--poll', action='store_true',
+                        help="监视时定期扫描而不用 inotify（网络共享文件夹上需要）")
+    parser.add_argument('--settle', type=float, default=SETTLE_SECONDS, metavar='SECONDS',
+                        help="文件大小和修改时间保持多少秒不变才认为写入完成（默认: %(default)s）")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="把每个文件的各阶段耗时、大小、错误写成 JSON lines，最后一行为汇总")
+    parser.add_argument('--log', metavar='FILE', help="把本次运行的汇总（吞吐、各阶段 p50/p95/p99）追加到日志文件")
+    parser.add_argument('-q', '--quiet', action='store_true', help="只输出错误和汇总")
+    return parser
+
+
+def default_manifest_path(args):
+    """处理记录的默认位置：输出模板的固定目录，否则第一个输入所在的目录"""
+    prefix = os.path.dirname(args.output.split('{')[0])
+    if prefix:
+        return os.path.join(prefix, MANIFEST_FILENAME)
+    first = args.inputs[0]
+    if os.path.isdir(first):
+        directory = first
+    elif any(c in first for c in GLOB_CHARS):
+        directory = glob_root(first)
+    else:
+        directory = os.path.dirname(first) or os.curdir
+    return os.path.join(directory, MANIFEST_FILENAME)
+
+
+def resolve_settings(args):
+    """合并设置文件和命令行参数，返回 (设置, 水印图片)"""
+    settings, watermark_path = WatermarkSettings(), None
+    if args.settings:
+        settings, watermark_path = load_settings_file(args.settings)
+
+    overrides = {name: getattr(args, name) for name in SETTING_ARGS if getattr(args, name) is not None}
+    if args.watermark:
+        watermark_path = args.watermark
+        overrides.setdefault('watermark_type', 'custom')
+    settings = replace(settings, **overrides)
+    validate_settings(settings)
+    return settings, load_watermark_for(settings, watermark_path)
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    presets = derivatives = None
+    try:
+        if args.presets:
+            if args.settings or args.watermark or any(getattr(args, name) is not None for name in SETTING_ARGS):
+                raise ValueError("--presets 不能和 --settings、--watermark 等水印参数一起使用")
+            presets = load_presets_file(args.presets, args.profile)
+            settings, watermark = None, None
+        else:
+            settings, watermark = resolve_settings(args)
+        if args.sizes:
+            derivatives = parse_sizes(args.sizes)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if args.output is None:
+        if derivatives:
+            args.output = DEFAULT_PRESET_SIZE_TEMPLATE if presets else DEFAULT_SIZE_TEMPLATE
+        else:
+            args.output = DEFAULT_PRESET_TEMPLATE if presets else DEFAULT_OUTPUT_TEMPLATE
+    elif presets and len(presets) > 1 and '{preset}' not in args.output:
+        parser.error("输出多个方案时，输出模板中需要包含 {preset}")
+    elif derivatives and len(derivatives) > 1 and '{size}' not in args.output:
+        parser.error("输出多个尺寸时，输出模板中需要包含 {size}")
+
+    # 每个方案的 (方案名称, 尺寸)，用于填写输出模板
+    labels = {preset.name: (preset.name, '') for preset in presets or []}
+    if derivatives:
+        base = presets or [Preset('', settings, watermark)]
+        presets = with_derivatives(base, derivatives)
+        pairs = [(preset.name, derivative.label) for preset in base for derivative in derivatives]
+        labels = dict(zip([preset.name for preset in presets], pairs))
+
+    # 每个文件的输出路径在读取到它时才确定
+    roots = {}
+    # 监视模式下自己写出的文件，输出在监视范围内时不能再次处理
+    produced = set()
+    stop = threading.Event()
+    if args.watch:
+        not_dirs = [item for item in args.inputs if not os.path.isdir(item)]
+        if not_dirs:
+            parser.error(f"监视模式的输入必须是文件夹: {', '.join(not_dirs)}")
+
+        def accept(path):
+            if not is_image_file(os.path.basename(path), args.pattern) or os.path.abspath(path) in produced:
+                return False
+            # 之前运行时写出的输出
+            return manifest is None or not manifest.is_output(path)
+
+        watcher = FolderWatcher(args.inputs, args.recursive, accept, output_dir_filter(args.output),
+                                settle=args.settle, poll=args.poll)
+        found = watcher.watch(stop)
+        install_stop_handler(stop)
+        print(f"正在监视 {', '.join(args.inputs)}（{watcher.mode}），按 Ctrl+C 停止", file=sys.stderr)
+    else:
+        found = iter_inputs(args.inputs, args.recursive, args.pattern, skip_dir=output_dir_filter(args.output))
+
+    def inputs():
+        for image_path, root in found:
+            roots[image_path] = root
+            yield image_path
+            # 取下一个文件时，这个文件的输出路径（每个方案一个）都已经确定
+            roots.pop(image_path, None)
+
+    profile = get_profile(args.profile)
+    preset_profiles = {preset.name: preset.profile for preset in presets or []}
+
+    def output_path(image_path, preset=None):
+        suffix = (preset_profiles.get(preset) or profile).extension_for(image_path)
+        path = format_output_path(args.output, image_path, roots.get(image_path), suffix,
+                                  *labels.get(preset, ('', '')))
+        if args.watch:
+            produced.add(os.path.abspath(path))
+        return path
+
+    manifest = None
+    if not args.no_manifest:
+        manifest = Manifest(args.manifest or default_manifest_path(args),
+                            use_hash=args.hash, force=args.force)
+
+    metrics = BatchMetrics()
+    interrupted = False
+    records = JsonLinesWriter(args.metrics) if args.metrics else None
+    try:
+        # 监视模式下每个文件到达后立即分发，不等凑够一批
+        results = iter_batch(inputs(), None, settings, watermark, workers=args.workers,
+                             chunksize=1 if args.watch else args.chunksize, output_path=output_path,
+                             manifest=manifest, profile=profile, memory_limit_mb=args.max_memory,
+                             presets=presets,
+                             measure_memory=bool(args.metrics or args.log))
+        for result in results:
+            metrics.add(result)
+            if records is not None:
+                records.write(result_record(result))
+            if result.skipped:
+                continue
+            if result.ok:
+                if not args.quiet:
+                    label = f"[{result.preset}] " if result.preset else ""
+                    print(f"{label}{result.image_path} -> {result.output_path}")
+            else:
+                print(f"失败 {result.image_path}: {result.error}", file=sys.stderr)
+    except KeyboardInterrupt:
+        interrupted = True
+        print("已中断", file=sys.stderr)
+    finally:
+        metrics.finish()
+        if manifest is not None:
+            manifest.close()
+        if records is not None:
+            records.write(metrics.summary())
+            records.close()
+
+    processed = metrics.processed
+    print(f"完成：成功 {processed} 个，跳过 {metrics.skipped} 个，失败 {metrics.failed} 个，"
+          f"耗时 {metrics.elapsed:.1f} 秒", file=sys.stderr)
+    if processed:
+        print(f"输出格式 {profile.name}：平均 {metrics.bytes_written / processed / 1024:.0f} KB/张",
+              file=sys.stderr)
+        for line in metrics.format_lines():
+            print(line, file=sys.stderr)
+    if args.log:
+        metrics.write_log(args.log, f"命令行 {profile.name}")
+    if interrupted:
+        return 130
+    if metrics.failed or not (processed or metrics.skipped or args.watch):
+        return 1
+    return 0
+
+
+def install_stop_handler(stop):
+    """第一次 Ctrl+C（或 SIGTERM）停止监视并处理完排队中的图片，第二次立即退出"""
+    def handler(signum, frame):
+        if stop.is_set():
+            raise KeyboardInterrupt
+        stop.set()
+        print("正在停止监视，处理完排队中的图片后退出（再按一次 Ctrl+C 立即退出）", file=sys.stderr)
+
+    signal.signal(signal.SIGINT, handler)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, handler)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
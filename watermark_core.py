@@ -0,0 +1,583 @@
+"""水印渲染核心
+
+不依赖 tkinter，预览、保存、批量处理都通过 WatermarkRenderer 渲染，
+设置对象不可变且可以被 pickle，方便在工作进程中使用。
+"""
+import os
+import json
+import math
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass, fields
+
+from PIL import Image, ImageDraw, ImageFont
+
+from watermark_fonts import default_font_face, get_font
+from watermark_metrics import StageTimer
+
+
+# 平铺：水印按间距、角度重复铺满整张图片
+TILED = "平铺"
+POSITIONS = ("左上", "右上", "左下", "右下", "居中", TILED)
+DEFAULT_TEXT = "水印文字"
+DEFAULT_WATERMARK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'watermark.png')
+
+# 图片水印距边缘的距离
+IMAGE_PADDING = 10
+# 文字水印距边缘的距离
+TEXT_PADDING = 20
+# 文字基础字号 = 图片短边 // TEXT_SIZE_DIVISOR
+TEXT_SIZE_DIVISOR = 20
+# 预览的最大尺寸，小于 PREVIEW_MIN_SIDE 的图片会放大显示
+PREVIEW_MAX_SIZE = (800, 600)
+PREVIEW_MIN_SIDE = 400
+# 缩小图片时先按整数倍快速缩小到目标尺寸的这个倍数以内，再精确重采样
+REDUCING_GAP = 3.0
+# 平铺间距的上限（相对水印大小），更大的间距按这个值处理
+MAX_TILE_SPACING = 10.0
+# size_scale 的上限，防止生成超大的水印图块
+MAX_SIZE_SCALE = 10.0
+# 只能取固定几个值的设置项
+SETTING_CHOICES = {
+    'watermark_type': ('default', 'text', 'custom'),
+    'text_color': ('white', 'black'),
+    'position': POSITIONS,
+}
+
+@dataclass(frozen=True)
+class WatermarkSettings:
+    """水印设置（不可变）"""
+    watermark_type: str = "default"  # default / text / custom
+    text: str = ""
+    text_color: str = "white"
+    position: str = "右下"
+    opacity: float = 0.5
+    size_scale: float = 1.0
+    # 平铺模式：水印之间的间距（相对水印大小）、旋转角度（度）、隔行错开半格
+    tile_spacing: float = 0.5
+    tile_angle: float = 30.0
+    tile_stagger: bool = True
+
+    def __post_init__(self):
+        for name in ('tile_spacing', 'tile_angle'):
+            if not math.isfinite(getattr(self, name)):
+                raise ValueError(f"{name} 应为有限的数值")
+
+    @property
+    def display_text(self):
+        return self.text or DEFAULT_TEXT
+
+    def fill_color(self):
+        """文字颜色（带透明度）"""
+        alpha = int(255 * self.opacity)
+        if self.text_color == 'white':
+            return (255, 255, 255, alpha)
+        return (0, 0, 0, alpha)
+
+
+def validate_settings(settings):
+    """检查来自命令行、设置文件或请求的设置，不合法时抛出 ValueError"""
+    for name, choices in SETTING_CHOICES.items():
+        if getattr(settings, name) not in choices:
+            raise ValueError(f"{name} 只能是: {', '.join(choices)}")
+    if not isinstance(settings.text, str):
+        raise ValueError("text 应为字符串")
+    for name in ('opacity', 'size_scale', 'tile_spacing', 'tile_angle'):
+        value = getattr(settings, name)
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+            raise ValueError(f"{name} 应为有限的数值")
+    if not 0 <= settings.opacity <= 1:
+        raise ValueError("opacity 应在 0 到 1 之间")
+    if not 0 < settings.size_scale <= MAX_SIZE_SCALE:
+        raise ValueError(f"size_scale 应在 0 到 {MAX_SIZE_SCALE} 之间")
+    if not 0 <= settings.tile_spacing <= MAX_TILE_SPACING:
+        raise ValueError(f"tile_spacing 应在 0 到 {MAX_TILE_SPACING} 之间")
+    if not isinstance(settings.tile_stagger, bool):
+        raise ValueError("tile_stagger 应为布尔值")
+
+
+def parse_settings(data, extra_keys=('watermark',)):
+    """把设置字典转成检查过的 WatermarkSettings，返回 (设置, extra_keys 中的其他项)"""
+    data = dict(data)
+    known = {field.name for field in fields(WatermarkSettings)}
+    unknown = set(data) - known - set(extra_keys)
+    if unknown:
+        raise ValueError(f"未知的设置项: {', '.join(sorted(unknown))}")
+    extra = {key: data.pop(key) for key in extra_keys if key in data}
+    settings = WatermarkSettings(**data)
+    validate_settings(settings)
+    return settings, extra
+
+
+def load_settings_file(path):
+    """读取 JSON 设置文件，返回 (WatermarkSettings, 水印图片路径)"""
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    settings, extra = parse_settings(data)
+    return settings, extra.get('watermark')
+
+
+@dataclass(frozen=True)
+class Overlay:
+    """准备好的水印图块，可以直接合成到指定尺寸的图片上
+
+    positions 不为空时，同一个图块依次贴在这些位置（平铺模式）。
+    """
+    image: Image.Image  # RGBA
+    position: tuple
+    positions: tuple = ()
+
+    def placements(self):
+        """图块需要贴上的所有位置"""
+        return self.positions or (self.position,)
+
+
+class OverlayCache:
+    """按几何参数缓存水印图块的 LRU 缓存"""
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, factory):
+        """取出缓存的图块，没有时调用 factory() 生成"""
+        with self._lock:
+            overlay = self._items.get(key)
+            if overlay is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return overlay
+            self.misses += 1
+
+        overlay = factory()
+        with self._lock:
+            self._items[key] = overlay
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+        return overlay
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """命中统计"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items)}
+
+
+# 进程内共享的图块缓存
+overlay_cache = OverlayCache()
+
+# id(水印图片) -> (弱引用, 内容摘要)，避免同一张水印重复计算摘要
+_watermark_ids = {}
+
+
+def watermark_identity(watermark):
+    """水印图片的内容标识，用作缓存键"""
+    entry = _watermark_ids.get(id(watermark))
+    if entry is not None and entry[0]() is watermark:
+        return entry[1]
+
+    digest = hashlib.md5(watermark.tobytes()).hexdigest()
+    identity = (watermark.size, digest)
+    # 清理已经释放的水印
+    for key in [key for key, (ref, _) in _watermark_ids.items() if ref() is None]:
+        del _watermark_ids[key]
+    _watermark_ids[id(watermark)] = (weakref.ref(watermark), identity)
+    return identity
+
+
+def composite_overlay(image, overlay):
+    """把图块按自身的透明度合成到 image 上的所有位置（就地修改）
+
+    不带透明通道的图片（RGB、L、CMYK）以图块的透明通道为蒙版直接贴上，图片
+    保持原来的模式，结果和转成 RGBA 后 alpha_composite 相同（RGB）或只差舍入
+    （L、CMYK 先把图块转成图片的模式）。带透明通道的图片按 alpha_composite
+    合成，水印不会降低原图的不透明度。开销都和水印面积成正比，与整张图片
+    大小无关。
+    """
+    tile = overlay.image
+    if 'A' not in image.getbands():
+        fill = tile if image.mode == 'RGB' else tile.convert(image.mode)
+        for position in overlay.placements():
+            image.paste(fill, position, tile)
+        return image
+    for position in overlay.placements():
+        alpha_composite_at(image, tile, position)
+    return image
+
+
+def alpha_composite_at(image, tile, position):
+    """把图块 alpha_composite 到带透明通道的 image 的 position 处（就地修改）
+
+    只裁出图块覆盖的区域做合成再贴回去。
+    """
+    left, top = position
+    box = (max(left, 0), max(top, 0),
+           min(left + tile.width, image.width), min(top + tile.height, image.height))
+    if box[0] >= box[2] or box[1] >= box[3]:
+        return image
+
+    # 图块超出图片边界时只保留图片内的部分
+    if box != (left, top, left + tile.width, top + tile.height):
+        tile = tile.crop((box[0] - left, box[1] - top, box[2] - left, box[3] - top))
+
+    region = image.crop(box)
+    if region.mode != 'RGBA':
+        region = Image.alpha_composite(region.convert('RGBA'), tile).convert(image.mode)
+    else:
+        region = Image.alpha_composite(region, tile)
+    image.paste(region, box[:2])
+    return image
+
+
+def calculate_position(position, image_size, watermark_size, padding=IMAGE_PADDING):
+    """计算水印位置"""
+    if position == "左上":
+        return (padding, padding)
+    elif position == "右上":
+        return (image_size[0] - watermark_size[0] - padding, padding)
+    elif position == "左下":
+        return (padding, image_size[1] - watermark_size[1] - padding)
+    elif position == "右下":
+        return (image_size[0] - watermark_size[0] - padding,
+                image_size[1] - watermark_size[1] - padding)
+    else:  # 居中
+        return ((image_size[0] - watermark_size[0]) // 2,
+                (image_size[1] - watermark_size[1]) // 2)
+
+
+def tile_layout(image_size, cell_size, spacing, stagger):
+    """平铺时每一行的起点
+
+    以图片中心放一个水印为基准向四周排列，返回 (每行的左上角坐标, 水平周期)。
+    同一行的水印间隔一个水平周期，错开时奇数行移动半个周期；每行从第一个
+    露出图片左边缘的水印开始，一行的宽度为图片宽度加一个水印宽度就能盖满，
+    和间距无关。间距限制在 0 到 MAX_TILE_SPACING 之间。
+    """
+    spacing = min(max(spacing, 0.0), MAX_TILE_SPACING)
+    period_x = max(1, round(cell_size[0] * (1 + spacing)))
+    period_y = max(1, round(cell_size[1] * (1 + spacing)))
+    center_left = (image_size[0] - cell_size[0]) // 2
+    center_top = (image_size[1] - cell_size[1]) // 2
+    rows = []
+    # 第一个下边缘在图片内的行
+    row = 1 - math.ceil((center_top + cell_size[1]) / period_y)
+    while center_top + row * period_y < image_size[1]:
+        left = center_left + (period_x // 2 if stagger and row % 2 else 0)
+        # 移到第一个右边缘在图片内的水印，间距很大时整行可能都在图片之外
+        left = (left + cell_size[0] - 1) % period_x - cell_size[0] + 1
+        if left < image_size[0]:
+            rows.append((left, center_top + row * period_y))
+        row += 1
+    return tuple(rows), period_x
+
+
+def stamp_row(cell, width, period):
+    """把一个水印按周期横向重复，拼成宽度为 width 的一整行，超出的部分裁掉"""
+    row = Image.new('RGBA', (width, cell.height), (0, 0, 0, 0))
+    for i in range(math.ceil(width / period)):
+        # 间距不小于 0 时水印互不重叠，直接贴上不需要混合
+        row.paste(cell, (i * period, 0))
+    return row
+
+
+def text_font_size(image_size, size_scale):
+    """根据图片尺寸计算文字字号"""
+    base_size = min(image_size) // TEXT_SIZE_DIVISOR
+    return int(base_size * size_scale)
+
+
+def scale_ratio(image_size, reference_size):
+    """image_size 相对原图 reference_size 的缩放比例"""
+    if not reference_size or tuple(reference_size) == tuple(image_size):
+        return 1.0
+    return min(image_size[0] / reference_size[0], image_size[1] / reference_size[1])
+
+
+def create_fallback_watermark():
+    """没有默认水印图片时，生成一张文字水印作为备选"""
+    watermark = Image.new('RGBA', (200, 50), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(watermark)
+    font = ImageFont.load_default()
+    text = "Default Watermark"
+
+    # 计算文字位置使其居中
+    text_bbox = draw.textbbox((0, 0), text, font=font)
+    text_width = text_bbox[2] - text_bbox[0]
+    text_height = text_bbox[3] - text_bbox[1]
+    x = (watermark.width - text_width) // 2
+    y = (watermark.height - text_height) // 2
+    draw.text((x, y), text, font=font, fill="white")
+    return watermark
+
+
+def fit_preview_size(size, max_size=PREVIEW_MAX_SIZE, min_side=PREVIEW_MIN_SIDE):
+    """计算图片在预览区域中显示的尺寸"""
+    width, height = size
+    scale = min(max_size[0] / width, max_size[1] / height)  # 选择较小的缩放比例以适应窗口
+    if scale >= 1:
+        if max(width, height) >= min_side:
+            return tuple(size)
+        # 如果图片太小，放大到合适大小
+        scale = min_side / max(width, height)
+    return (max(1, int(width * scale)), max(1, int(height * scale)))
+
+
+def downscale(image, size):
+    """把图片缩小到 size，先按整数倍快速缩小再用 LANCZOS 重采样"""
+    return image.resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+
+
+def has_transparency(image):
+    """图片是否带有透明信息"""
+    return image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+
+
+def render_mode(image, image_format=None):
+    """加水印时图片使用的模式
+
+    RGB、L 保持原样，CMYK 在输出 JPEG（或 image_format 为空）时也保持原样，
+    从解码到编码都不转换；只有真正带透明信息的图片才转成 RGBA，其他模式转成 RGB。
+    """
+    if has_transparency(image):
+        return 'RGBA'
+    if image.mode in ('RGB', 'L') or (image.mode == 'CMYK' and image_format in (None, 'JPEG')):
+        return image.mode
+    return 'RGB'
+
+
+def convert_for_render(image, image_format=None):
+    """把图片转换成 render_mode 的模式，已经是这个模式时原样返回"""
+    mode = render_mode(image, image_format)
+    if image.mode != mode:
+        image = image.convert(mode)
+    return image
+
+
+def load_preview_image(path, max_size=PREVIEW_MAX_SIZE):
+    """以接近预览的尺寸解码图片，返回 (预览图, 原图尺寸)
+
+    JPEG 通过 draft 在解码时直接按 1/2、1/4、1/8 缩小，不需要解码完整的像素。
+    """
+    image = Image.open(path)
+    full_size = image.size
+    size = fit_preview_size(full_size, max_size)
+    image.draft('RGB', size)
+    image = image.convert('RGBA' if has_transparency(image) else 'RGB')
+    if image.size != size:
+        image = downscale(image, size)
+    return image, full_size
+
+
+def load_source_image(path, image_format=None):
+    """完整解码原图，并移除色彩配置文件
+
+    图片转换成 render_mode 的模式，image_format 为输出格式。
+    """
+    image = Image.open(path)
+    image.load()
+    image = convert_for_render(image, image_format)
+    # 清空附带的信息以移除色彩配置文件，不需要再复制一份像素
+    image.info = {}
+    return image
+
+
+def load_watermark_image(path):
+    """加载水印图片并转换为RGBA"""
+    image = Image.open(path)
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    return image
+
+
+def load_default_watermark(path=DEFAULT_WATERMARK_PATH):
+    """加载默认水印图片，失败时返回 None"""
+    if not os.path.exists(path):
+        return None
+    try:
+        return load_watermark_image(path)
+    except Exception as e:
+        print(f"加载默认水印失败: {str(e)}")
+        return None
+
+
+class WatermarkRenderer:
+    """根据 WatermarkSettings 给图片加水印
+
+    watermark 为默认/自定义水印图片（RGBA），文字水印时可以为 None。
+    同一尺寸的图片只会生成一次水印图块，之后从 cache 中取出。
+
+    reference_size 为原图尺寸：在缩小的预览图上渲染时传入，水印的大小、
+    边距会按比例缩小，效果和在原图上渲染后再缩小一致。
+
+    timer（watermark_metrics.StageTimer）不为空时记录 convert/overlay/composite
+    三个阶段的耗时。
+
+    render 的 copy 为 False 时直接在传入的图片上合成，不再复制
+    整张图片，之后调用方不能再使用原图；只有需要转换模式时才会生成新图片。
+    """
+
+    def __init__(self, settings, watermark=None, cache=None):
+        self.settings = settings
+        if watermark is not None and watermark.mode != 'RGBA':
+            watermark = watermark.convert('RGBA')
+        self.watermark = watermark
+        self.cache = overlay_cache if cache is None else cache
+        self._watermark_id = None
+
+    def render(self, image, reference_size=None, timer=None, copy=True):
+        """返回加好水印的图片，copy 为 True 时不修改原图"""
+        timer = timer or StageTimer()
+        if self.settings.watermark_type != "text" and self.watermark is None:
+            with timer.stage('convert'):
+                return image.copy() if copy else image
+        with timer.stage('convert'):
+            result = self._prepare(image, copy)
+        with timer.stage('overlay'):
+            overlay = self.overlay_for(result.size, reference_size)
+        with timer.stage('composite'):
+            return self._composite(result, overlay)
+
+    def warm_up(self):
+        """提前扫描字体、计算水印图片的标识，第一张图片不用等待这些准备工作"""
+        if self.settings.watermark_type == "text":
+            default_font_face()
+        elif self.watermark is not None and self._watermark_id is None:
+            self._watermark_id = watermark_identity(self.watermark)
+        return self
+
+    def overlay_for(self, image_size, reference_size=None):
+        """取得指定图片尺寸对应的水印图块"""
+        settings = self.settings
+        image_size = tuple(image_size)
+        reference_size = tuple(reference_size or image_size)
+        if settings.position == TILED:
+            build = self.build_tiled_overlay
+        elif settings.watermark_type == "text":
+            build = self.build_text_overlay
+        else:
+            build = self.build_image_overlay
+
+        key = (image_size, reference_size, settings)
+        if settings.watermark_type != "text":
+            if self._watermark_id is None:
+                self._watermark_id = watermark_identity(self.watermark)
+            key += (self._watermark_id,)
+        return self.cache.get(key, lambda: build(image_size, reference_size))
+
+    def image_cell(self, ratio):
+        """按缩放比例和透明度处理后的水印图片"""
+        settings = self.settings
+        original_size = self.watermark.size
+        new_size = (max(1, int(original_size[0] * settings.size_scale * ratio)),
+                    max(1, int(original_size[1] * settings.size_scale * ratio)))
+        watermark = self.watermark.resize(new_size, Image.Resampling.LANCZOS)
+
+        # 调整透明度
+        opacity = settings.opacity
+        watermark.putalpha(watermark.getchannel('A').point(lambda x: int(x * opacity)))
+        return watermark
+
+    def text_cell(self, font):
+        """刚好容纳文字的透明图块"""
+        text = self.settings.display_text
+        draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+        left, top, right, bottom = draw.textbbox((0, 0), text, font=font)
+        tile = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (255, 255, 255, 0))
+        ImageDraw.Draw(tile).text((-left, -top), text, font=font, fill=self.settings.fill_color())
+        return tile
+
+    def build_image_overlay(self, image_size, reference_size=None):
+        """按缩放比例和透明度处理水印图片"""
+        ratio = scale_ratio(image_size, reference_size)
+        watermark = self.image_cell(ratio)
+        position = calculate_position(self.settings.position, image_size, watermark.size,
+                                      padding=round(IMAGE_PADDING * ratio))
+        return Overlay(watermark, position)
+
+    def build_tiled_overlay(self, image_size, reference_size=None):
+        """平铺水印：旋转后的水印只生成一次，拼成一整行，再按行贴满图片"""
+        settings = self.settings
+        ratio = scale_ratio(image_size, reference_size)
+        if settings.watermark_type == "text":
+            font_size = text_font_size(reference_size or image_size, settings.size_scale)
+            cell = self.text_cell(get_font(int(font_size * ratio)))
+        else:
+            cell = self.image_cell(ratio)
+        if settings.tile_angle % 360:
+            cell = cell.rotate(settings.tile_angle, Image.Resampling.BICUBIC, expand=True)
+
+        rows, period = tile_layout(image_size, cell.size, settings.tile_spacing, settings.tile_stagger)
+        row = stamp_row(cell, image_size[0] + cell.width, period)
+        return Overlay(row, rows[0], rows)
+
+    def build_text_overlay(self, image_size, reference_size=None):
+        """把文字绘制到刚好容纳它的透明图块上"""
+        settings = self.settings
+        text = settings.display_text
+        ratio = scale_ratio(image_size, reference_size)
+        font_size = text_font_size(reference_size or image_size, settings.size_scale)
+        font = get_font(int(font_size * ratio))
+
+        # 获取文字边界框
+        draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+        text_bbox = draw.textbbox((0, 0), text, font=font)
+        text_width = text_bbox[2] - text_bbox[0]
+        text_height = text_bbox[3] - text_bbox[1]
+
+        # 确保文字完全显示在图片内
+        padding = round(TEXT_PADDING * ratio)
+        position = calculate_position(
+            settings.position,
+            (image_size[0] - padding * 2, image_size[1] - padding * 2),
+            (text_width, text_height)
+        )
+        position = (position[0] + padding, position[1] + padding)
+
+        # 文字实际占据的区域
+        left, top, right, bottom = draw.textbbox(position, text, font=font)
+        tile = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)), (255, 255, 255, 0))
+        ImageDraw.Draw(tile).text((position[0] - left, position[1] - top), text,
+                                  font=font, fill=settings.fill_color())
+        return Overlay(tile, (left, top))
+
+    def render_region(self, region, offset, full_size, timer=None):
+        """给整图中左上角位于 offset 的一块区域加水印（就地修改）
+
+        用于分块处理大图，和水印不相交的区域直接返回。
+        """
+        timer = timer or StageTimer()
+        if self.settings.watermark_type != "text" and self.watermark is None:
+            return region
+        with timer.stage('overlay'):
+            overlay = self.overlay_for(full_size)
+        width, height = overlay.image.size
+        positions = tuple((left - offset[0], top - offset[1]) for left, top in overlay.placements())
+        positions = tuple((left, top) for left, top in positions
+                          if left < region.width and top < region.height
+                          and left + width > 0 and top + height > 0)
+        if not positions:
+            return region
+        with timer.stage('composite'):
+            return self._composite(region, Overlay(overlay.image, positions[0], positions))
+
+    def _composite(self, image, overlay):
+        """把图块合成到 image 上（就地修改）"""
+        return composite_overlay(image, overlay)
+
+    def _prepare(self, image, copy=True):
+        """用于合成的图片，copy 为 False 时尽量直接使用原图"""
+        # 调色板等模式无法直接混合，先整体转换（见 render_mode）
+        if image.mode not in ('RGB', 'RGBA', 'L', 'CMYK'):
+            return convert_for_render(image)
+        return image.copy() if copy else image
@@ -0,0 +1,137 @@
+"""输出编码设置
+
+每个编码方案对应一种输出格式和编码参数，可以在批量处理时选择。
+encode_image 先编码到内存，返回编码后的数据和耗时，方便比较不同
+方案的文件大小和速度。
+"""
+import io
+import os
+import time
+import itertools
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+
+@dataclass(frozen=True)
+class EncoderProfile:
+    """输出编码方案"""
+    name: str
+    format: str  # JPEG / WEBP / PNG / GIF，source 表示保持原图格式
+    options: dict = field(default_factory=dict, hash=False)
+    description: str = ""
+
+    def resolve(self, image_path):
+        """保持原图格式时，按原图扩展名选出实际使用的方案"""
+        if self.format != 'source':
+            return self
+        ext = os.path.splitext(image_path)[1].lower()
+        return PROFILES[SOURCE_FORMATS.get(ext, 'png')]
+
+    def extension_for(self, image_path):
+        """输出文件的扩展名（带点）"""
+        return FORMAT_EXTENSIONS[self.resolve(image_path).format]
+
+
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'WEBP': '.webp', 'PNG': '.png', 'GIF': '.gif'}
+
+PROFILES = {profile.name: profile for profile in [
+    EncoderProfile('jpeg', 'JPEG', {'quality': 95}, "JPEG 质量95（默认）"),
+    EncoderProfile('jpeg-best', 'JPEG', {'quality': 100, 'subsampling': 0}, "JPEG 最高质量，文件很大"),
+    EncoderProfile('jpeg-web', 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True,
+                                        'subsampling': 2}, "JPEG 渐进式，适合网页"),
+    EncoderProfile('jpeg-fast', 'JPEG', {'quality': 85, 'subsampling': 2}, "JPEG 编码最快"),
+    EncoderProfile('webp', 'WEBP', {'quality': 85, 'method': 4}, "WebP 有损"),
+    EncoderProfile('webp-fast', 'WEBP', {'quality': 80, 'method': 0}, "WebP 有损，编码最快"),
+    EncoderProfile('webp-lossless', 'WEBP', {'lossless': True, 'quality': 80, 'method': 4}, "WebP 无损"),
+    EncoderProfile('png', 'PNG', {'compress_level': 6}, "PNG 无损"),
+    EncoderProfile('png-fast', 'PNG', {'compress_level': 1}, "PNG 无损，压缩最快"),
+    EncoderProfile('gif', 'GIF', {}, "GIF，动图保持动画"),
+    EncoderProfile('source', 'source', {}, "保持原图格式"),
+]}
+DEFAULT_PROFILE = 'jpeg'
+# 保持原图格式时，扩展名对应的方案；其他格式（bmp/tif/tiff）使用 PNG
+SOURCE_FORMATS = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.webp': 'webp', '.png': 'png', '.gif': 'gif'}
+
+
+def get_profile(profile):
+    """按名称取得编码方案，也可以直接传入 EncoderProfile"""
+    if isinstance(profile, EncoderProfile):
+        return profile
+    try:
+        return PROFILES[profile or DEFAULT_PROFILE]
+    except KeyError:
+        raise ValueError(f"未知的输出格式: {profile}（可选: {', '.join(PROFILES)}）")
+
+
+@dataclass
+class EncodeResult:
+    """编码结果"""
+    data: bytes
+    format: str
+    encode_time: float
+
+    @property
+    def size(self):
+        return len(self.data)
+
+
+def prepare_for_format(image, image_format):
+    """转换成目标格式支持的模式"""
+    if image_format == 'JPEG':
+        if image.mode not in ('RGB', 'L', 'CMYK'):
+            image = image.convert('RGB')
+    elif image.mode == 'RGBA':
+        # 完全不透明时去掉透明通道，文件更小
+        if image.getchannel('A').getextrema() == (255, 255):
+            image = image.convert('RGB')
+    elif image.mode == 'CMYK':
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'L', 'LA', 'P'):
+        image = image.convert('RGBA')
+    return image
+
+
+def encode_image(image, profile, image_path=''):
+    """按编码方案把图片编码到内存"""
+    profile = get_profile(profile).resolve(image_path)
+    start = time.perf_counter()
+    image = prepare_for_format(image, profile.format)
+    buffer = io.BytesIO()
+    image.save(buffer, profile.format, **profile.options)
+    return EncodeResult(buffer.getvalue(), profile.format, time.perf_counter() - start)
+
+
+# 临时文件名中的序号，同一进程的多个线程不会冲突
+_temp_counter = itertools.count()
+
+
+@contextmanager
+def atomic_output(save_path):
+    """先写入同目录下的临时文件，完成后再改名为 save_path
+
+    写入出错时删除临时文件；进程中途被杀时最多留下一个隐藏的 .tmp 文件，
+    不会留下不完整的输出图片。
+    """
+    directory, name = os.path.split(save_path)
+    temp_path = os.path.join(directory, f".{name}.{os.getpid()}-{threading.get_ident()}-"
+                                        f"{next(_temp_counter)}.tmp")
+    # 用 open 而不是 mkstemp 创建，文件权限和直接写入时一样遵循 umask
+    f = open(temp_path, 'xb')
+    try:
+        with f:
+            yield f
+        os.replace(temp_path, save_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_encoded(result, save_path):
+    """写入编码好的数据（先写临时文件再改名），返回写入的字节数"""
+    with atomic_output(save_path) as f:
+        f.write(result.data)
+    return result.size
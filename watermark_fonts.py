@@ -0,0 +1,222 @@
+"""字体查找与缓存
+
+第一次使用时扫描系统字体目录，找出支持中文的字体并把结果保存到
+索引文件中，之后启动只需要检查文件有没有变化。加载好的字体对象按
+(路径, 字体序号, 字号) 缓存，重复渲染不再解析字体文件。
+"""
+import os
+import sys
+import json
+import threading
+from functools import lru_cache
+
+from PIL import ImageFont
+
+
+FONT_EXTENSIONS = ('.ttf', '.ttc', '.otf', '.otc')
+# 用来判断字体是否支持中文的字符
+CJK_PROBE = "水"
+# 一定不存在的字符，用来取得字体的“缺字”字形
+MISSING_PROBE = "\U0010fffd"
+INDEX_VERSION = 1
+
+# 优先使用的字体（按顺序）
+if sys.platform.startswith('win'):
+    PREFERRED_FONTS = [
+        "msyh.ttc",  # 微软雅黑
+        "simsun.ttc",  # 宋体
+        "msgothic.ttc",
+        "YuGothic.ttf",
+    ]
+else:
+    PREFERRED_FONTS = [
+        "NotoSansCJK-Regular.ttc",
+        "PingFang.ttc",
+        "Hiragino Sans GB.ttc",
+        "wqy-microhei.ttc",
+    ]
+
+
+def font_directories():
+    """系统字体目录"""
+    home = os.path.expanduser("~")
+    if sys.platform.startswith('win'):
+        windir = os.environ.get('WINDIR', 'C:/Windows')
+        local = os.environ.get('LOCALAPPDATA', os.path.join(home, 'AppData', 'Local'))
+        return [os.path.join(windir, 'Fonts'),
+                os.path.join(local, 'Microsoft', 'Windows', 'Fonts')]
+    if sys.platform == 'darwin':
+        return ['/System/Library/Fonts', '/Library/Fonts',
+                os.path.join(home, 'Library', 'Fonts')]
+    return ['/usr/share/fonts', '/usr/local/share/fonts',
+            os.path.join(home, '.fonts'), os.path.join(home, '.local', 'share', 'fonts')]
+
+
+def default_index_path():
+    """字体索引文件位置，可以用 WATERMARK_FONT_INDEX 环境变量指定"""
+    path = os.environ.get('WATERMARK_FONT_INDEX')
+    if path:
+        return path
+    if sys.platform.startswith('win'):
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser("~"))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser("~"), '.cache'))
+    return os.path.join(base, 'watermarktool', 'fonts.json')
+
+
+def iter_font_files(directories):
+    """遍历目录下的字体文件"""
+    for directory in directories:
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if name.lower().endswith(FONT_EXTENSIONS):
+                    yield os.path.join(root, name)
+
+
+def supports_cjk(font):
+    """字体里有中文字形，而不是缺字方框"""
+    try:
+        glyph = font.getmask(CJK_PROBE)
+        if glyph.size[0] == 0 or glyph.size[1] == 0:
+            return False
+        missing = font.getmask(MISSING_PROBE)
+        return glyph.size != missing.size or bytes(glyph) != bytes(missing)
+    except Exception:
+        return False
+
+
+def probe_font_file(path):
+    """读取字体文件中每个字体，返回 [{'index', 'name', 'cjk'}]"""
+    faces = []
+    index = 0
+    while True:
+        try:
+            font = ImageFont.truetype(path, 16, index=index)
+        except Exception:
+            break
+        family, style = font.getname()
+        faces.append({'index': index, 'name': f"{family or ''} {style or ''}".strip(),
+                      'cjk': supports_cjk(font)})
+        # 只有字体集合（ttc/otc）才有多个字体
+        if not path.lower().endswith(('.ttc', '.otc')):
+            break
+        index += 1
+    return faces
+
+
+class FontIndex:
+    """系统字体索引，记录每个字体文件的字体和是否支持中文"""
+
+    def __init__(self, path=None, directories=None):
+        self.path = path or default_index_path()
+        self.directories = directories or font_directories()
+        self.files = {}
+
+    def load(self):
+        """读取保存的索引，文件损坏或版本不对时忽略"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') == INDEX_VERSION:
+                self.files = data.get('files', {})
+        except (OSError, ValueError):
+            self.files = {}
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'files': self.files}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"保存字体索引失败: {str(e)}")
+
+    def refresh(self):
+        """扫描字体目录，只解析新增或修改过的字体文件"""
+        self.load()
+        files = {}
+        changed = False
+        for path in iter_font_files(self.directories):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entry = self.files.get(path)
+            if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                entry = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                         'faces': probe_font_file(path)}
+                changed = True
+            files[path] = entry
+
+        stale = changed or files.keys() != self.files.keys()
+        self.files = files
+        if stale:
+            self.save()
+        return self
+
+    def cjk_faces(self):
+        """所有支持中文的字体，返回 [(路径, 字体序号)]"""
+        return [(path, face['index'])
+                for path, entry in sorted(self.files.items())
+                for face in entry['faces'] if face['cjk']]
+
+    def find(self, filename):
+        """按文件名查找字体"""
+        filename = filename.lower()
+        for path in sorted(self.files):
+            if os.path.basename(path).lower() == filename and self.files[path]['faces']:
+                return path, self.files[path]['faces'][0]['index']
+        return None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_font_index():
+    """进程内只扫描一次字体目录"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = FontIndex().refresh()
+        return _index
+
+
+@lru_cache(maxsize=1)
+def default_font_face():
+    """选用的中文字体 (路径, 字体序号)，找不到时返回 None"""
+    index = get_font_index()
+    for filename in PREFERRED_FONTS:
+        face = index.find(filename)
+        if face is not None:
+            return face
+
+    faces = index.cjk_faces()
+    if faces:
+        return faces[0]
+    print("未找到支持中文的字体，使用默认字体")
+    return None
+
+
+@lru_cache(maxsize=64)
+def load_truetype(path, index, size):
+    """加载指定字号的字体（结果会被缓存）"""
+    return ImageFont.truetype(path, size, index=index)
+
+
+@lru_cache(maxsize=1)
+def load_default_font():
+    """Pillow 自带的字体"""
+    return ImageFont.load_default()
+
+
+def get_font(size):
+    """取得指定字号的中文字体，找不到时使用默认字体"""
+    try:
+        face = default_font_face()
+        if face is not None:
+            return load_truetype(face[0], face[1], size)
+    except Exception as e:
+        print(f"加载字体失败: {str(e)}")
+    return load_default_font()
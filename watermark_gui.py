@@ -0,0 +1,592 @@
+"""水印工具的图形界面
+
+由 watermarktool.py 在启动界面时导入；其他模块都不依赖 tkinter。
+"""
+import os
+import time
+import traceback
+import tkinter as tk
+import queue
+import threading 
+from tkinter import ttk, filedialog, messagebox
+from PIL import ImageTk
+
+from watermark_core import (
+    POSITIONS, TILED, WatermarkSettings, WatermarkRenderer,
+    create_fallback_watermark, load_default_watermark,
+    load_preview_image, load_source_image, load_watermark_image,
+)
+from watermark_batch import SUPPORTED_EXTENSIONS, default_workers, iter_batch, output_path_for
+from watermark_encoders import DEFAULT_PROFILE, PROFILES, encode_image, get_profile, write_encoded
+from watermark_animation import encode_animated_file
+from watermark_prefetch import PreviewPrefetcher
+from watermark_manifest import MANIFEST_FILENAME, Manifest
+from watermark_metrics import BATCH_LOG_FILENAME, BatchMetrics
+
+
+# 滑块事件合并的间隔（毫秒）
+PREVIEW_DELAY_MS = 15
+# 批量预览时预读前后各几张图片，以及预读缓存的内存上限（MB）
+PREFETCH_WINDOW = 2
+PREFETCH_MEMORY_MB = 256
+
+
+class WatermarkApp:
+    def __init__(self, master):
+        self.master = master
+        self.master.title("水印工具")
+        self.root = master
+        # 设置最小窗口大小
+        self.master.minsize(800, 600)
+
+        # 初始化变量
+        self.watermark_type = tk.StringVar(value="default")
+        self.text_content = tk.StringVar()
+        self.font_size = tk.IntVar(value=60)
+        self.text_color = tk.StringVar(value="white")
+        self.position = tk.StringVar(value="右下")
+        self.opacity = tk.DoubleVar(value=0.5)
+        self.size_scale = tk.DoubleVar(value=1.0)
+        self.tile_spacing = tk.DoubleVar(value=0.5)
+        self.tile_angle = tk.DoubleVar(value=30.0)
+        self.tile_stagger = tk.BooleanVar(value=True)
+        self.batch_workers = tk.IntVar(value=default_workers())
+        # 批量处理时忽略处理记录，全部重新处理
+        self.batch_force = tk.BooleanVar(value=False)
+        self.output_profile = tk.StringVar(value=DEFAULT_PROFILE)
+        self.watermark_image = None
+        # 原图只在保存时才完整解码，用完即释放，这里只记录原图尺寸
+        self.source_size = None
+        self.current_image_path = None
+        # 缩小到预览尺寸的原图，拖动滑块时只在它上面渲染
+        self.preview_source = None
+        self._preview_job = None
+        self.batch_state = None
+        self.prefetcher = None
+
+        # 默认水印图片在第一次使用时才加载
+        self.default_watermark = None
+        # 设置GUI
+        self.setup_gui()
+
+    def setup_gui(self):
+        # 主布局
+        main_frame = ttk.Frame(self.master)
+        main_frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        # 左侧控制面板
+        control_frame = ttk.LabelFrame(main_frame, text="水印设置")
+        control_frame.pack(side=tk.LEFT, fill=tk.Y, padx=5, pady=5)
+
+        # 水印类型选择
+        ttk.Label(control_frame, text="水印类型:").pack(pady=5)
+        ttk.Radiobutton(control_frame, text="默认水印", variable=self.watermark_type,
+                        value="default", command=self.update_watermark).pack()
+        ttk.Radiobutton(control_frame, text="文字水印", variable=self.watermark_type,
+                        value="text", command=self.update_watermark).pack()
+        custom_radio = ttk.Radiobutton(control_frame, text="自定义图片", variable=self.watermark_type,
+                                       value="custom", command=self.load_custom_watermark)
+        custom_radio.pack()
+
+        # 文字水印设置
+        self.text_frame = ttk.LabelFrame(control_frame, text="文字水印设置")
+        ttk.Label(self.text_frame, text="请输入文字:").pack(fill=tk.X, pady=2)
+        
+        # 创建文字输入框和确认按钮的容器
+        text_input_frame = ttk.Frame(self.text_frame)
+        text_input_frame.pack(fill=tk.X, pady=2)
+        
+        # 文字输入框
+        ttk.Entry(text_input_frame, textvariable=self.text_content).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
+        # 确认按钮
+        ttk.Button(text_input_frame, text="确认", command=self.update_watermark).pack(side=tk.LEFT, padx=5)
+     
+
+        # 添加文字颜色选择
+        ttk.Label(self.text_frame, text="文字颜色:").pack(fill=tk.X, pady=2)
+        color_frame = ttk.Frame(self.text_frame)
+        color_frame.pack(fill=tk.X, pady=2)
+        ttk.Radiobutton(color_frame, text="白色", variable=self.text_color,
+                        value="white", command=self.update_watermark).pack(side=tk.LEFT)
+        ttk.Radiobutton(color_frame, text="黑色", variable=self.text_color,
+                        value="black", command=self.update_watermark).pack(side=tk.LEFT)
+
+        # 初始隐藏文字水印设置
+        self.text_frame.pack_forget()
+
+        # 位置选择
+        position_frame = ttk.LabelFrame(control_frame, text="位置设置")
+        position_frame.pack(fill=tk.X, pady=5, padx=5)
+        positions = list(POSITIONS)
+        position_combo = ttk.Combobox(position_frame, textvariable=self.position,
+                                      values=positions, state="readonly")
+        position_combo.pack(fill=tk.X, pady=5)
+        position_combo.bind('<<ComboboxSelected>>', lambda _: self.update_watermark())
+
+        # 平铺设置（选择平铺时显示）
+        self.tile_frame = ttk.Frame(position_frame)
+        ttk.Label(self.tile_frame, text="间距:").pack(fill=tk.X)
+        ttk.Scale(self.tile_frame, from_=0, to=3, variable=self.tile_spacing,
+                  orient=tk.HORIZONTAL, command=lambda _: self.schedule_preview()).pack(fill=tk.X)
+        ttk.Label(self.tile_frame, text="角度:").pack(fill=tk.X)
+        ttk.Scale(self.tile_frame, from_=-90, to=90, variable=self.tile_angle,
+                  orient=tk.HORIZONTAL, command=lambda _: self.schedule_preview()).pack(fill=tk.X)
+        ttk.Checkbutton(self.tile_frame, text="隔行错开", variable=self.tile_stagger,
+                        command=self.update_watermark).pack(anchor=tk.W)
+
+        # 透明度调整
+        ttk.Label(control_frame, text="透明度:").pack(pady=5)
+        ttk.Scale(control_frame, from_=0, to=1, variable=self.opacity,
+                  orient=tk.HORIZONTAL, command=lambda _: self.schedule_preview()).pack(fill=tk.X)
+
+        # 大小调整
+        ttk.Label(control_frame, text="大小:").pack(pady=5)
+        ttk.Scale(control_frame, from_=0.1, to=2.0, variable=self.size_scale,
+                  orient=tk.HORIZONTAL, command=lambda _: self.schedule_preview()).pack(fill=tk.X)
+
+        # 输出格式
+        ttk.Label(control_frame, text="输出格式:").pack(pady=5)
+        ttk.Combobox(control_frame, textvariable=self.output_profile,
+                     values=list(PROFILES), state="readonly").pack(fill=tk.X)
+
+        # 按钮区域
+        button_frame = ttk.Frame(control_frame)
+        button_frame.pack(fill=tk.X, pady=10)
+        ttk.Button(button_frame, text="选择图片", command=self.load_image).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="批量处理", command=self.batch_process).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="保存", command=self.save_image).pack(side=tk.LEFT, padx=5)
+
+        # 预览区域
+        preview_frame = ttk.LabelFrame(main_frame, text="预览")
+        preview_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True, padx=5, pady=5)
+        self.preview_label = ttk.Label(preview_frame)
+        self.preview_label.pack(fill=tk.BOTH, expand=True)
+
+    def update_watermark(self):
+        """更新水印预览"""
+        # 显示/隐藏文字水印设置框
+        if self.watermark_type.get() == "text":
+            self.text_frame.pack(fill=tk.X, pady=5, after=self.text_frame.master.children['!radiobutton3'])
+        else:
+            self.text_frame.pack_forget()
+        if self.position.get() == TILED:
+            self.tile_frame.pack(fill=tk.X, pady=2)
+        else:
+            self.tile_frame.pack_forget()
+
+        if self.preview_source:
+            try:
+                # 在预览尺寸的图片上渲染，水印按原图尺寸等比缩小
+                result = self.get_renderer().render(self.preview_source,
+                                                    reference_size=self.source_size)
+                # 更新预览
+                self.update_preview(result)
+
+            except Exception as e:
+                print(f"更新水印失败: {str(e)}")
+                traceback.print_exc()
+
+    def schedule_preview(self):
+        """合并连续的滑块事件，只渲染最新的设置"""
+        if self._preview_job is None:
+            self._preview_job = self.master.after(PREVIEW_DELAY_MS, self._run_scheduled_preview)
+
+    def _run_scheduled_preview(self):
+        self._preview_job = None
+        self.update_watermark()
+
+    def get_settings(self):
+        """从界面变量生成水印设置"""
+        return WatermarkSettings(
+            watermark_type=self.watermark_type.get(),
+            text=self.text_content.get(),
+            text_color=self.text_color.get(),
+            position=self.position.get(),
+            opacity=self.opacity.get(),
+            size_scale=self.size_scale.get(),
+            tile_spacing=self.tile_spacing.get(),
+            tile_angle=self.tile_angle.get(),
+            tile_stagger=self.tile_stagger.get(),
+        )
+
+    def get_renderer(self):
+        """按当前设置创建渲染器"""
+        return WatermarkRenderer(self.get_settings(), self.get_watermark())
+
+    def get_watermark(self):
+        """获取水印图像（文字水印返回 None）"""
+        watermark_type = self.watermark_type.get()
+        if watermark_type == "default":
+            return self.create_default_watermark()
+        elif watermark_type == "custom":
+            return self.watermark_image
+        return None
+
+    def create_default_watermark(self):
+        """创建默认水印，第一次调用时加载并保存"""
+        try:
+            if self.default_watermark is None:
+                # 如果没有找到默认水印图片，使用文字水印作为备选
+                self.default_watermark = load_default_watermark() or create_fallback_watermark()
+            return self.default_watermark
+        except Exception as e:
+            print(f"创建默认水印失败: {str(e)}")
+            traceback.print_exc()
+            return None
+
+    def open_image(self, path, preview=None):
+        """切换当前图片，只解码预览尺寸的图片
+
+        preview 为已经解码好的 (预览图, 原图尺寸)，例如预读缓存中的结果。
+        """
+        if path is None:
+            self.preview_source = None
+            self.source_size = None
+        else:
+            self.preview_source, self.source_size = preview or load_preview_image(path)
+        self.current_image_path = path
+
+    def update_preview(self, image):
+        """更新预览图像"""
+        if image:
+            try:
+                # 确保预览图片是RGB模式
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+
+                # 更新预览
+                if hasattr(self, 'current_preview'):
+                    del self.current_preview
+                self.current_preview = ImageTk.PhotoImage(image)
+                self.preview_label.configure(image=self.current_preview)
+                self.preview_label.image = self.current_preview
+
+            except Exception as e:
+                print(f"更新预览失败: {str(e)}")
+                traceback.print_exc()
+
+    def load_image(self):
+        """加载原始图片"""
+        file_path = filedialog.askopenfilename(
+            filetypes=[
+                ("图片文件", "*.png *.jpg *.jpeg *.bmp *.gif *.tif *.tiff *.webp"),
+                ("所有文件", "*.*")
+            ]
+        )
+        if file_path:
+            try:
+                # 只解码预览需要的尺寸，保存时再完整解码
+                self.open_image(file_path)
+                self.update_watermark()
+            except Exception as e:
+                messagebox.showerror("错误", f"加载图片失败: {str(e)}")
+                print(f"加载图片失败: {str(e)}")
+                traceback.print_exc()
+
+    def batch_process(self):
+        """批量处理文件夹中的图片"""
+        folder_path = filedialog.askdirectory(title="选择要处理的文件夹")
+        if not folder_path:
+            return
+
+        try:
+            # 获取所有支持的图片文件（修改文件搜索逻辑，避免重复）
+            extensions = SUPPORTED_EXTENSIONS
+            self.image_files = []
+            for file in os.listdir(folder_path):
+                if file.lower().endswith(extensions):
+                    full_path = os.path.join(folder_path, file)
+                    if os.path.isfile(full_path):  # 确保是文件而不是文件夹
+                        self.image_files.append(full_path)
+
+            if not self.image_files:
+                messagebox.showwarning("警告", "所选文件夹中没有找到支持的图片文件")
+                return
+
+            # 排序文件列表，确保顺序一致
+            self.image_files.sort()
+
+            # 后台预读相邻图片
+            if self.prefetcher is not None:
+                self.prefetcher.close()
+            self.prefetcher = PreviewPrefetcher(self.image_files, window=PREFETCH_WINDOW,
+                                                max_memory_mb=PREFETCH_MEMORY_MB)
+
+            # 初始化批量处理状态
+            self.current_index = 0
+            self.is_batch_mode = True
+            
+            # 添加导航按钮到现有界面
+            if not hasattr(self, 'nav_frame'):
+                self.nav_frame = ttk.Frame(self.master)
+                self.nav_frame.pack(fill=tk.X, pady=5, padx=10)
+                
+                # 添加信息标签
+                self.info_label = ttk.Label(self.nav_frame, text="")
+                self.info_label.pack(side=tk.LEFT, padx=5)
+                
+                # 添加导航按钮
+                self.prev_btn = ttk.Button(self.nav_frame, text="上一张", command=self.prev_image)
+                self.prev_btn.pack(side=tk.LEFT, padx=5)
+                
+                self.next_btn = ttk.Button(self.nav_frame, text="下一张", command=self.next_image)
+                self.next_btn.pack(side=tk.LEFT, padx=5)
+                
+                self.process_btn = ttk.Button(self.nav_frame, text="开始处理", command=self.process_all_images)
+                self.process_btn.pack(side=tk.RIGHT, padx=5)
+                
+                self.cancel_btn = ttk.Button(self.nav_frame, text="取消批量", command=self.cancel_batch)
+                self.cancel_btn.pack(side=tk.RIGHT, padx=5)
+
+                # 并行处理的进程数
+                ttk.Spinbox(self.nav_frame, from_=1, to=default_workers() * 2, width=4,
+                            textvariable=self.batch_workers).pack(side=tk.RIGHT, padx=5)
+                ttk.Label(self.nav_frame, text="进程数:").pack(side=tk.RIGHT)
+
+                ttk.Checkbutton(self.nav_frame, text="全部重新处理",
+                                variable=self.batch_force).pack(side=tk.RIGHT, padx=5)
+            else:
+                # 如果已经存在导航框架，更新它的显示
+                self.nav_frame.pack(fill=tk.X, pady=5, padx=10)
+            
+            # 显示第一张图片
+            self.show_current_image()
+            
+        except Exception as e:
+            messagebox.showerror("错误", f"预览失败：{str(e)}")
+            print(f"预览失败: {str(e)}")
+            traceback.print_exc()
+
+    def show_current_image(self):
+        """显示当前索引的图片"""
+        try:
+            # 更新信息标签
+            total_images = len(self.image_files)
+            current_file = os.path.basename(self.image_files[self.current_index])
+            self.info_label.config(text=f"图片 {self.current_index + 1}/{total_images}: {current_file}")
+            
+            # 加载并显示图片（优先使用预读的结果）
+            preview = self.prefetcher.get(self.current_index)
+            self.open_image(self.image_files[self.current_index], preview)
+            self.prefetcher.update(self.current_index)
+            
+            # 使用现有的更新水印方法
+            self.update_watermark()
+            
+            # 更新导航按钮状态
+            self.prev_btn['state'] = 'normal' if self.current_index > 0 else 'disabled'
+            self.next_btn['state'] = 'normal' if self.current_index < total_images - 1 else 'disabled'
+            
+        except Exception as e:
+            print(f"显示图片失败: {str(e)}")
+            traceback.print_exc()
+
+    def prev_image(self):
+        """显示上一张图片"""
+        if self.current_index > 0:
+            self.current_index -= 1
+            self.show_current_image()
+
+    def next_image(self):
+        """显示下一张图片"""
+        if self.current_index < len(self.image_files) - 1:
+            self.current_index += 1
+            self.show_current_image()
+
+    def cancel_batch(self):
+        """取消批量处理模式"""
+        self.is_batch_mode = False
+        self.nav_frame.pack_forget()
+        self.open_image(None)
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+            self.prefetcher = None
+        self.preview_label.configure(image='')
+
+    def process_all_images(self):
+        """开始批量处理所有图片"""
+        if messagebox.askyesno("确认", "是否开始处理所有图片？"):
+            try:
+                folder_path = os.path.dirname(self.image_files[0])
+                watermark_dir = os.path.join(folder_path, "watermark")
+                
+                # 显示进度条
+                progress_window = tk.Toplevel(self.master)
+                progress_window.title("处理进度")
+                progress_window.geometry("320x260")
+                progress_window.transient(self.master)
+                
+                progress_label = ttk.Label(progress_window, text="正在处理...")
+                progress_label.pack(pady=10)
+                
+                progress_bar = ttk.Progressbar(progress_window, length=200, mode='determinate')
+                progress_bar.pack(pady=10)
+
+                # 吞吐和各阶段耗时的中位数
+                stats_label = ttk.Label(progress_window, text="", justify=tk.LEFT)
+                stats_label.pack(pady=5)
+
+                try:
+                    workers = max(1, self.batch_workers.get())
+                except tk.TclError:
+                    workers = default_workers()
+
+                # 后台线程驱动进程池，结果通过队列交给界面线程
+                self.batch_state = {
+                    'queue': queue.Queue(),
+                    'total': len(self.image_files),
+                    'done': 0,
+                    'metrics': BatchMetrics(),
+                    'stats_updated': 0.0,
+                    'watermark_dir': watermark_dir,
+                    'window': progress_window,
+                    'label': progress_label,
+                    'bar': progress_bar,
+                    'stats': stats_label,
+                }
+                self.process_btn['state'] = 'disabled'
+                threading.Thread(
+                    target=self.run_batch,
+                    args=(list(self.image_files), watermark_dir, self.get_settings(),
+                          self.get_watermark(), workers, self.output_profile.get(),
+                          self.batch_force.get(), self.batch_state['queue']),
+                    daemon=True,
+                ).start()
+                self.master.after(50, self.poll_batch)
+                
+            except Exception as e:
+                messagebox.showerror("错误", f"批量处理失败：{str(e)}")
+                print(f"批量处理失败: {str(e)}")
+                traceback.print_exc()
+
+    def run_batch(self, image_files, watermark_dir, settings, watermark, workers, profile, force,
+                  result_queue):
+        """在后台线程中运行批量处理（不能访问界面）"""
+        try:
+            # 处理记录保存在输出文件夹中，再次处理时跳过没有变化的图片；
+            # force 为 True 时全部重新处理，并更新处理记录
+            os.makedirs(watermark_dir, exist_ok=True)
+            with Manifest(os.path.join(watermark_dir, MANIFEST_FILENAME), force=force) as manifest:
+                for result in iter_batch(image_files, watermark_dir, settings, watermark, workers,
+                                         manifest=manifest, profile=profile):
+                    result_queue.put(('result', result))
+            result_queue.put(('finished', None))
+        except Exception as e:
+            traceback.print_exc()
+            result_queue.put(('failed', e))
+
+    def poll_batch(self):
+        """在界面线程中读取批量处理的进度"""
+        state = self.batch_state
+        while True:
+            try:
+                kind, payload = state['queue'].get_nowait()
+            except queue.Empty:
+                break
+
+            if kind == 'result':
+                state['done'] += 1
+                state['metrics'].add(payload)
+                state['bar']['value'] = (state['done'] / state['total']) * 100
+                state['label']['text'] = f"已处理: {os.path.basename(payload.image_path)}\n{state['done']}/{state['total']}"
+            else:
+                self.finish_batch(payload if kind == 'failed' else None)
+                return
+
+        # 统计每半秒刷新一次
+        now = time.perf_counter()
+        if now - state['stats_updated'] >= 0.5 and state['metrics'].processed:
+            state['stats_updated'] = now
+            state['stats']['text'] = "\n".join(state['metrics'].format_lines(brief=True))
+        self.master.after(50, self.poll_batch)
+
+    def finish_batch(self, error=None):
+        """批量处理结束后的收尾工作"""
+        state = self.batch_state
+        state['window'].destroy()
+        self.process_btn['state'] = 'normal'
+        self.batch_state = None
+
+        metrics = state['metrics']
+        metrics.finish()
+        try:
+            metrics.write_log(os.path.join(state['watermark_dir'], BATCH_LOG_FILENAME))
+        except OSError as e:
+            print(f"写入批量处理日志失败: {str(e)}")
+
+        if error is not None:
+            messagebox.showerror("错误", f"批量处理失败：{str(error)}")
+            return
+
+        self.cancel_batch()  # 处理完成后退出批量模式
+        if metrics.processed > 0 or metrics.skipped > 0:
+            messagebox.showinfo("完成", f"批量处理完成！\n成功处理 {metrics.processed} 个文件"
+                                        f"（共 {metrics.bytes_written / 1024 / 1024:.1f} MB，"
+                                        f"{metrics.images_per_sec:.1f} 张/秒）\n"
+                                        f"跳过 {metrics.skipped} 个没有变化的文件\n"
+                                        f"保存在 {state['watermark_dir']} 文件夹中，"
+                                        f"各阶段耗时见 {BATCH_LOG_FILENAME}")
+        else:
+            messagebox.showwarning("警告", "没有成功处理任何图片！")
+                
+    def load_custom_watermark(self):
+        """加载自定义水印图片"""
+        file_path = filedialog.askopenfilename(
+            filetypes=[
+                ("PNG图片", "*.png"),
+                ("所有文件", "*.*")
+            ]
+        )
+        if file_path:
+            try:
+                self.watermark_image = load_watermark_image(file_path)
+                self.watermark_type.set("custom")
+                self.update_watermark()
+            except Exception as e:
+                messagebox.showerror("错误", f"加载水印图片失败: {str(e)}")
+                print(f"加载水印图片失败: {str(e)}")
+                traceback.print_exc()
+
+    def save_image(self):
+        """保存添加水印后的图片"""
+        if not self.current_image_path:
+            messagebox.showwarning("警告", "请先选择原图")
+            return
+
+        try:
+            # 获取原图路径的目录
+            original_dir = os.path.dirname(self.current_image_path)
+            # 创建水印文件夹
+            watermark_dir = os.path.join(original_dir, "watermark")
+            if not os.path.exists(watermark_dir):
+                os.makedirs(watermark_dir)
+            
+            # 生成新文件名（扩展名由输出格式决定）
+            profile = self.output_profile.get()
+            file_path = output_path_for(self.current_image_path, watermark_dir, profile)
+            
+            # 动图输出为 GIF/WebP 时逐帧加水印
+            resolved = get_profile(profile).resolve(self.current_image_path)
+            encoded = encode_animated_file(self.current_image_path, self.get_renderer(), resolved)
+            if encoded is None:
+                # 每次保存时重新解码原图，直接在上面加水印，不额外复制整张图片
+                image = load_source_image(self.current_image_path, resolved.format)
+                image = self.get_renderer().render(image, copy=False)
+                encoded = encode_image(image, profile, self.current_image_path)
+                del image
+
+            # 保存图片
+            write_encoded(encoded, file_path)
+            messagebox.showinfo("成功", f"图片保存成功！保存在 {file_path}\n"
+                                        f"大小 {encoded.size / 1024:.0f} KB，编码耗时 {encoded.encode_time * 1000:.0f} ms")
+
+        except Exception as e:
+            messagebox.showerror("错误", f"保存图片失败：{str(e)}")
+            print(f"保存图片失败: {str(e)}")
+            traceback.print_exc()
+
+def main():
+    root = tk.Tk()
+    app = WatermarkApp(root)
+    root.mainloop()
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""批量处理记录
+
+在输出文件夹中用 SQLite 记录每个原图处理时的大小、修改时间（可选内容
+哈希）、水印设置的哈希和输出路径。再次处理时跳过没有变化的文件，
+中途中断后重新运行会从中断的地方继续。一次输出多个方案时，每个方案
+分别记录（记录的键为 原图路径#方案名称）。
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from dataclasses import asdict
+
+from watermark_core import watermark_identity
+
+
+MANIFEST_FILENAME = '.watermark_manifest.sqlite'
+# 攒够这么多条记录或间隔这么多秒提交一次
+COMMIT_EVERY = 100
+COMMIT_INTERVAL = 2.0
+
+
+def settings_hash(settings, watermark=None, **extra):
+    """水印设置、水印图片内容以及其他输出参数的哈希"""
+    data = {'settings': asdict(settings), 'extra': extra}
+    if watermark is not None:
+        data['watermark'] = watermark_identity(watermark)
+    return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def manifest_key(image_path, preset=None):
+    """记录的键：原图的绝对路径，输出多个方案时再加上方案名称
+
+    原图都以图片扩展名结尾，加上方案名称后不会和其他原图的键重复。
+    """
+    key = os.path.abspath(image_path)
+    return key if preset is None else f"{key}#{preset}"
+
+
+def file_hash(path):
+    """文件内容的哈希"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """处理记录，可以在多个线程中使用
+
+    use_hash 为 True 时，修改时间变了但内容相同的文件也会跳过；
+    force 为 True 时忽略已有记录全部重新处理（仍然更新记录）。
+    """
+
+    def __init__(self, path, use_hash=False, force=False):
+        self.path = path
+        self.use_hash = use_hash
+        self.force = force
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            " input_path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER,"
+            " content_hash TEXT, settings_hash TEXT, output_path TEXT, processed_at REAL)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+        # 启动时一次性读入，之后查询不访问数据库
+        self._rows = {row[0]: row[1:] for row in self._conn.execute(
+            "SELECT input_path, size, mtime_ns, content_hash, settings_hash, output_path FROM files")}
+        # 记录过的输出文件（绝对路径），输出和原图在同一个文件夹时用来区分
+        self._outputs = {os.path.abspath(row[4]) for row in self._rows.values() if row[4]}
+        # 已经检查过、等待处理的文件的签名
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._rows)
+
+    def is_output(self, path):
+        """path 是否为记录过的输出文件"""
+        with self._lock:
+            return os.path.abspath(path) in self._outputs
+
+    def needs_processing(self, image_path, settings_digest, output_path, preset=None):
+        """原图、设置或输出有变化时返回 True；preset 为方案名称"""
+        key = manifest_key(image_path, preset)
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return True
+        signature = [stat.st_size, stat.st_mtime_ns, None]
+
+        with self._lock:
+            row = self._rows.get(key)
+        current = (not self.force and row is not None and row[3] == settings_digest and row[4] == output_path
+                   and os.path.exists(output_path))
+        if current and (row[0], row[1]) == (signature[0], signature[1]):
+            return False
+
+        if self.use_hash:
+            signature[2] = file_hash(image_path)
+            if current and row[2] == signature[2]:
+                # 只是修改时间变了，内容相同
+                self._store(key, signature, settings_digest, output_path)
+                return False
+
+        with self._lock:
+            self._pending[key] = signature
+        return True
+
+    def record(self, result, settings_digest):
+        """记录处理成功的文件"""
+        key = manifest_key(result.image_path, result.preset)
+        with self._lock:
+            signature = self._pending.pop(key, None)
+        if not result.ok:
+            return
+        if signature is None:
+            stat = os.stat(result.image_path)
+            signature = [stat.st_size, stat.st_mtime_ns, None]
+        self._store(key, signature, settings_digest, result.output_path)
+
+    def _store(self, key, signature, settings_digest, output_path):
+        size, mtime_ns, content_hash = signature
+        with self._lock:
+            self._rows[key] = (size, mtime_ns, content_hash, settings_digest, output_path)
+            if output_path:
+                self._outputs.add(os.path.abspath(output_path))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, size, mtime_ns, content_hash, settings_digest, output_path, time.time()))
+            self._uncommitted += 1
+            if (self._uncommitted >= COMMIT_EVERY
+                    or time.monotonic() - self._last_commit >= COMMIT_INTERVAL):
+                self._commit()
+
+    def _commit(self):
+        self._conn.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
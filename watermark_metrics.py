@@ -0,0 +1,318 @@
+"""批量处理的分阶段计时和统计
+
+StageTimer 记录一张图片在各阶段（读取、解码、模式转换、水印图块、合成、编码、
+写入）花费的时间，随 FileResult 从工作进程返回。BatchMetrics 汇总整批
+结果，计算吞吐、各阶段的 p50/p95/p99 和水印图块缓存的命中率；每个文件的记录可以写成 JSON lines，
+方便用其他工具分析。MemoryPeak 读取进程的内存峰值，需要时测量处理一张图片
+多用了多少内存（只支持 Linux）。
+"""
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+# 按处理顺序排列的阶段名称
+STAGES = ('read', 'decode', 'convert', 'resize', 'overlay', 'composite', 'encode', 'write')
+STAGE_NAMES = {
+    'read': '读取',
+    'decode': '解码',
+    'convert': '模式转换',
+    'resize': '缩小尺寸',
+    'overlay': '字体/水印图块',
+    'composite': '合成',
+    'encode': '编码',
+    'write': '写入',
+}
+SUMMARY_PERCENTILES = (50, 95, 99)
+# 图形界面批量处理时，汇总追加到输出文件夹中的这个日志
+BATCH_LOG_FILENAME = 'watermark_batch.log'
+# Linux 下进程的内存峰值（VmHWM），向 clear_refs 写入 5 可以把它重置为当前占用
+PROC_STATUS = '/proc/self/status'
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+
+class StageTimer:
+    """累计每个阶段的耗时（秒），同一阶段多次计时会相加"""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+
+def read_memory_status(key):
+    """读取 /proc/self/status 中的内存项（字节），不支持时返回 None"""
+    try:
+        with open(PROC_STATUS, encoding='ascii') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _load_malloc_trim():
+    """glibc 的 malloc_trim，其他 C 库返回 None"""
+    # ctypes.util 会导入 subprocess 等模块，第一次用到时才导入
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+        return libc.malloc_trim
+    except (OSError, AttributeError):
+        return None
+
+
+_malloc_trim = None
+
+
+def release_free_memory():
+    """把 C 库中已经释放的内存还给系统（只支持 glibc）
+
+    大图的像素缓冲释放后常常留在进程的堆里，不做这一步时常驻内存只增不减，
+    内存峰值也测不出下一张图片实际用了多少。
+    """
+    global _malloc_trim
+    if _malloc_trim is None:
+        _malloc_trim = _load_malloc_trim() or False
+    if _malloc_trim:
+        _malloc_trim(0)
+
+
+class MemoryPeak:
+    """读取进程常驻内存（RSS）的峰值，measure 为 True 时测量一段代码多用的内存
+
+    只支持 Linux，其他系统上 high 和 peak 都为 None。结束时 high 为进程的
+    VmHWM（字节），只读一次 /proc，几乎没有开销。
+    measure 为 True 时开始前先把空闲内存还给系统，并把 VmHWM 重置为当前占用，
+    结束时 peak 为 VmHWM 减去开始时的占用；这两步每次要整理整个堆，处理
+    大量图片时会明显降低吞吐，只在需要单张图片的内存峰值时使用。
+    测量的是整个进程，同一进程中其他线程同时分配的内存也会算在内。
+    """
+
+    def __init__(self, measure=False):
+        self.measure = measure
+        self.high = None
+        self.peak = None
+        self._baseline = None
+
+    def __enter__(self):
+        if not self.measure:
+            return self
+        release_free_memory()
+        try:
+            with open(PROC_CLEAR_REFS, 'w') as f:
+                f.write('5')
+        except OSError:
+            return self
+        self._baseline = read_memory_status('VmRSS')
+        return self
+
+    def __exit__(self, *exc_info):
+        self.high = read_memory_status('VmHWM')
+        if self._baseline is not None and self.high is not None:
+            self.peak = max(0, self.high - self._baseline)
+
+
+def percentile(values, p):
+    """最近秩法的分位数，values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def result_record(result):
+    """单个文件的记录（可以直接写成 JSON）"""
+    return {
+        'type': 'file',
+        'input': result.image_path,
+        'preset': result.preset,
+        'output': result.output_path,
+        'status': 'skipped' if result.skipped else ('ok' if result.ok else 'error'),
+        'error': result.error,
+        'error_type': result.error_type,
+        'width': result.width,
+        'height': result.height,
+        'bytes_in': result.bytes_read,
+        'bytes_out': result.bytes_written,
+        'peak_memory': result.peak_memory,
+        'process_peak_memory': result.process_peak_memory,
+        'overlay_hits': result.overlay_hits,
+        'overlay_misses': result.overlay_misses,
+        'stages_ms': {name: round(seconds * 1000, 3) for name, seconds in result.timings.items()},
+    }
+
+
+class BatchMetrics:
+    """汇总一批 FileResult，可以在处理过程中随时取得统计"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.processed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stages = {}
+        self.errors = {}
+        # 每张图片的内存峰值（字节），不支持统计时为空
+        self.peak_memory = []
+        # 处理这批图片的进程中最大的内存峰值（字节）
+        self.process_peak_memory = None
+        # 水印图块缓存的命中、未命中次数（所有工作进程合计）
+        self.overlay_hits = 0
+        self.overlay_misses = 0
+
+    def add(self, result):
+        if result.skipped:
+            self.skipped += 1
+            return
+        self.overlay_hits += result.overlay_hits
+        self.overlay_misses += result.overlay_misses
+        if not result.ok:
+            self.failed += 1
+            key = result.error_type or 'Error'
+            self.errors[key] = self.errors.get(key, 0) + 1
+            return
+        self.processed += 1
+        self.bytes_read += result.bytes_read
+        self.bytes_written += result.bytes_written
+        for name, seconds in result.timings.items():
+            self.stages.setdefault(name, []).append(seconds)
+        if result.peak_memory is not None:
+            self.peak_memory.append(result.peak_memory)
+        if result.process_peak_memory is not None:
+            self.process_peak_memory = max(self.process_peak_memory or 0, result.process_peak_memory)
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.perf_counter()) - self.started
+
+    @property
+    def images_per_sec(self):
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else 0.0
+
+    def stage_summary(self):
+        """{阶段: {'p50': 毫秒, ..., 'total': 毫秒}}，按 STAGES 的顺序"""
+        names = [name for name in STAGES if name in self.stages]
+        names += sorted(set(self.stages) - set(STAGES))
+        summary = {}
+        for name in names:
+            values = self.stages[name]
+            row = {f'p{p}': round(percentile(values, p) * 1000, 3) for p in SUMMARY_PERCENTILES}
+            row['total'] = round(sum(values) * 1000, 3)
+            summary[name] = row
+        return summary
+
+    def memory_summary(self):
+        """单张图片内存峰值的 p50/p95/最大值（MB），没有数据时返回 None"""
+        if not self.peak_memory:
+            return None
+        summary = {f'p{p}': round(percentile(self.peak_memory, p) / 1024 / 1024, 1)
+                   for p in SUMMARY_PERCENTILES[:2]}
+        summary['max'] = round(max(self.peak_memory) / 1024 / 1024, 1)
+        return summary
+
+    def cache_summary(self):
+        """水印图块缓存的命中、未命中次数和命中率，没有用到缓存时返回 None"""
+        total = self.overlay_hits + self.overlay_misses
+        if not total:
+            return None
+        return {'hits': self.overlay_hits, 'misses': self.overlay_misses,
+                'hit_rate': round(self.overlay_hits / total, 4)}
+
+    def summary(self):
+        """整批的统计（可以直接写成 JSON）"""
+        return {
+            'type': 'summary',
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'errors': dict(self.errors),
+            'elapsed_s': round(self.elapsed, 3),
+            'images_per_sec': round(self.images_per_sec, 3),
+            'bytes_in': self.bytes_read,
+            'bytes_out': self.bytes_written,
+            'stages_ms': self.stage_summary(),
+            'peak_memory_mb': self.memory_summary(),
+            'process_peak_memory_mb': (round(self.process_peak_memory / 1024 / 1024, 1)
+                                       if self.process_peak_memory is not None else None),
+            'overlay_cache': self.cache_summary(),
+        }
+
+    def format_lines(self, brief=False):
+        """可读的统计文字；brief 为 True 时只显示各阶段的 p50，用于进度窗口"""
+        lines = [f"{self.images_per_sec:.2f} 张/秒，读取 {self.bytes_read / 1024 / 1024:.1f} MB，"
+                 f"写入 {self.bytes_written / 1024 / 1024:.1f} MB"]
+        for name, row in self.stage_summary().items():
+            label = STAGE_NAMES.get(name, name)
+            if brief:
+                lines.append(f"{label} {row['p50']:.1f} ms")
+            else:
+                lines.append(f"{label}：p50 {row['p50']:.1f} ms，p95 {row['p95']:.1f} ms，"
+                             f"p99 {row['p99']:.1f} ms")
+        memory = self.memory_summary()
+        if memory and not brief:
+            lines.append(f"单张内存峰值：p50 {memory['p50']:.1f} MB，p95 {memory['p95']:.1f} MB，"
+                         f"最大 {memory['max']:.1f} MB")
+        if self.process_peak_memory is not None and not brief:
+            lines.append(f"进程内存峰值：{self.process_peak_memory / 1024 / 1024:.1f} MB")
+        cache = self.cache_summary()
+        if cache and not brief:
+            lines.append(f"水印图块缓存：命中 {cache['hits']} 次，未命中 {cache['misses']} 次，"
+                         f"命中率 {cache['hit_rate'] * 100:.1f}%")
+        if self.errors and not brief:
+            lines.append("失败原因：" + "，".join(f"{key} {count} 个" for key, count in self.errors.items()))
+        return lines
+
+    def write_log(self, path, title=None):
+        """把统计追加到日志文件"""
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S')
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(f"[{stamp}] {title or '批量处理'}：成功 {self.processed} 个，"
+                    f"跳过 {self.skipped} 个，失败 {self.failed} 个，耗时 {self.elapsed:.1f} 秒\n")
+            for line in self.format_lines():
+                f.write(f"    {line}\n")
+
+
+class JsonLinesWriter:
+    """逐行写入 JSON 记录，可以在多个线程中使用"""
+
+    def __init__(self, path):
+        self._file = open(path, 'a', encoding='utf-8')
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + '\n')
+            # 监视模式会长时间运行，每条记录都立即写出
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
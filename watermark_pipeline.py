@@ -0,0 +1,216 @@
+"""批量处理的读取/计算/写入流水线
+
+读取、计算、写入分开进行：读取线程提前把原图的字节读进内存（受内存预算
+限制），工作进程只负责解码、加水印和编码，编码好的数据交给写入线程保存。
+磁盘读写和 CPU 计算同时进行，在网络盘或机械硬盘上不会互相等待。
+"""
+import os
+import time
+import queue
+import threading
+import traceback
+from dataclasses import dataclass
+
+from watermark_encoders import write_encoded
+
+
+# 预读的原图最多占用的内存
+READ_AHEAD_MB = 256
+# 等待写入的文件数上限，写入跟不上时计算会暂停
+WRITE_QUEUE_SIZE = 16
+# 没有新结果时，每隔这么多秒检查一次写入完成的文件
+RESULT_POLL_INTERVAL = 0.05
+
+
+@dataclass
+class BatchTask:
+    """一个待处理的文件；data 为预读的原图，为空时由工作进程自己读取"""
+    image_path: str
+    save_path: str
+    data: bytes = None
+    # 预读耗时（秒）
+    read_time: float = 0.0
+    # 一次解码输出多个方案时，每个方案的 (序号, 输出路径)；save_path 为第一个方案的路径
+    variants: tuple = ()
+
+    @property
+    def prefetched_size(self):
+        return len(self.data) if self.data is not None else 0
+
+
+class ByteBudget:
+    """限制同时在内存中的预读字节数，可以在多个线程中使用"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def acquire(self, size):
+        """等到有足够的预算；关闭后返回 False"""
+        with self._cond:
+            # 没有其他预读时总是允许，单个文件不会一直等下去
+            while not self.closed and self.used and self.used + size > self.limit:
+                self._cond.wait()
+            if self.closed:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size):
+        if not size:
+            return
+        with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+    def close(self):
+        """唤醒所有等待的线程，之后不再预读"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+def read_task(image_path, save_path, budget, max_size=None, variants=()):
+    """预读一个文件，产出 BatchTask
+
+    超过 max_size 或读取失败的文件不预读，留给工作进程处理（分块处理或报告错误）。
+    """
+    try:
+        size = os.path.getsize(image_path)
+    except OSError:
+        return BatchTask(image_path, save_path, variants=variants)
+    if size > budget.limit or (max_size and size > max_size) or not budget.acquire(size):
+        return BatchTask(image_path, save_path, variants=variants)
+    start = time.perf_counter()
+    try:
+        with open(image_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        budget.release(size)
+        return BatchTask(image_path, save_path, variants=variants)
+    # 文件在 stat 之后被修改时，按实际读取的长度记账
+    budget.release(size - len(data))
+    return BatchTask(image_path, save_path, data, time.perf_counter() - start, variants)
+
+
+_END = object()
+
+
+def iter_prefetched(iterable, maxsize, idle_timeout=None):
+    """在后台线程中迭代 iterable，最多提前准备 maxsize 项
+
+    iterable 中的异常会在取到对应位置时重新抛出；提前关闭生成器时后台线程随之退出。
+    idle_timeout 不为空时，等待超过这么多秒会产出 None，调用方可以趁机做别的事。
+    """
+    items = queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except BaseException as e:
+            put((_END, e))
+            return
+        put((_END, None))
+
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            try:
+                item, error = items.get(timeout=idle_timeout)
+            except queue.Empty:
+                yield None
+                continue
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def write_result(result):
+    """保存 FileResult.encoded 中编码好的数据，写入失败时把结果改为失败"""
+    start = time.perf_counter()
+    try:
+        os.makedirs(os.path.dirname(result.output_path) or '.', exist_ok=True)
+        result.bytes_written = write_encoded(result.encoded, result.output_path)
+    except Exception as e:
+        print(f"保存图片失败 {result.output_path}: {str(e)}")
+        traceback.print_exc()
+        result.error = str(e)
+        result.error_type = type(e).__name__
+        result.output_path = None
+    finally:
+        result.encoded = None
+        result.timings['write'] = result.timings.get('write', 0.0) + time.perf_counter() - start
+    return result
+
+
+class AsyncWriter:
+    """在后台线程中保存编码好的图片，保存完成的结果由 completed() 取出
+
+    on_done(result) 在每个结果完成时立即调用（可能在写入线程中），
+    例如更新处理记录，不需要等调用方取出结果。
+    """
+
+    def __init__(self, maxsize=WRITE_QUEUE_SIZE, on_done=None):
+        self.on_done = on_done
+        self._queue = queue.Queue(maxsize)
+        self._done = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            result = self._queue.get()
+            if result is None:
+                return
+            self._finish(write_result(result))
+
+    def _finish(self, result):
+        if self.on_done is not None:
+            try:
+                self.on_done(result)
+            except Exception as e:
+                print(f"记录处理结果失败 {result.image_path}: {str(e)}")
+                traceback.print_exc()
+        self._done.put(result)
+
+    def submit(self, result):
+        """排队写入；没有待写数据的结果（失败、已经写好）直接视为完成
+
+        队列满时等待，写入跟不上时不会无限占用内存。
+        """
+        if result.encoded is None:
+            self._finish(result)
+        else:
+            self._queue.put(result)
+
+    def completed(self):
+        """取出已经完成的结果（不等待）"""
+        while True:
+            try:
+                yield self._done.get_nowait()
+            except queue.Empty:
+                return
+
+    def close(self):
+        """等待排队中的文件全部写完"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
@@ -0,0 +1,83 @@
+"""批量预览的后台预读
+
+在后台线程中解码当前图片前后几张的预览图，切换图片时直接从内存中取。
+缓存按与当前图片的距离淘汰，并限制总内存占用。
+"""
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from watermark_core import load_preview_image
+
+
+def image_nbytes(image):
+    """图片像素占用的字节数"""
+    return image.width * image.height * len(image.getbands())
+
+
+class PreviewPrefetcher:
+    """按索引预读 image_files 中当前图片附近的预览图
+
+    get() 返回 load_preview_image 的结果 (预览图, 原图尺寸)。
+    """
+
+    def __init__(self, image_files, window=2, max_memory_mb=256, workers=2,
+                 loader=load_preview_image):
+        self.image_files = list(image_files)
+        self.window = window
+        self.max_memory = max_memory_mb * 1024 * 1024
+        self.loader = loader
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._futures = OrderedDict()  # 索引 -> Future
+        self._lock = threading.Lock()
+
+    def _submit(self, index):
+        future = self._futures.get(index)
+        if future is None:
+            future = self._executor.submit(self.loader, self.image_files[index])
+            self._futures[index] = future
+        return future
+
+    def get(self, index):
+        """取得指定索引的预览图，没有预读到时等待解码完成"""
+        with self._lock:
+            future = self._submit(index)
+        try:
+            return future.result()
+        except Exception:
+            # 失败的结果不缓存，下次重新读取
+            with self._lock:
+                if self._futures.get(index) is future:
+                    del self._futures[index]
+            raise
+
+    def update(self, index):
+        """以 index 为中心预读相邻的图片，并淘汰窗口外的缓存"""
+        with self._lock:
+            start = max(0, index - self.window)
+            end = min(len(self.image_files), index + self.window + 1)
+
+            # 离当前图片近的优先，距离相同时先预读后面的图片
+            neighbours = sorted(range(start, end), key=lambda i: (abs(i - index), i < index))
+            neighbours = neighbours[:self._entry_limit()]
+
+            keep = set(neighbours)
+            for stale in [i for i in self._futures if i not in keep]:
+                self._futures.pop(stale).cancel()
+            for neighbour in neighbours:
+                self._submit(neighbour)
+
+    def _entry_limit(self):
+        """内存上限内最多能缓存几张预览图（按已解码的预览图估算）"""
+        sizes = [image_nbytes(f.result()[0]) for f in self._futures.values()
+                 if f.done() and not f.cancelled() and f.exception() is None]
+        if not sizes:
+            return len(self.image_files)
+        return max(1, self.max_memory // max(sizes))
+
+    def close(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,531 @@
+"""本地 HTTP 加水印服务
+
+上传后台通过 HTTP 调用，不需要启动图形界面：
+
+    python watermark_server.py --port 8080 -j 4 --watermark logo=logo.png
+
+    POST /watermark?watermark_type=text&text=版权所有&position=右下
+         请求体为原图，返回加好水印的图片；参数同设置文件（WatermarkSettings
+         的字段），另外 watermark=名称 选择预先加载的水印图片，profile=编码方案
+    GET  /metrics   JSON 格式的请求数、延迟分位数、吞吐和各阶段耗时
+    GET  /health
+
+连接默认保持（HTTP/1.1 keep-alive）。图片在固定数量的工作进程中处理，
+水印图片、字体和水印图块在工作进程中一直保持加载；排队的请求超过上限时
+返回 503，请求体超过上限时返回 413。
+"""
+import io
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+import traceback
+import multiprocessing
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import fields, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from PIL import Image, UnidentifiedImageError
+
+from watermark_core import (
+    WatermarkRenderer, WatermarkSettings, convert_for_render, load_settings_file, validate_settings,
+    create_fallback_watermark, load_default_watermark, load_watermark_image,
+)
+from watermark_batch import default_workers
+from watermark_encoders import DEFAULT_PROFILE, PROFILES, encode_image, get_profile
+from watermark_animation import ANIMATED_FORMATS, encode_animation, is_animated
+from watermark_metrics import STAGES, StageTimer, percentile
+
+
+DEFAULT_PORT = 8080
+# 请求体的默认上限（MB）
+DEFAULT_MAX_BODY_MB = 50
+# 同时保持的连接数上限（每个连接占用一个线程），超过时直接返回 503 并关闭
+DEFAULT_MAX_CONNECTIONS = 64
+# 每个工作进程最多排队的请求数
+QUEUE_PER_WORKER = 2
+# 请求在队列和工作进程中最多等待的秒数
+REQUEST_TIMEOUT = 60
+# 保持连接的空闲超时（秒）
+KEEP_ALIVE_TIMEOUT = 30
+# 延迟分位数按最近多少个请求计算，吞吐按最近多少秒计算
+LATENCY_WINDOW = 1000
+THROUGHPUT_WINDOW = 60
+# 每个工作进程缓存的渲染器数量（每种设置一个）
+RENDERER_CACHE_SIZE = 64
+DEFAULT_WATERMARK_NAME = 'default'
+# --settings 文件中 watermark 指定的水印图片，custom 水印的请求没有 watermark= 时使用
+SETTINGS_WATERMARK_NAME = 'settings'
+
+CONTENT_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png', 'GIF': 'image/gif'}
+# 原图格式对应的扩展名，profile=source 时按它选择输出格式
+SOURCE_SUFFIXES = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'GIF': '.gif'}
+
+
+class RequestError(Exception):
+    """可以直接返回给客户端的错误"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def parse_bool(value):
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f"不是布尔值: {value}")
+
+
+def parse_request_settings(query, base, watermark_names):
+    """把查询参数解析成 (设置, 水印名称, 编码方案名称)，参数错误时抛出 RequestError"""
+    known = {field.name: field for field in fields(WatermarkSettings)}
+    params = {name: values[-1] for name, values in parse_qs(query, keep_blank_values=True).items()}
+    watermark_name = params.pop('watermark', None)
+    profile_name = params.pop('profile', None) or DEFAULT_PROFILE
+    overrides = {}
+    try:
+        for name, value in params.items():
+            field = known.get(name)
+            if field is None:
+                raise ValueError(f"未知的参数: {name}")
+            if field.type is bool:
+                overrides[name] = parse_bool(value)
+            elif field.type is float:
+                overrides[name] = float(value)
+            else:
+                overrides[name] = value
+        if watermark_name is not None:
+            overrides.setdefault('watermark_type', 'custom')
+        settings = replace(base, **overrides)
+        validate_settings(settings)
+        get_profile(profile_name)
+    except ValueError as e:
+        raise RequestError(400, str(e))
+
+    if settings.watermark_type == 'custom':
+        if watermark_name is None and SETTINGS_WATERMARK_NAME in watermark_names:
+            watermark_name = SETTINGS_WATERMARK_NAME
+        if watermark_name is None:
+            raise RequestError(400, "custom 水印需要用 watermark=名称 指定预先加载的水印图片")
+        if watermark_name not in watermark_names:
+            raise RequestError(400, f"没有名为 {watermark_name} 的水印（可选: {', '.join(watermark_names)}）")
+    elif settings.watermark_type == 'default':
+        watermark_name = DEFAULT_WATERMARK_NAME
+    else:
+        watermark_name = None
+    return settings, watermark_name, profile_name
+
+
+# 工作进程内预先加载的水印图片和按设置缓存的渲染器，由 _init_worker 创建
+_worker_watermarks = {}
+_worker_renderers = OrderedDict()
+
+
+def _init_worker(watermarks, max_pixels=None):
+    # Ctrl+C 由主进程处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker_watermarks.update(watermarks)
+    if max_pixels:
+        Image.MAX_IMAGE_PIXELS = max_pixels
+    # 启动时就扫描字体，第一个文字水印请求不用等待
+    WatermarkRenderer(WatermarkSettings(watermark_type='text')).warm_up()
+
+
+def _renderer_for(settings, watermark_name):
+    key = (settings, watermark_name)
+    renderer = _worker_renderers.get(key)
+    if renderer is not None:
+        _worker_renderers.move_to_end(key)
+        return renderer
+    renderer = WatermarkRenderer(settings, _worker_watermarks.get(watermark_name))
+    renderer.warm_up()
+    _worker_renderers[key] = renderer
+    while len(_worker_renderers) > RENDERER_CACHE_SIZE:
+        _worker_renderers.popitem(last=False)
+    return renderer
+
+
+def _render_request(data, settings, watermark_name, profile_name):
+    """在工作进程中处理一个请求，返回 (编码后的数据, 格式, 各阶段耗时, 原图尺寸)"""
+    timer = StageTimer()
+    with timer.stage('decode'):
+        image = Image.open(io.BytesIO(data))
+        source_format = image.format
+    size = image.size
+    upload_name = 'upload' + SOURCE_SUFFIXES.get(source_format, '')
+    resolved = get_profile(profile_name).resolve(upload_name)
+    renderer = _renderer_for(settings, watermark_name)
+    if is_animated(image) and resolved.format in ANIMATED_FORMATS:
+        # 动图逐帧加水印，输出 GIF/WebP 动图
+        encoded, = encode_animation(image, [(renderer, resolved, None)], [timer])
+        if isinstance(encoded, Exception):
+            raise encoded
+    else:
+        with timer.stage('decode'):
+            image.load()
+        with timer.stage('convert'):
+            image = convert_for_render(image, resolved.format)
+        image = renderer.render(image, timer=timer, copy=False)
+        encoded = encode_image(image, resolved, upload_name)
+    timer.add('encode', encoded.encode_time)
+    return encoded.data, encoded.format, timer.timings, size
+
+
+class ServiceMetrics:
+    """请求统计，可以在多个线程中使用"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = 0
+        self.in_flight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.status = {}
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._stages = {}
+        self._finished = deque()
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def end(self, status, latency, bytes_in=0, bytes_out=0, timings=None):
+        now = time.time()
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.status[status] = self.status.get(status, 0) + 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            if status == 200:
+                self._latencies.append(latency)
+                self._finished.append(now)
+                for name, seconds in (timings or {}).items():
+                    self._stages.setdefault(name, deque(maxlen=LATENCY_WINDOW)).append(seconds)
+            while self._finished and self._finished[0] < now - THROUGHPUT_WINDOW:
+                self._finished.popleft()
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            latencies = list(self._latencies)
+            stages = {name: list(values) for name, values in self._stages.items()}
+            recent = sum(1 for t in self._finished if t >= now - THROUGHPUT_WINDOW)
+            uptime = now - self.started
+            ok = self.status.get(200, 0)
+            data = {
+                'uptime_s': round(uptime, 1),
+                'requests': self.requests,
+                'in_flight': self.in_flight,
+                'status': {str(code): count for code, count in sorted(self.status.items())},
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+            }
+        data['throughput_rps'] = {
+            f'last_{THROUGHPUT_WINDOW}s': round(recent / min(uptime, THROUGHPUT_WINDOW), 3) if uptime else 0.0,
+            'overall': round(ok / uptime, 3) if uptime else 0.0,
+        }
+        data['latency_ms'] = milliseconds(latencies)
+        names = [name for name in STAGES if name in stages] + sorted(set(stages) - set(STAGES))
+        data['stages_ms'] = {name: milliseconds(stages[name]) for name in names}
+        return data
+
+
+def milliseconds(values):
+    """p50/p95/p99/max（毫秒），values 为空时返回空字典"""
+    if not values:
+        return {}
+    result = {f'p{p}': round(percentile(values, p) * 1000, 3) for p in (50, 95, 99)}
+    result['max'] = round(max(values) * 1000, 3)
+    return result
+
+
+class WatermarkService:
+    """工作进程池和共享状态，请求处理线程通过它提交任务"""
+
+    def __init__(self, base_settings, watermarks, workers, max_body, max_pixels=None):
+        self.base_settings = base_settings
+        self.watermark_names = sorted(watermarks)
+        self.workers = workers
+        self.max_body = max_body
+        self.metrics = ServiceMetrics()
+        self.queue_limit = workers * QUEUE_PER_WORKER
+        self._slots = threading.BoundedSemaphore(self.queue_limit)
+        # 使用 spawn，和批量处理一致
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(workers, initializer=_init_worker,
+                                 initargs=(watermarks, max_pixels))
+
+    def parse(self, query):
+        """解析查询参数，返回 (设置, 水印名称, 编码方案名称)；参数错误时抛出 RequestError"""
+        return parse_request_settings(query, self.base_settings, self.watermark_names)
+
+    @contextmanager
+    def slot(self):
+        """占用一个排队位置，已满时抛出 RequestError(503)
+
+        在读取请求体之前占用：服务繁忙时不必先接收整个上传的图片。
+        """
+        if not self._slots.acquire(blocking=False):
+            raise RequestError(503, "服务繁忙，请稍后重试")
+        try:
+            yield
+        finally:
+            self._slots.release()
+
+    def render(self, data, request):
+        """在工作进程中处理一个请求（调用方应占用着 slot）
+
+        request 为 parse 的结果，返回 (编码后的数据, 格式, 各阶段耗时)；出错时抛出 RequestError。
+        """
+        settings, watermark_name, profile_name = request
+        try:
+            job = self.pool.apply_async(_render_request, (data, settings, watermark_name, profile_name))
+            data, image_format, timings, _ = job.get(REQUEST_TIMEOUT)
+            return data, image_format, timings
+        except multiprocessing.TimeoutError:
+            raise RequestError(503, "处理超时")
+        except UnidentifiedImageError:
+            raise RequestError(415, "无法识别的图片格式")
+        except Image.DecompressionBombError as e:
+            raise RequestError(413, str(e))
+        except (OSError, SyntaxError) as e:
+            # 图片损坏或不完整
+            raise RequestError(400, f"无法处理图片: {str(e)}")
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+class WatermarkRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'WatermarkService/1.0'
+    timeout = KEEP_ALIVE_TIMEOUT
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def send_body(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_body(status, body, 'application/json; charset=utf-8', headers)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/metrics':
+            data = self.service.metrics.snapshot()
+            data.update(workers=self.service.workers, queue_limit=self.service.queue_limit)
+            self.send_json(200, data)
+        elif path == '/health':
+            self.send_body(200, b'ok', 'text/plain; charset=utf-8')
+        else:
+            self.send_json(404, {'error': "未知的路径"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != '/watermark':
+            self.close_connection = True
+            self.send_json(404, {'error': "未知的路径"})
+            return
+
+        start = time.perf_counter()
+        self.service.metrics.begin()
+        status, size, body_out, timings = 500, 0, b'', None
+        data = None
+        try:
+            # 参数、请求体大小和排队位置都检查过后才接收请求体
+            request = self.service.parse(url.query)
+            length = self.body_length()
+            with self.service.slot():
+                data = self.read_body(length)
+                size = len(data)
+                body_out, image_format, timings = self.service.render(data, request)
+            status = 200
+            server_timing = ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+            self.send_body(200, body_out, CONTENT_TYPES.get(image_format, 'application/octet-stream'),
+                           {'Server-Timing': server_timing})
+        except RequestError as e:
+            status = e.status
+            if data is None:
+                # 请求体没有读取，连接上剩下的数据无法继续解析
+                self.close_connection = True
+            headers = {'Retry-After': '1'} if e.status == 503 else None
+            self.send_json(e.status, {'error': str(e)}, headers)
+        except Exception as e:
+            print(f"处理请求失败: {str(e)}", file=sys.stderr)
+            traceback.print_exc()
+            self.send_json(500, {'error': str(e)})
+        finally:
+            self.service.metrics.end(status, time.perf_counter() - start, size, len(body_out), timings)
+
+    def handle_expect_100(self):
+        """客户端等待 100 Continue 时，先检查大小，超过上限的请求体不用发送"""
+        try:
+            too_large = int(self.headers.get('Content-Length', 0)) > self.service.max_body
+        except ValueError:
+            too_large = False
+        if too_large:
+            self.close_connection = True
+            self.service.metrics.begin()
+            self.service.metrics.end(413, 0.0)
+            self.send_json(413, {'error': f"请求体超过上限 {self.service.max_body // 1024 // 1024} MB"})
+            return False
+        return super().handle_expect_100()
+
+    def body_length(self):
+        """检查请求头，返回请求体的字节数；不能接收的请求抛出 RequestError"""
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            self.close_connection = True
+            raise RequestError(411, "请求需要 Content-Length，不支持分块传输")
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.close_connection = True
+            raise RequestError(411, "请求需要 Content-Length")
+        try:
+            length = int(length)
+        except ValueError:
+            self.close_connection = True
+            raise RequestError(400, "Content-Length 无效")
+        if length > self.service.max_body:
+            # 不读取超大的请求体，直接关闭连接
+            self.close_connection = True
+            raise RequestError(413, f"请求体超过上限 {self.service.max_body // 1024 // 1024} MB")
+        if length <= 0:
+            raise RequestError(400, "请求体为空")
+        return length
+
+    def read_body(self, length):
+        """读取 length 字节的请求体；不完整时关闭连接，不影响同一连接上的后续请求"""
+        data = self.rfile.read(length)
+        if len(data) != length:
+            self.close_connection = True
+            raise RequestError(400, "请求体不完整")
+        return data
+
+
+class WatermarkHTTPServer(ThreadingHTTPServer):
+    """每个连接一个线程，连接数超过 max_connections 时直接返回 503"""
+    daemon_threads = True
+    # 拒绝连接时的完整响应，不为它再开线程
+    BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n'
+                     b'Retry-After: 1\r\nConnection: close\r\n\r\n')
+
+    def __init__(self, address, service, quiet=False, max_connections=DEFAULT_MAX_CONNECTIONS):
+        super().__init__(address, WatermarkRequestHandler)
+        self.service = service
+        self.quiet = quiet
+        self._connections = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self._connections.acquire(blocking=False):
+            self.service.metrics.begin()
+            self.service.metrics.end(503, 0.0)
+            try:
+                request.settimeout(1)
+                request.sendall(self.BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._connections.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._connections.release()
+
+
+def parse_watermark_args(values, settings_watermark=None):
+    """--watermark 名称=路径，返回 {名称: RGBA 图片}
+
+    默认水印总是加载为 default，settings_watermark（设置文件中的水印图片路径）
+    加载为 settings。
+    """
+    watermarks = {DEFAULT_WATERMARK_NAME: load_default_watermark() or create_fallback_watermark()}
+    if settings_watermark:
+        watermarks[SETTINGS_WATERMARK_NAME] = load_watermark_image(settings_watermark)
+    for value in values or []:
+        name, sep, path = value.partition('=')
+        if not sep or not name or not path:
+            raise ValueError(f"--watermark 的格式应为 名称=路径: {value}")
+        watermarks[name] = load_watermark_image(path)
+    return watermarks
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="本地 HTTP 加水印服务")
+    parser.add_argument('--host', default='127.0.0.1', help="监听地址（默认: %(default)s，只允许本机访问）")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="端口（默认: %(default)s）")
+    parser.add_argument('-j', '--workers', type=int, default=default_workers(),
+                        help="工作进程数（默认: %(default)s）")
+    parser.add_argument('--settings', help="JSON 设置文件，作为请求参数的默认值；其中的 watermark 图片"
+                             f"加载为 {SETTINGS_WATERMARK_NAME}，custom 水印的请求默认使用它")
+    parser.add_argument('--watermark', action='append', metavar='NAME=PATH',
+                        help="预先加载的水印图片，请求中用 watermark=NAME 选择（可重复）")
+    parser.add_argument('--max-body', type=float, default=DEFAULT_MAX_BODY_MB, metavar='MB',
+                        help="请求体上限（默认: %(default)s MB）")
+    parser.add_argument('--max-pixels', type=int, help="图片像素数上限（默认使用 Pillow 的限制）")
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS,
+                        help="同时保持的连接数上限，超过时返回 503（默认: %(default)s）")
+    parser.add_argument('-q', '--quiet', action='store_true', help="不输出每个请求的日志")
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        base_settings, settings_watermark = WatermarkSettings(), None
+        if args.settings:
+            base_settings, settings_watermark = load_settings_file(args.settings)
+        watermarks = parse_watermark_args(args.watermark, settings_watermark)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    service = WatermarkService(base_settings, watermarks, max(1, args.workers),
+                               int(args.max_body * 1024 * 1024), args.max_pixels)
+    server = WatermarkHTTPServer((args.host, args.port), service, args.quiet, max(1, args.max_connections))
+    host, port = server.server_address[:2]
+    print(f"加水印服务已启动: http://{host}:{port}/watermark（{service.workers} 个工作进程，"
+          f"编码方案: {', '.join(PROFILES)}），按 Ctrl+C 停止", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
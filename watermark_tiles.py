@@ -0,0 +1,531 @@
+"""超大图片的分块处理
+
+按内存上限把图片分成若干水平条带，逐条读取、加水印、写出，内存占用
+只和条带大小有关。只有和水印相交的条带才需要合成。
+
+Pillow 只能整张解码图片，也没有可以分段写入的编码器，所以分块模式自己
+按条带读取，输出为逐行压缩写入的 PNG。可以按条带读取的原图：
+
+- 未压缩的 TIFF、BMP、PPM/PGM：直接按行号计算数据位置，交给 Pillow 解码；
+- PNG（不隔行扫描、每通道 8 位及以下）：IDAT 流式解压，每次只解压一个条带，
+  行过滤交给 Pillow 的 PNG 解码器还原，见 PNGStreamReader；
+- 压缩的 TIFF（LZW、Deflate、JPEG 等）：每次只读取一个条带需要的 strip 或
+  一行 tile，写成一个小 TIFF 交给 Pillow（libtiff）解码，见 TIFFBandReader。
+
+其他图片超过内存上限时直接报错，不会撑爆内存。
+"""
+import io
+import os
+import time
+import zlib
+import struct
+from contextlib import contextmanager
+
+from PIL import Image
+
+from watermark_metrics import StageTimer
+from watermark_encoders import atomic_output
+
+
+# 每种读取方式同时存在的条带副本数：解码后的条带、转换后的条带和 PNG 行缓冲；
+# PNG 原图另有解压出的过滤数据和交给 Pillow 的数据，压缩的 TIFF 另有读取的压缩数据
+BAND_COPIES = {'raw': 3, 'png': 5, 'tiff': 4}
+# 每个 IDAT 块的最大长度
+PNG_CHUNK_SIZE = 1024 * 1024
+PNG_COLOR_TYPES = {'L': 0, 'RGB': 2, 'LA': 4, 'RGBA': 6}
+DEFAULT_COMPRESS_LEVEL = 6
+ORIENTATION_TAG = 0x0112
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# 每次从 IDAT 块读取的字节数
+PNG_READ_SIZE = 64 * 1024
+# 可以逐行解码的 PNG：(位深, 颜色类型) -> (模式, 原始数据格式)，和 Pillow 的 PNG 解码器一致
+PNG_STREAM_MODES = {
+    (1, 0): ('1', '1'), (2, 0): ('L', 'L;2'), (4, 0): ('L', 'L;4'), (8, 0): ('L', 'L'),
+    (8, 2): ('RGB', 'RGB'),
+    (1, 3): ('P', 'P;1'), (2, 3): ('P', 'P;2'), (4, 3): ('P', 'P;4'), (8, 3): ('P', 'P'),
+    (8, 4): ('LA', 'LA'),
+    (8, 6): ('RGBA', 'RGBA'),
+}
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# PNG 的行过滤以每像素字节数为单位，按这个字节数选一个逐字节不变的模式来还原过滤
+PNG_FILTER_MODES = {1: 'L', 2: 'LA', 3: 'RGB', 4: 'RGBA'}
+
+TIFF_PLANAR_CONFIG = 284
+TIFF_ROWS_PER_STRIP = 278
+TIFF_STRIP_OFFSETS = 273
+TIFF_STRIP_BYTE_COUNTS = 279
+TIFF_TILE_WIDTH = 322
+TIFF_TILE_LENGTH = 323
+TIFF_TILE_OFFSETS = 324
+TIFF_TILE_BYTE_COUNTS = 325
+TIFF_LONG = 4
+# TIFF 的数据类型 -> struct 格式（按一个值），BYTE/ASCII/UNDEFINED 按字节写入
+TIFF_TYPE_FORMATS = {1: 'B', 2: 'B', 3: 'H', 4: 'L', 5: 'LL', 6: 'b', 7: 'B', 8: 'h', 9: 'l', 10: 'll',
+                     11: 'f', 12: 'd'}
+# 写入条带 TIFF 时从原图复制的解码参数：位深、压缩、颜色、填充顺序、通道数、
+# 平面配置、预测器、调色板、附加通道、采样格式、JPEG 表和 YCbCr 参数
+TIFF_DECODE_TAGS = (258, 259, 262, 266, 277, 284, 317, 320, 338, 339, 347, 529, 530, 531, 532)
+
+
+class MemoryLimitError(Exception):
+    """图片超过内存上限且无法分块处理"""
+
+
+@contextmanager
+def unlimited_pixels():
+    """临时关闭 Pillow 的超大图片保护，由内存上限代替它"""
+    previous = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        yield
+    finally:
+        Image.MAX_IMAGE_PIXELS = previous
+
+
+def decoded_size(image):
+    """图片完整解码后占用的字节数（估算）"""
+    bands = Image.getmodebands(image.mode) if image.mode else 4
+    return image.width * image.height * max(bands, 1)
+
+
+def raw_stride(tile, mode, width):
+    """未压缩数据每行的字节数"""
+    args = tile.args if isinstance(tile.args, tuple) else (tile.args,)
+    if len(args) > 1 and args[1]:
+        return args[1]
+    # 用打包 8 个像素的长度推算每像素的位数
+    bits8 = len(Image.new(mode, (8, 1)).tobytes('raw', args[0]))
+    return (width * bits8 * 8 + 63) // 64
+
+
+def stream_kind(image):
+    """图片按条带读取的方式：'raw'、'png' 或 'tiff'（见模块说明），不能按条带读取时返回 None"""
+    try:
+        if not image.tile:
+            return None
+        if image.format == 'PNG':
+            # PNG 的 getexif 会解码整张图片，Pillow 也不按 PNG 的方向旋转，不用检查
+            tile = image.tile[0]
+            rawmode = tile.args[0] if isinstance(tile.args, tuple) else tile.args
+            supported = {raw for _, raw in PNG_STREAM_MODES.values()}
+            if (len(image.tile) == 1 and tile.codec_name == 'zip' and rawmode in supported
+                    and not image.info.get('interlace')):
+                return 'png'
+            return None
+        # 带旋转方向的 TIFF 解码后会整体旋转，不能按条带处理
+        if image.getexif().get(ORIENTATION_TAG, 1) != 1:
+            return None
+        if all(tile.codec_name == 'raw' for tile in image.tile):
+            for tile in image.tile:
+                x0, _, x1, _ = tile.extents
+                raw_stride(tile, image.mode, x1 - x0)
+            return 'raw'
+        if image.format == 'TIFF' and image.tile[0].codec_name == 'libtiff':
+            tags = image.tag_v2
+            layout = TIFF_STRIP_OFFSETS in tags or TIFF_TILE_OFFSETS in tags
+            if layout and tags.get(TIFF_PLANAR_CONFIG, 1) == 1:
+                return 'tiff'
+        return None
+    except Exception:
+        return None
+
+
+def can_stream(image):
+    """图片可以按条带读取"""
+    return stream_kind(image) is not None
+
+
+def band_unit(image, kind):
+    """条带的行数必须是这个数的整数倍：压缩的 TIFF 为每个 strip 或 tile 的行数，其他为 1"""
+    if kind != 'tiff':
+        return 1
+    tags = image.tag_v2
+    if TIFF_TILE_OFFSETS in tags:
+        return tags[TIFF_TILE_LENGTH]
+    return max(1, min(tags.get(TIFF_ROWS_PER_STRIP, image.height), image.height))
+
+
+def band_tiles(image, top, bottom):
+    """把原图的数据块裁剪成只覆盖 [top, bottom) 行的数据块"""
+    tiles = []
+    for tile in image.tile:
+        x0, y0, x1, y1 = tile.extents
+        start, end = max(y0, top), min(y1, bottom)
+        if start >= end:
+            continue
+        args = tile.args if isinstance(tile.args, tuple) else (tile.args,)
+        stride = raw_stride(tile, image.mode, x1 - x0)
+        orientation = args[2] if len(args) > 2 else 1
+        if orientation < 0:
+            # 从下往上存储（BMP）：最后一行在最前面
+            offset = tile.offset + (y1 - end) * stride
+        else:
+            offset = tile.offset + (start - y0) * stride
+        new_args = (args[0], stride, orientation) + tuple(args[3:])
+        tiles.append(tile._replace(extents=(x0, start - top, x1, end - top),
+                                   offset=offset, args=new_args))
+    return tiles
+
+
+class PNGStreamReader:
+    """逐条解码不隔行扫描的 PNG，只保留当前条带的数据
+
+    IDAT 按需流式解压，每次只解压一个条带的行。行过滤（Sub/Up/Average/Paeth）
+    要参考上一行，所以把上一个条带还原后的最后一行（过滤类型 0）放在条带前面，
+    一起交给 Pillow 的 PNG 解码器还原，结果和 Pillow 整张解码完全相同。
+    """
+
+    def __init__(self, f):
+        self.f = f
+        if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+            raise ValueError("不是 PNG 文件")
+        header = None
+        self.palette = None
+        self.transparency = None
+        while True:
+            length, kind = self._chunk_header()
+            if kind == b'IDAT':
+                break
+            data = f.read(length)
+            f.read(4)
+            if kind == b'IHDR':
+                header = struct.unpack('>IIBBBBB', data[:13])
+            elif kind == b'PLTE':
+                self.palette = data
+            elif kind == b'tRNS':
+                self.transparency = data
+        if header is None:
+            raise ValueError("PNG 缺少 IHDR")
+        width, height, bits, color_type, _, _, interlace = header
+        if interlace or (bits, color_type) not in PNG_STREAM_MODES:
+            raise ValueError("只能逐行解码不隔行扫描、每通道 8 位及以下的 PNG")
+        self.size = (width, height)
+        self.mode, self.rawmode = PNG_STREAM_MODES[(bits, color_type)]
+        channels = PNG_CHANNELS[color_type]
+        self.stride = (width * bits * channels + 7) // 8
+        self._pixel_bytes = max(1, bits * channels // 8)
+        self._filter_mode = PNG_FILTER_MODES[self._pixel_bytes]
+        # 当前 IDAT 块中还没有读取的字节数
+        self._remaining = length
+        self._inflater = zlib.decompressobj()
+        self._input = b''
+        self._output = bytearray()
+        # 上一行还原后的数据，第一行之前按 PNG 规定为全 0
+        self._previous = bytes(self.stride)
+
+    def _chunk_header(self):
+        header = self.f.read(8)
+        if len(header) < 8:
+            raise ValueError("PNG 数据不完整")
+        return struct.unpack('>I4s', header)
+
+    def _read_idat(self):
+        """读取下一段压缩数据，跨越多个 IDAT 块"""
+        while not self._remaining:
+            self.f.read(4)
+            length, kind = self._chunk_header()
+            if kind != b'IDAT':
+                raise ValueError("PNG 图像数据不完整")
+            self._remaining = length
+        data = self.f.read(min(self._remaining, PNG_READ_SIZE))
+        if not data:
+            raise ValueError("PNG 数据不完整")
+        self._remaining -= len(data)
+        return data
+
+    def read_band(self, rows):
+        """解码接下来的 rows 行，返回条带图片"""
+        need = rows * (self.stride + 1)
+        while len(self._output) < need:
+            if self._inflater.eof:
+                raise ValueError("PNG 图像数据不完整")
+            data = self._input or self._read_idat()
+            self._output += self._inflater.decompress(data, need - len(self._output))
+            self._input = self._inflater.unconsumed_tail
+        # 不压缩地重新打包成 zlib 流，交给 Pillow 还原过滤
+        packer = zlib.compressobj(0)
+        stream = packer.compress(b'\x00' + self._previous)
+        stream += packer.compress(memoryview(self._output)[:need])
+        stream += packer.flush()
+        del self._output[:need]
+        filter_width = self.stride // self._pixel_bytes
+        decoded = Image.frombytes(self._filter_mode, (filter_width, rows + 1), stream, 'zip',
+                                  self._filter_mode)
+        stream = None
+        self._previous = decoded.crop((0, rows, filter_width, rows + 1)).tobytes()
+        if self.mode == self._filter_mode:
+            band = decoded.crop((0, 1, filter_width, rows + 1))
+        else:
+            data = decoded.tobytes()
+            decoded = None
+            band = Image.frombytes(self.mode, (self.size[0], rows), memoryview(data)[self.stride:],
+                                   'raw', self.rawmode)
+        if self.mode == 'P' and self.palette:
+            if self.transparency:
+                # 带透明度的调色板，转换为 RGBA 时使用
+                alpha = self.transparency + b'\xff' * (len(self.palette) // 3 - len(self.transparency))
+                band.putpalette(b''.join(self.palette[i * 3:i * 3 + 3] + alpha[i:i + 1]
+                                         for i in range(len(self.palette) // 3)), 'RGBA')
+            else:
+                band.putpalette(self.palette)
+        return band
+
+
+def tiff_value(value, kind):
+    """把 TIFF 标签的值编码为小端字节，返回 (字节, 值的个数)"""
+    if isinstance(value, bytes):
+        return value, len(value)
+    if isinstance(value, str):
+        data = value.encode('ascii') + b'\x00'
+        return data, len(data)
+    values = value if isinstance(value, (tuple, list)) else (value,)
+    if kind in (5, 10):
+        # 分数按 (分子, 分母) 写入
+        values = [part for item in values for part in (item.numerator, item.denominator)]
+        return struct.pack(f'<{len(values)}{TIFF_TYPE_FORMATS[kind][0]}', *values), len(values) // 2
+    return struct.pack(f'<{len(values)}{TIFF_TYPE_FORMATS[kind]}', *values), len(values)
+
+
+def tiff_file(entries, offsets_tag, pieces):
+    """写出只有一个目录的小端 TIFF 文件内容
+
+    entries 为 {标签: (值, 类型)}；pieces 为图像数据块，依次放在目录之后，
+    它们的位置写入 offsets_tag（StripOffsets 或 TileOffsets）。
+    """
+    entries = dict(entries)
+    entries[offsets_tag] = ((0,) * len(pieces), TIFF_LONG)
+    tags = sorted(entries)
+    encoded = {tag: tiff_value(*entries[tag]) for tag in tags}
+    # 超过 4 字节的值放在目录后面，按偶数位置对齐
+    extra_start = 8 + 2 + 12 * len(tags) + 4
+    position = extra_start
+    for data, _ in encoded.values():
+        if len(data) > 4:
+            position += len(data) + len(data) % 2
+    offsets = []
+    for piece in pieces:
+        offsets.append(position)
+        position += len(piece)
+    encoded[offsets_tag] = tiff_value(tuple(offsets), TIFF_LONG)
+
+    directory = [struct.pack('<H', len(tags))]
+    extra = []
+    position = extra_start
+    for tag in tags:
+        data, count = encoded[tag]
+        if len(data) > 4:
+            directory.append(struct.pack('<HHLL', tag, entries[tag][1], count, position))
+            extra.append(data + b'\x00' * (len(data) % 2))
+            position += len(data) + len(data) % 2
+        else:
+            directory.append(struct.pack('<HHL', tag, entries[tag][1], count) + data.ljust(4, b'\x00'))
+    directory.append(struct.pack('<L', 0))
+    return b''.join([b'II*\x00', struct.pack('<L', 8)] + directory + extra + list(pieces))
+
+
+class TIFFBandReader:
+    """按条带读取压缩的 TIFF（按 strip 或按 tile 存储，只支持 PlanarConfiguration 1）
+
+    每个条带只读取覆盖它的 strip 或一行 tile 的压缩数据，连同原图的解码参数
+    写成一个只有这个条带的小 TIFF，交给 Pillow（libtiff）解码。
+    """
+
+    def __init__(self, image):
+        tags = image.tag_v2
+        self.size = image.size
+        self.tiled = TIFF_TILE_OFFSETS in tags
+        self.unit = band_unit(image, 'tiff')
+        if self.tiled:
+            self.tile_width = tags[TIFF_TILE_WIDTH]
+            self.per_row = -(-image.width // self.tile_width)
+            self.offsets, self.byte_counts = tags[TIFF_TILE_OFFSETS], tags[TIFF_TILE_BYTE_COUNTS]
+        else:
+            self.per_row = 1
+            self.offsets, self.byte_counts = tags[TIFF_STRIP_OFFSETS], tags[TIFF_STRIP_BYTE_COUNTS]
+        self.tags = {tag: (tags[tag], tags.tagtype[tag]) for tag in TIFF_DECODE_TAGS if tag in tags}
+
+    def band_file(self, f, top, rows):
+        """从 f 读取 [top, top + rows) 行的压缩数据，返回只有这些行的 TIFF 文件内容"""
+        first = top // self.unit * self.per_row
+        last = -(-(top + rows) // self.unit) * self.per_row
+        pieces = []
+        for offset, count in zip(self.offsets[first:last], self.byte_counts[first:last]):
+            f.seek(offset)
+            pieces.append(f.read(count))
+
+        entries = dict(self.tags)
+        if self.tiled:
+            layout = {256: self.size[0], 257: rows, TIFF_TILE_WIDTH: self.tile_width, TIFF_TILE_LENGTH: self.unit}
+            offsets_tag, counts_tag = TIFF_TILE_OFFSETS, TIFF_TILE_BYTE_COUNTS
+        else:
+            layout = {256: self.size[0], 257: rows, TIFF_ROWS_PER_STRIP: self.unit}
+            offsets_tag, counts_tag = TIFF_STRIP_OFFSETS, TIFF_STRIP_BYTE_COUNTS
+        entries.update((tag, (value, TIFF_LONG)) for tag, value in layout.items())
+        entries[counts_tag] = (tuple(len(piece) for piece in pieces), TIFF_LONG)
+        return tiff_file(entries, offsets_tag, pieces)
+
+    def read_band(self, f, top, rows):
+        """解码 [top, top + rows) 行，top 为 unit 的整数倍"""
+        with unlimited_pixels():
+            band = Image.open(io.BytesIO(self.band_file(f, top, rows)))
+            band.load()
+        return band
+
+
+def iter_bands(path, band_height):
+    """逐条解码图片，产出 (起始行, 条带图片)；band_height 为 band_unit 的整数倍"""
+    with unlimited_pixels():
+        header = Image.open(path)
+    width, height = header.size
+    kind = stream_kind(header)
+    tiff = TIFFBandReader(header) if kind == 'tiff' else None
+    header.close()
+
+    if kind in ('png', 'tiff'):
+        with open(path, 'rb') as f:
+            png = PNGStreamReader(f) if kind == 'png' else None
+            for top in range(0, height, band_height):
+                rows = min(band_height, height - top)
+                yield top, png.read_band(rows) if png else tiff.read_band(f, top, rows)
+        return
+
+    for top in range(0, height, band_height):
+        bottom = min(top + band_height, height)
+        with unlimited_pixels():
+            band = Image.open(path)
+            band.tile = band_tiles(band, top, bottom)
+            band._size = (width, bottom - top)
+            if hasattr(band, '_tile_size'):
+                # TIFF 按 _tile_size 分配解码缓冲
+                band._tile_size = band._size
+            band.load()
+        yield top, band
+
+
+class PNGStreamWriter:
+    """逐行写入 PNG，不需要整张图片在内存中"""
+
+    def __init__(self, f, size, mode, compress_level=DEFAULT_COMPRESS_LEVEL):
+        self.f = f
+        self.size = size
+        self.mode = mode
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._pending = []
+        self._pending_size = 0
+        f.write(b'\x89PNG\r\n\x1a\n')
+        self._chunk(b'IHDR', struct.pack('>IIBBBBB', size[0], size[1], 8,
+                                         PNG_COLOR_TYPES[mode], 0, 0, 0))
+
+    def _chunk(self, kind, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(kind)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind)) & 0xffffffff))
+
+    def _write_compressed(self, data, final=False):
+        if data:
+            self._pending.append(data)
+            self._pending_size += len(data)
+        if self._pending_size >= PNG_CHUNK_SIZE or (final and self._pending):
+            self._chunk(b'IDAT', b''.join(self._pending))
+            self._pending = []
+            self._pending_size = 0
+
+    def write_band(self, band):
+        """写入一条图片（宽度相同，模式相同）"""
+        data = band.tobytes()
+        stride = len(data) // band.height
+        # 每行前加过滤类型 0（不过滤）
+        rows = b''.join(b'\x00' + data[y * stride:(y + 1) * stride] for y in range(band.height))
+        self._write_compressed(self._compressor.compress(rows))
+        self.rows_written += band.height
+
+    def close(self):
+        if self.rows_written != self.size[1]:
+            raise ValueError(f"PNG 行数不完整: {self.rows_written}/{self.size[1]}")
+        self._write_compressed(self._compressor.flush(), final=True)
+        self._chunk(b'IEND', b'')
+
+
+def output_mode(mode):
+    """PNG 可以直接写入的模式"""
+    if mode in PNG_COLOR_TYPES:
+        return mode
+    if mode in ('PA', 'P') or mode.endswith('A'):
+        return 'RGBA'
+    return 'RGB'
+
+
+def band_height_for(width, bytes_per_pixel, memory_limit, copies=BAND_COPIES['raw'], unit=1):
+    """内存上限内每个条带的行数，为 unit 的整数倍（至少 unit 行）"""
+    row_bytes = max(1, width * bytes_per_pixel * copies)
+    return max(unit, memory_limit // row_bytes // unit * unit)
+
+
+def band_bytes_per_row(image):
+    """分块处理时条带每行占用的字节数（所有副本合计）"""
+    mode = output_mode(image.mode)
+    bytes_per_pixel = max(Image.getmodebands(image.mode), Image.getmodebands(mode))
+    return image.width * bytes_per_pixel * BAND_COPIES[stream_kind(image) or 'raw']
+
+
+def process_tiled(renderer, image_path, save_path, memory_limit, compress_level=None, timer=None):
+    """分块处理一张图片，返回 (写入的字节数, 压缩写入的耗时)
+
+    timer（watermark_metrics.StageTimer）记录各阶段在所有条带上的总耗时，
+    PNG 边压缩边写入，都记在 encode 阶段。
+    """
+    timer = timer or StageTimer()
+    with unlimited_pixels():
+        image = Image.open(image_path)
+    full_size = image.size
+    mode = output_mode(image.mode)
+    bytes_per_pixel = max(Image.getmodebands(image.mode), Image.getmodebands(mode))
+    kind = stream_kind(image)
+    unit = band_unit(image, kind)
+    image.close()
+
+    band_height = band_height_for(full_size[0], bytes_per_pixel, memory_limit, BAND_COPIES[kind or 'raw'], unit)
+    encode_time = 0.0
+    with atomic_output(save_path) as f:
+        writer = PNGStreamWriter(f, full_size, mode, compress_level or DEFAULT_COMPRESS_LEVEL)
+        bands = iter_bands(image_path, band_height)
+        while True:
+            with timer.stage('decode'):
+                item = next(bands, None)
+            if item is None:
+                break
+            top, band = item
+            if band.mode != mode:
+                with timer.stage('convert'):
+                    band = band.convert(mode)
+            # 只有和水印相交的条带才会真正合成
+            renderer.render_region(band, (0, top), full_size, timer)
+            start = time.perf_counter()
+            writer.write_band(band)
+            encode_time += time.perf_counter() - start
+        start = time.perf_counter()
+        writer.close()
+        encode_time += time.perf_counter() - start
+    timer.add('encode', encode_time)
+    return os.path.getsize(save_path), encode_time
+
+
+def check_memory(image, memory_limit, profile_format):
+    """判断图片是否需要分块处理；超过上限又不能分块时抛出 MemoryLimitError"""
+    need = decoded_size(image)
+    if need <= memory_limit:
+        return False
+    kind = stream_kind(image)
+    if kind and profile_format == 'PNG':
+        smallest = band_bytes_per_row(image) * band_unit(image, kind)
+        if smallest > memory_limit:
+            raise MemoryLimitError(
+                f"TIFF 的每个数据块有 {band_unit(image, kind)} 行，解码一块约需 {smallest / 1024 / 1024:.0f} MB，"
+                f"超过内存上限 {memory_limit / 1024 / 1024:.0f} MB")
+        return True
+    raise MemoryLimitError(
+        f"图片解码后约 {need / 1024 / 1024:.0f} MB，超过内存上限 {memory_limit / 1024 / 1024:.0f} MB；"
+        f"分块处理需要 PNG（不隔行扫描、每通道 8 位及以下）、TIFF、BMP 或 PPM 原图并输出 PNG")
@@ -0,0 +1,346 @@
+"""监视文件夹，新图片写入完成后产出它的路径
+
+Linux 上用 inotify（通过 ctypes 调用，不需要额外安装），收到“写入端已关闭”
+或“移入”事件后立即处理。其他系统、inotify 不可用或指定 poll=True 时定期扫描：
+每次只对每个目录 stat 一次，修改时间变化的目录才用 os.scandir 重新列出；
+原地覆盖不会改变目录的修改时间，所以每隔 FULL_SCAN_INTERVAL 秒完整扫描一次。
+
+使用 inotify 时，看到写入活动的文件要等到写入端关闭才处理（超过
+OPEN_WRITE_TIMEOUT 秒没有任何变化也会处理）；扫描模式和启动时已有的文件
+则在大小和修改时间保持 settle 秒不变后认为写入完成。扫描模式下刚处理过的
+文件还会继续检查 RECHECK_SECONDS 秒，写入中途停顿导致处理了不完整的文件时，
+写完后会再处理一次。网络共享文件夹上 inotify 收不到其他电脑的修改，这时
+应该使用扫描。
+
+处理过的文件记录它的签名，避免重新扫描时再次产出：扫描模式下一直记录到
+文件被删除或移走；inotify 只报告变化，处理 RECHECK_SECONDS 秒后就不再记录
+（事件队列溢出后的完整扫描可能再次产出这些文件，由处理记录跳过）。长时间
+运行时记录的数量不会超过文件夹中的文件数。
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+
+# 扫描间隔（秒）
+POLL_INTERVAL = 1.0
+# 文件保持不变多少秒才认为写入完成
+SETTLE_SECONDS = 2.0
+# 扫描模式下每隔多少秒完整扫描一次
+FULL_SCAN_INTERVAL = 60.0
+# 扫描模式下处理过的文件继续检查多少秒，inotify 模式下处理过的文件记录多少秒
+RECHECK_SECONDS = 60.0
+# inotify 模式下写入端一直没有关闭的文件，多少秒没有变化后也处理
+OPEN_WRITE_TIMEOUT = 60.0
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def file_signature(path):
+    """(大小, 修改时间)，文件不存在时返回 None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class Inotify:
+    """最小的 inotify 封装，只在 Linux 上可用"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def read(self, timeout):
+        """等待事件，返回 [(wd, mask, 文件名)]"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def inotify_available():
+    return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+
+class FolderWatcher:
+    """监视一个或多个文件夹，产出写入完成的文件 (路径, 所在的监视根目录)
+
+    accept(path) 判断文件是否需要处理，skip_dir(path) 返回 True 的子目录不监视
+    （例如输出目录）。启动时文件夹中已有的文件也会产出一次，是否已经处理过由
+    调用方（处理记录）判断；之后只有新出现或内容变化的文件才会再次产出。
+    """
+
+    def __init__(self, roots, recursive=False, accept=None, skip_dir=None,
+                 settle=SETTLE_SECONDS, interval=POLL_INTERVAL, poll=False):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.recursive = recursive
+        self.accept = accept or (lambda path: True)
+        self.skip_dir = skip_dir or (lambda path: False)
+        self.settle = settle
+        self.interval = interval
+        self.inotify = None
+        if not poll and inotify_available():
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                print(f"无法使用 inotify，改为定期扫描: {str(e)}", file=sys.stderr)
+        # 目录 -> (修改时间, 所在的监视根目录)
+        self._dirs = {}
+        # inotify 监视描述符 -> 目录
+        self._watches = {}
+        # 目录 -> {已经产出的文件: 产出时的签名}
+        self._seen = {}
+        # 刚产出的文件 -> 产出的时间
+        self._recent = {}
+        # 等待写入完成的文件 -> [签名, 签名开始不变的时间, 是否收到关闭事件, 根目录, 是否由扫描发现]
+        self._pending = {}
+        self._last_full_scan = 0.0
+
+    @property
+    def mode(self):
+        return 'inotify' if self.inotify is not None else 'poll'
+
+    def _add_dir(self, directory, root):
+        if directory in self._dirs or (directory != root and self.skip_dir(directory)):
+            return
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            return
+        if self.inotify is not None:
+            # 先监视再列出，列出期间新建的文件不会漏掉
+            try:
+                self._watches[self.inotify.add_watch(directory)] = directory
+            except OSError as e:
+                print(f"无法监视目录 {directory}: {str(e)}", file=sys.stderr)
+        self._dirs[directory] = (mtime, root)
+        self._scan_dir(directory, root)
+
+    def _scan_dir(self, directory, root):
+        """列出目录中的文件和子目录"""
+        try:
+            entries = os.scandir(directory)
+        except OSError:
+            self._dirs.pop(directory, None)
+            self._seen.pop(directory, None)
+            return
+        subdirs = []
+        files = set()
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if self.recursive:
+                            subdirs.append(entry.path)
+                    elif entry.is_file() and self.accept(entry.path):
+                        files.add(entry.path)
+                        stat = entry.stat()
+                        self._track(entry.path, (stat.st_size, stat.st_mtime_ns), root)
+                except OSError:
+                    continue
+        # 已经删除或移走的文件不再记录
+        seen = self._seen.get(directory)
+        if seen:
+            for path in [path for path in seen if path not in files]:
+                del seen[path]
+            if not seen:
+                del self._seen[directory]
+        for subdir in subdirs:
+            self._add_dir(subdir, root)
+
+    def _track(self, path, signature, root, closed=False, scanned=True):
+        """记录一个可能需要处理的文件
+
+        scanned 为 False 表示由 inotify 的写入事件发现，需要等待关闭事件。
+        """
+        if signature is None or self._seen_signature(path) == signature:
+            return
+        entry = self._pending.get(path)
+        now = time.monotonic()
+        if entry is None:
+            self._pending[path] = [signature, now, closed, root, scanned]
+        else:
+            if entry[0] != signature:
+                entry[0], entry[1] = signature, now
+            entry[2] = entry[2] or closed
+            entry[4] = entry[4] and scanned
+
+    def _poll_dirs(self, full=False):
+        """扫描模式：只重新列出修改时间变化的目录"""
+        for directory, (mtime, root) in list(self._dirs.items()):
+            try:
+                current = os.stat(directory).st_mtime_ns
+            except OSError:
+                del self._dirs[directory]
+                self._seen.pop(directory, None)
+                continue
+            if full or current != mtime:
+                self._dirs[directory] = (current, root)
+                self._scan_dir(directory, root)
+
+    def _read_events(self, timeout):
+        overflow = False
+        for wd, mask, name in self.inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            if mask & (IN_IGNORED | IN_DELETE_SELF | IN_MOVE_SELF):
+                if mask & IN_IGNORED:
+                    del self._watches[wd]
+                self._dirs.pop(directory, None)
+                self._seen.pop(directory, None)
+                continue
+            path = os.path.join(directory, name)
+            root = self._root_of(path)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_dir(path, root)
+            elif self.accept(path):
+                self._track(path, file_signature(path), root,
+                            closed=bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO)), scanned=False)
+        if overflow:
+            # 事件队列溢出，可能漏掉了文件，完整扫描一次
+            self._poll_dirs(full=True)
+
+    def _ready(self):
+        """产出已经写入完成的文件"""
+        now = time.monotonic()
+        for path, entry in list(self._pending.items()):
+            signature = file_signature(path)
+            if signature is None:
+                del self._pending[path]
+                continue
+            if signature != entry[0]:
+                # 还在写入
+                entry[0], entry[1], entry[2] = signature, now, False
+                continue
+            # inotify 看到写入活动后等待关闭事件，否则等待文件保持不变
+            settle = self.settle if self.inotify is None or entry[4] else OPEN_WRITE_TIMEOUT
+            # 空文件通常是刚创建、还没开始写入
+            if signature[0] and (entry[2] or now - entry[1] >= settle):
+                del self._pending[path]
+                self._seen.setdefault(os.path.dirname(path), {})[path] = signature
+                self._recent[path] = now
+                yield path, entry[3]
+
+    def _recheck_recent(self):
+        """扫描模式：刚处理过的文件又被修改时重新处理"""
+        now = time.monotonic()
+        for path, since in list(self._recent.items()):
+            if now - since >= RECHECK_SECONDS:
+                del self._recent[path]
+                continue
+            signature = file_signature(path)
+            if signature is None:
+                del self._recent[path]
+            elif signature != self._seen_signature(path):
+                del self._recent[path]
+                self._track(path, signature, self._root_of(path))
+
+    def _forget_processed(self):
+        """inotify 模式：处理过 RECHECK_SECONDS 秒的文件不再记录，之后的修改由事件报告"""
+        now = time.monotonic()
+        for path, since in list(self._recent.items()):
+            if now - since < RECHECK_SECONDS:
+                continue
+            del self._recent[path]
+            directory = os.path.dirname(path)
+            seen = self._seen.get(directory)
+            if seen is not None:
+                seen.pop(path, None)
+                if not seen:
+                    del self._seen[directory]
+
+    def _seen_signature(self, path):
+        return self._seen.get(os.path.dirname(path), {}).get(path)
+
+    def _root_of(self, path):
+        return self._dirs.get(os.path.dirname(path), (None, os.path.dirname(path)))[1]
+
+    def watch(self, stop=None):
+        """一直监视，直到 stop（threading.Event）被设置"""
+        for root in self.roots:
+            self._add_dir(root, root)
+        # 启动时已经存在并且很久没有修改的文件不需要等待
+        cutoff = time.time_ns() - int(self.settle * 1e9)
+        for entry in self._pending.values():
+            if entry[0][1] <= cutoff:
+                entry[2] = True
+        self._last_full_scan = time.monotonic()
+
+        try:
+            while stop is None or not stop.is_set():
+                yield from self._ready()
+                # 有文件在等待写入完成时更频繁地检查
+                timeout = min(self.interval, self.settle / 4) if self._pending else self.interval
+                if self.inotify is not None:
+                    self._read_events(timeout)
+                    self._forget_processed()
+                else:
+                    if stop is not None:
+                        stop.wait(timeout)
+                    else:
+                        time.sleep(timeout)
+                    full = time.monotonic() - self._last_full_scan >= FULL_SCAN_INTERVAL
+                    if full:
+                        self._last_full_scan = time.monotonic()
+                    self._poll_dirs(full)
+                    self._recheck_recent()
+        finally:
+            self.close()
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify = None